@@ -2,15 +2,17 @@
 
 import os
 import sys
+import json
 import logging
 import logging.config
 import argparse
-from time import sleep
 
-import schedule
 import orgassist
 from orgassist.config import Config, ConfigError
 from orgassist.assistant import Assistant
+from orgassist.helpers import Scheduler, MetricsExporter
+from orgassist.control import ControlServer, register_commands
+from orgassist.helpers.sockets import SocketInUse
 
 
 def parse_args():
@@ -29,6 +31,18 @@ def parse_args():
                    type=str,
                    metavar="PATH",
                    default=None)
+    p.add_argument("--agenda",
+                   help="Print agenda and exit (uses the org parse cache)",
+                   action="store_true",
+                   default=False)
+    p.add_argument("--assistant",
+                   help="Assistant whose agenda is printed (default: first)",
+                   type=str,
+                   default=None)
+    p.add_argument("--json",
+                   help="Print agenda as JSON",
+                   action="store_true",
+                   default=False)
 
     """
     p.add_argument("--daemon",
@@ -91,8 +105,36 @@ def register_plugins(cfg):
         importlib.import_module(plugin)
 
 
-def setup(args):
-    "Setup logging"
+def setup_metrics(cfg, scheduler, bots, assistants):
+    "Periodically write metrics for the node-exporter textfile collector"
+    path = cfg.get_path('metrics.path', required=False)
+    if path is None:
+        return None
+    interval = cfg.get('metrics.interval', default=60, assert_type=int)
+
+    sources = [scheduler.get_metrics]
+    sources += [bot.get_metrics for bot in bots]
+    sources += [assistant.get_metrics for assistant in assistants]
+    exporter = MetricsExporter(path, sources)
+    scheduler.every(interval).seconds.do(exporter.write)
+    return exporter
+
+
+def setup_control(cfg, scheduler, assistants):
+    "Serve status and control commands on a Unix socket"
+    path = cfg.get_path('control.socket', required=False)
+    if path is None:
+        return None
+    control = ControlServer(path)
+    register_commands(control, assistants, scheduler)
+    return control
+
+
+def setup(args, bot=None):
+    """
+    Read config, create scheduler and assistants talking through a bot -
+    XMPP unless a different one is given (eg. LoopbackBot).
+    """
     try:
         cfg = Config.from_file(args.config)
     except FileNotFoundError:
@@ -102,10 +144,18 @@ def setup(args):
     register_plugins(cfg)
 
     # Scheduler
-    scheduler = schedule.Scheduler()
+    scheduler = Scheduler()
 
     # XMPP Bot / interface
-    xmpp_bot = orgassist.bots.XmppBot(cfg.bots.xmpp)
+    if bot is None:
+        xmpp_bot = orgassist.bots.XmppBot(cfg.bots.xmpp)
+    else:
+        xmpp_bot = bot
+
+    # Optional local HTTP interface for scripts
+    http_bot = None
+    if cfg.get('bots.http', required=False) is not None:
+        http_bot = orgassist.bots.HttpBot(cfg.bots.http)
 
     # Create instances of assistants
     assistants = []
@@ -116,10 +166,16 @@ def setup(args):
                               scheduler)
 
         assistant.register_xmpp_bot(xmpp_bot)
+        if http_bot is not None:
+            assistant.register_http_bot(http_bot)
         # FUTURE: s.register_irc_bot(irc)
 
         assistants.append(assistant)
 
+    bots = [xmpp_bot] + ([http_bot] if http_bot is not None else [])
+    setup_metrics(cfg, scheduler, bots, assistants)
+    control = setup_control(cfg, scheduler, assistants)
+
     unused = cfg.get_unused()
     if unused:
         print('The following config keys were unused and can be mistyped:')
@@ -128,19 +184,83 @@ def setup(args):
 
     return {
         'xmpp_bot': xmpp_bot,
+        'http_bot': http_bot,
+        'control': control,
         'assistants': assistants,
         'scheduler': scheduler,
     }
 
 
+def print_agenda(args):
+    """
+    Print agenda of a single assistant and exit. No bots are started and
+    no notification state is written - safe to run next to the daemon.
+    """
+    try:
+        cfg = Config.from_file(args.config)
+    except FileNotFoundError:
+        print("Unable to read config file:", args.config)
+        return 4
+    setup_logging(cfg)
+    register_plugins(cfg)
+
+    configs = dict(cfg.assistants.items())
+    if not configs:
+        print("No assistants configured")
+        return 4
+    name = args.assistant or next(iter(configs))
+    if name not in configs:
+        print("Unknown assistant:", name)
+        return 4
+
+    assistant = Assistant(name, configs[name], Scheduler(), read_only=True)
+    plugin = assistant.plugins.get('calendar')
+    if plugin is None:
+        print("Calendar plugin is not enabled for", name)
+        return 4
+
+    if not args.json:
+        print(plugin.get_agenda())
+        return 0
+
+    def describe(events):
+        "Serialize events with their sources"
+        return [
+            dict(event.as_dict(), source=plugin.calendar.source_of(event))
+            for event in events
+        ]
+
+    ctx = plugin.get_agenda_context()
+    agenda = {
+        'now': ctx['now'].isoformat(),
+        'appointments': describe(ctx['appointments']),
+        'unfinished': describe(ctx['unfinished']),
+        'queries': {
+            query: describe(events)
+            for query, events in ctx['queries'].items()
+        },
+    }
+    print(json.dumps(agenda, indent=2))
+    return 0
+
+
+def close_interfaces(program):
+    "Stop local interfaces and remove their sockets"
+    if program.get('http_bot'):
+        program['http_bot'].close()
+    if program.get('control'):
+        program['control'].close()
+
+
 def main_loop(program):
     "Main loop - execute scheduled tasks"
     while True:
+        program['scheduler'].check_stall()
         program['scheduler'].run_pending()
         idle = program['scheduler'].idle_seconds
         # Limit wakeups and sleep long, but not too long: bot communication
         # works in separate thread and while we are sleeping user might cause
-        # action which schedules something.
+        # action which schedules something - adding a job ends the wait.
 
         # Try to sleep evenly, instead of doing jumps of 30s + 3s sleep for a
         # total 33s idle time (instead will sleep 17 + 16 seconds)
@@ -151,8 +271,10 @@ def main_loop(program):
             idle = idle // 2 + 1
         elif idle < 0:
             idle = 0
-        sleep(idle)
+        program['scheduler'].wait(idle)
         try:
+            # Catch-up missed notifications before the overdue jobs run
+            program['scheduler'].check_stall(expected=idle)
             program['scheduler'].run_pending()
         except:
             # In case something bad happens - boss should know.
@@ -168,6 +290,14 @@ def main():
     if args.generate_config is not None:
         return generate_config(args.generate_config)
 
+    if args.agenda:
+        try:
+            return print_agenda(args)
+        except ConfigError as ex:
+            print("Error while parsing your configuration file:")
+            print(ex.args[0])
+            return 3
+
     try:
         program = setup(args)
         if program is None:
@@ -182,9 +312,19 @@ def main():
 
     if args.test:
         # Just test
+        close_interfaces(program)
         return 0
 
     # Start processing in other threads
+    try:
+        if program['control'] is not None:
+            program['control'].start()
+        if program['http_bot'] is not None:
+            program['http_bot'].start()
+    except SocketInUse as ex:
+        print("Unable to start:", ex)
+        close_interfaces(program)
+        return 4
     program['xmpp_bot'].client.process()
 
     try:
@@ -199,6 +339,7 @@ def main():
         if program.get('xmpp_bot'):
             print("Stopping XMPP")
             program['xmpp_bot'].close()
+        close_interfaces(program)
 
 
 if __name__ == "__main__":
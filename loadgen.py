@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Load generator - drives assistants configured in a config file through an
+in-process LoopbackBot and reports command latencies and throughput.
+
+Each simulated sender talks as one of the configured channel JIDs (round
+robin over all assistants) and issues commands with exponentially
+distributed pauses at given rates, eg.:
+
+    ./loadgen.py --config test.yml --senders 8 --duration 60 \\
+                 --rate ag=1 --rate s=2 --rate note=0.2 --rate refresh=0.05
+
+Latency is measured from the time a command was planned to be sent, so
+a slow assistant which delays following commands is not hidden.
+
+Plugins are not thread-safe - assistants run commands in the main loop,
+between scheduled jobs (refreshes, notifications), as with XMPP. Senders
+only wait for the main loop; the bot keeps a lock per assistant, so the
+messages of one command (eg. `s' and quitting its context) are not
+interleaved with other senders of the same assistant.
+
+Note: `note' appends to the configured inbox file - use a test config.
+"""
+
+import sys
+import random
+import argparse
+import threading
+from time import monotonic, sleep
+
+from orgassist.config import ConfigError
+from orgassist.bots import LoopbackBot
+
+import assist
+
+# Command name -> messages sent for it (formatted with a counter)
+COMMANDS = {
+    'ag': ('ag',),
+    's': ('s {search}', '.'),
+    'note': ('note Load test note {counter}',),
+    'refresh': ('refresh',),
+}
+
+DEFAULT_RATES = {
+    'ag': 0.5,
+    's': 0.5,
+    'note': 0.1,
+    'refresh': 0.05,
+}
+
+
+def parse_args():
+    "Parse arguments"
+    p = argparse.ArgumentParser()
+    p.add_argument("--config",
+                   help="Path to the YAML config file",
+                   type=str,
+                   default="config.yml")
+    p.add_argument("--senders",
+                   help="Number of simulated senders",
+                   type=int,
+                   default=4)
+    p.add_argument("--duration",
+                   help="Test duration in seconds",
+                   type=float,
+                   default=30)
+    p.add_argument("--rate",
+                   help=("Commands per second of each sender, eg. ag=0.5; "
+                         "commands: " + ", ".join(COMMANDS)),
+                   action="append",
+                   metavar="COMMAND=RATE",
+                   default=[])
+    p.add_argument("--search",
+                   help="Text searched by the `s' command",
+                   type=str,
+                   default="meeting")
+    p.add_argument("--seed",
+                   help="Random seed",
+                   type=int,
+                   default=None)
+    return p.parse_args()
+
+
+def parse_rates(specs):
+    "Parse COMMAND=RATE specifications and apply defaults"
+    rates = dict(DEFAULT_RATES)
+    for spec in specs:
+        command, _, rate = spec.partition('=')
+        if command not in COMMANDS:
+            raise ValueError("Unknown command '%s'" % command)
+        try:
+            rates[command] = float(rate)
+        except ValueError:
+            raise ValueError("Invalid rate '%s'" % spec)
+    return {command: rate for command, rate in rates.items() if rate > 0}
+
+
+def percentile(values, fraction):
+    "Nearest-rank percentile of sorted values"
+    if not values:
+        return None
+    rank = max(0, int(round(fraction * len(values) + 0.5)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+class Sender(threading.Thread):
+    "Simulated user sending commands at given rates"
+    def __init__(self, bot, jid, rates, search, deadline, seed):
+        super().__init__(daemon=True)
+        self.bot = bot
+        self.jid = jid
+        self.rates = rates
+        self.search = search
+        self.deadline = deadline
+        self.random = random.Random(seed)
+
+        # Command -> latencies in seconds
+        self.latencies = {command: [] for command in rates}
+        self.messages = 0
+        self.errors = 0
+
+    def run(self):
+        total_rate = sum(self.rates.values())
+        commands = list(self.rates)
+        weights = [self.rates[command] for command in commands]
+
+        planned = monotonic()
+        counter = 0
+        while True:
+            planned += self.random.expovariate(total_rate)
+            if planned >= self.deadline:
+                break
+            delay = planned - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+            command = self.random.choices(commands, weights)[0]
+            counter += 1
+            texts = [
+                text.format(search=self.search, counter=counter)
+                for text in COMMANDS[command]
+            ]
+            try:
+                self.bot.deliver(self.jid, *texts)
+            except Exception:
+                # Keep loading - the failure is counted and reported
+                self.errors += 1
+            self.latencies[command].append(monotonic() - planned)
+            self.messages += len(texts)
+
+
+def report(senders, elapsed):
+    "Print latency percentiles and throughput"
+    latencies = {}
+    for sender in senders:
+        for command, values in sender.latencies.items():
+            latencies.setdefault(command, []).extend(values)
+
+    print("%-10s %8s %10s %10s %10s" % ('command', 'count', 'p50', 'p99', 'max'))
+    every = []
+    for command, values in sorted(latencies.items()):
+        values.sort()
+        every.extend(values)
+        if not values:
+            continue
+        print("%-10s %8d %8.1fms %8.1fms %8.1fms" % (
+            command, len(values),
+            percentile(values, 0.5) * 1000,
+            percentile(values, 0.99) * 1000,
+            values[-1] * 1000))
+    every.sort()
+    if every:
+        print("%-10s %8d %8.1fms %8.1fms %8.1fms" % (
+            'all', len(every),
+            percentile(every, 0.5) * 1000,
+            percentile(every, 0.99) * 1000,
+            every[-1] * 1000))
+
+    messages = sum(sender.messages for sender in senders)
+    errors = sum(sender.errors for sender in senders)
+    print("Messages: %d in %.1fs (%.1f msg/s), errors: %d" % (
+        messages, elapsed, messages / elapsed, errors))
+
+
+def main():
+    "Run the load test"
+    args = parse_args()
+    try:
+        rates = parse_rates(args.rate)
+    except ValueError as ex:
+        print(ex)
+        return 2
+    if not rates:
+        print("All rates are zero")
+        return 2
+
+    bot = LoopbackBot()
+    try:
+        program = assist.setup(args, bot=bot)
+        if program is None:
+            return 4
+    except ConfigError as ex:
+        print("Error while parsing your configuration file:")
+        print(ex.args[0])
+        return 3
+
+    jids = sorted(set(sender for sender, _ in bot.dispatch_map))
+    if not jids:
+        print("No assistant channels configured")
+        return 4
+
+    seed = random.Random(args.seed)
+    start = monotonic()
+    deadline = start + args.duration
+    senders = [
+        Sender(bot, jids[i % len(jids)], rates, args.search, deadline,
+               seed.random())
+        for i in range(args.senders)
+    ]
+    for sender in senders:
+        sender.start()
+
+    # Main loop - runs commands and scheduled jobs (refreshes,
+    # notifications). Commands wake it up.
+    scheduler = program['scheduler']
+    while any(sender.is_alive() for sender in senders):
+        scheduler.run_pending()
+        scheduler.wait(0.1)
+    elapsed = monotonic() - start
+    assist.close_interfaces(program)
+
+    report(senders, elapsed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
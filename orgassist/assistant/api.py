@@ -54,6 +54,14 @@ class AssistantPlugin:
         what config keys were ignored (and are, for example, mistyped).
         """
 
+    def get_metrics(self):
+        """
+        Return a list of metric samples: (name, {label: value}, value).
+
+        Called periodically by the metrics exporter, should be cheap.
+        """
+        return []
+
 
 class CommandContext:
     """
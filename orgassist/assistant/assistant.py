@@ -18,12 +18,19 @@ class Assistant:
     #  'plugin_name': PluginClass }
     registered_plugins = {}
 
-    def __init__(self, name, config, scheduler):
-        "Initialize structures, plugins and validate configs early"
+    def __init__(self, name, config, scheduler, read_only=False):
+        """
+        Initialize structures, plugins and validate configs early.
+
+        Read-only assistants answer one-shot queries (eg. assist.py --agenda)
+        next to a running instance - plugins must not alter persistent
+        state, like the notification journal.
+        """
         # Assistant initialization
         self.assistant_name = name
         self.scheduler = scheduler
         self.config = config
+        self.read_only = read_only
 
         # Command dispatcher.
         self.command = CommandDispatch(self)
@@ -33,6 +40,10 @@ class Assistant:
                                   default='UTC', assert_type=str)
         self.time = helpers.Time(timezone)
 
+        # Timings of commands, counters and gauges set by plugins
+        self.stats = helpers.Stats()
+        self.command.register(['stats'], self.handle_stats)
+
         # Instances of plugins
         self.plugins = {}
 
@@ -44,6 +55,12 @@ class Assistant:
 
         self._initialize_plugins()
 
+        # Optionally dump statistics to the log periodically
+        stats_interval = self.config.get('stats_log_interval',
+                                         required=False, assert_type=int)
+        if stats_interval:
+            self.scheduler.every(stats_interval).seconds.do(self.log_stats)
+
     def _initialize_plugins(self):
         "Create instances of plugins"
         # {name: handler1, name2: handler1, name3: handler2, ...}
@@ -66,11 +83,31 @@ class Assistant:
         for plugin in self.plugins.values():
             plugin.initialize()
 
+    def dispatch_in_main_loop(self, command):
+        """
+        Create a bot callback which dispatches messages to a command context
+        in the main loop, between scheduled jobs - plugins are not
+        thread-safe. Raises TimeoutError if the main loop is busy.
+        """
+        def dispatch(message):
+            "Handle message in the main loop"
+            self.scheduler.call(lambda: command.dispatch(message))
+        return dispatch
+
     def register_xmpp_bot(self, bot):
         """
         Dispatch to this assistant when a JID talks to bot with given
-        resource.
+        resource. Commands are run by the main loop.
         """
+        in_main_loop = self.dispatch_in_main_loop(self.command)
+
+        def dispatch(message):
+            "Handle chat message - tell the boss if it can't be handled now"
+            try:
+                in_main_loop(message)
+            except TimeoutError:
+                message.respond(helpers.language.get('BUSY'))
+
         for channel_cfg in self.config.channels:
             jid = channel_cfg.get('jid',
                                   required=False, assert_type=str)
@@ -83,8 +120,7 @@ class Assistant:
                 continue
 
             # Incoming channel
-            bot.add_dispatch(jid, resource,
-                             self.command.dispatch)
+            bot.add_dispatch(jid, resource, dispatch)
 
             # Outgoing channel
             def create_closure(jid, resource):
@@ -100,6 +136,21 @@ class Assistant:
 
             create_closure(jid, resource)
 
+    def register_http_bot(self, bot):
+        """
+        Dispatch HTTP requests authenticated with the assistant token.
+        HTTP clients only issue commands - boss is still told via other
+        channels.
+
+        HTTP has its own context, so scripts don't interfere with a chat
+        session, and commands are run by the main loop between jobs.
+        """
+        token = self.config.get('http_token', required=False, assert_type=str)
+        if not token:
+            return
+        command = CommandDispatch(self, commands=self.command.commands)
+        bot.add_dispatch(token, self.dispatch_in_main_loop(command))
+
     def register_irc_bot(self, bot):
         "Register dispatch in an IRC bot"
         raise NotImplementedError
@@ -113,6 +164,36 @@ class Assistant:
         for channel in self.boss_channels:
             channel(message)
 
+    def get_stats(self):
+        "Gather assistant statistics and statistics of the shared scheduler"
+        lines = self.stats.report()
+        scheduler_stats = getattr(self.scheduler, 'stats', None)
+        if scheduler_stats is not None:
+            lines += scheduler_stats.report()
+        return lines
+
+    def get_metrics(self):
+        "Gather metric samples from all plugins labeled with assistant name"
+        samples = []
+        for plugin in self.plugins.values():
+            for name, labels, value in plugin.get_metrics():
+                labels = dict(labels, assistant=self.assistant_name)
+                samples.append((name, labels, value))
+        return samples
+
+    def handle_stats(self, message):
+        "Respond with command/job timings and counters"
+        lines = self.get_stats()
+        if not lines:
+            message.respond("No statistics gathered yet.")
+            return
+        message.respond("\n".join(lines))
+
+    def log_stats(self):
+        "Dump statistics to the log"
+        for line in self.get_stats():
+            log.info("Stats %s: %s", self.assistant_name, line)
+
     # Decorator to register context plugins
     @classmethod
     def plugin(cls, name):
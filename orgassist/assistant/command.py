@@ -14,15 +14,18 @@ class CommandDispatch:
     # Number of past contexts to keep.
     KEEP_CONTEXTS = 3
 
-    def __init__(self, assistant):
-        "Create variables"
+    def __init__(self, assistant, commands=None):
+        """
+        Create variables. Dispatchers of different interfaces can share
+        registered commands while keeping separate contexts.
+        """
 
         self.assistant = assistant
 
         # Commands registered by plugins for dispatching
         # {command1: callback1, command2: callback1,
         #  command3: callback2 }
-        self.commands = {}
+        self.commands = commands if commands is not None else {}
 
         # Current command context.
         self.context = None
@@ -81,7 +84,9 @@ class CommandDispatch:
             if not self.context.is_valid():
                 self.context_quit(None)
             else:
-                ret = self.context.handler(message)
+                name = 'context.' + self.context.__class__.__name__
+                with self.assistant.stats.timer(name):
+                    ret = self.context.handler(message)
                 if ret:
                     self.context_quit(None)
                 return
@@ -93,7 +98,8 @@ class CommandDispatch:
         if handler is not None:
             # Prepare a message without a command-word.
             message.strip_command(command_raw)
-            ret = handler(message)
+            with self.assistant.stats.timer('command.' + command):
+                ret = handler(message)
             if isinstance(ret, api.CommandContext):
                 self.context = ret
         else:
@@ -3,3 +3,5 @@ log = logging.getLogger('orgassist.xmpp-bot')
 
 from .api import Message
 from .xmpp_bot import XmppBot
+from .loopback_bot import LoopbackBot
+from .http_bot import HttpBot
@@ -0,0 +1,222 @@
+"""
+Local HTTP/JSON command interface for scripts.
+
+    POST /command
+    Authorization: Bearer <assistant http_token>
+    {"text": "note Buy milk"}
+
+    -> {"responses": ["Got it!"]}
+
+Listens on a loopback address or on a Unix socket. Connections are kept
+alive (HTTP/1.1) and each one is served in its own thread.
+"""
+
+import os
+import json
+import errno
+import hmac
+import threading
+import ipaddress
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from orgassist.config import ConfigError
+from orgassist.helpers.sockets import SocketInUse, remove_stale_socket
+from . import Message
+from . import log
+
+# Maximal accepted request body
+MAX_BODY = 64 * 1024
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    "Threaded HTTP server on a Unix socket"
+    daemon_threads = True
+
+    def server_bind(self):
+        "Remove a stale socket and allow access only to the owner"
+        remove_stale_socket(self.server_address)
+        super().server_bind()
+        os.chmod(self.server_address, 0o600)
+
+
+class CommandHandler(BaseHTTPRequestHandler):
+    "Handle JSON command requests"
+    protocol_version = 'HTTP/1.1'
+
+    # Idle keep-alive connections are closed after this many seconds
+    timeout = 60
+
+    def address_string(self):
+        "Unix socket clients have no address"
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        log.debug("HTTP %s: %s", self.address_string(), format % args)
+
+    def send_json(self, status, data):
+        "Send a JSON response keeping the connection open"
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        "Dispatch a command to the assistant identified by the token"
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            self.close_connection = True
+            self.send_json(413, {'error': 'Request too large'})
+            return
+        body = self.rfile.read(length)
+
+        if self.path != '/command':
+            self.send_json(404, {'error': 'Unknown path'})
+            return
+
+        bot = self.server.bot
+        scheme, _, token = self.headers.get('Authorization', '').partition(' ')
+        if scheme != 'Bearer':
+            token = ''
+        dispatch = bot.find_dispatch(token)
+        if dispatch is None:
+            self.send_json(401, {'error': 'Invalid token'})
+            return
+
+        try:
+            request = json.loads(body.decode('utf-8'))
+            text = request['text']
+            if not isinstance(text, str) or not text.strip():
+                raise ValueError("Empty text")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_json(400, {'error': 'Expected JSON: {"text": "command"}'})
+            return
+
+        try:
+            responses = bot.dispatch(dispatch, text)
+        except TimeoutError:
+            self.send_json(503, {'error': 'Assistant is busy'})
+            return
+        except Exception:
+            log.exception("HTTP command %r failed", text)
+            self.send_json(500, {'error': 'Command failed'})
+            return
+        self.send_json(200, {'responses': responses})
+
+
+class HttpBot:
+    """
+    Serve commands over a local HTTP endpoint. Assistants register with
+    their tokens; commands of a single assistant are dispatched one at a
+    time.
+    """
+    def __init__(self, config):
+        "Read config - the socket is bound when started"
+        # token -> (callback, lock)
+        self.dispatch_map = {}
+
+        # Message counters for metrics
+        self.messages_in = 0
+        self.messages_out = 0
+        self._counter_lock = threading.Lock()
+
+        self.socket_path = config.get_path('socket', required=False)
+        if self.socket_path is not None:
+            self.server = UnixHTTPServer(self.socket_path, CommandHandler,
+                                         bind_and_activate=False)
+        else:
+            host = config.get('host', default='127.0.0.1', assert_type=str)
+            port = config.get('port', default=8765, assert_type=int)
+            if not self.is_loopback(host):
+                raise ConfigError("HTTP interface can listen only on a "
+                                  "loopback address, not '%s'" % host)
+            self.server = ThreadingHTTPServer((host, port), CommandHandler,
+                                              bind_and_activate=False)
+        self.server.bot = self
+        self.bound = False
+        self.thread = None
+
+    @staticmethod
+    def is_loopback(host):
+        "Is the host a loopback address?"
+        if host == 'localhost':
+            return True
+        try:
+            return ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            return False
+
+    @property
+    def address(self):
+        "Bound (host, port) or a socket path"
+        return self.server.server_address
+
+    def add_dispatch(self, token, callback):
+        "Register callback to handle commands authenticated by a token"
+        if not token:
+            raise ConfigError("HTTP token can't be empty")
+        if token in self.dispatch_map:
+            raise ConfigError("HTTP token duplicated")
+        self.dispatch_map[token] = (callback, threading.Lock())
+
+    def find_dispatch(self, token):
+        "Find (callback, lock) of a token comparing in constant time"
+        found = None
+        for known, dispatch in self.dispatch_map.items():
+            if hmac.compare_digest(known.encode('utf-8'), token.encode('utf-8')):
+                found = dispatch
+        return found
+
+    def dispatch(self, dispatch, text):
+        "Dispatch a command and collect responses"
+        callback, lock = dispatch
+        responses = []
+        message = Message(text, 'http', responses.append)
+        with lock:
+            callback(message)
+            message.finish()
+        with self._counter_lock:
+            self.messages_in += 1
+            self.messages_out += len(responses)
+        return responses
+
+    def start(self):
+        """
+        Bind the socket and serve requests in a background thread. Raise
+        SocketInUse if other process listens on the address.
+        """
+        try:
+            self.server.server_bind()
+        except OSError as ex:
+            if ex.errno != errno.EADDRINUSE:
+                raise
+            raise SocketInUse("HTTP address %s is in use - is orgassist "
+                              "already running?" % (self.address,))
+        self.bound = True
+        self.server.server_activate()
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='http-bot', daemon=True)
+        self.thread.start()
+        log.info("HTTP interface listening on %s", self.address)
+
+    def get_metrics(self):
+        "Message counters"
+        return [
+            ('orgassist_http_messages_received_total', {}, self.messages_in),
+            ('orgassist_http_messages_sent_total', {}, self.messages_out),
+        ]
+
+    def close(self):
+        "Stop serving and close the socket"
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread = None
+        self.server.server_close()
+        if (self.bound and self.socket_path is not None and
+                os.path.exists(self.socket_path)):
+            os.unlink(self.socket_path)
+        self.bound = False
@@ -0,0 +1,105 @@
+"""
+In-process bot - delivers messages to assistants without a chat server.
+
+Used for end-to-end tests and load generation: conforms to the interface
+assistants use with XmppBot (add_dispatch, send_message) and calls
+dispatch callbacks synchronously in the thread of the caller. Assistants
+run the commands in the main loop, which has to be running.
+"""
+
+import threading
+from collections import defaultdict
+
+from orgassist.helpers import language
+from . import Message
+from . import log
+
+
+class LoopbackBot:
+    """
+    Dispatch messages in process. Responses are returned from `deliver';
+    messages initiated by assistants (notifications, agendas) are kept in
+    per-JID outboxes.
+    """
+    def __init__(self, jid='assistant@loopback'):
+        # (Sender JID, [local resource]) -> (callback, lock)
+        self.dispatch_map = {}
+
+        # Messages of a single delivery to an assistant are not interleaved
+        # with other deliveries to it (eg. entering and quitting a context).
+        # Different assistants are delivered to concurrently.
+        # Assistant (owner of a callback) -> lock
+        self.locks = {}
+
+        # Messages sent by assistants: JID -> [text]
+        self.outbox = defaultdict(list)
+
+        # Message counters for metrics
+        self.messages_in = 0
+        self.messages_out = 0
+        # Guards outboxes and counters
+        self._lock = threading.Lock()
+
+        self.jid = jid
+
+    def add_dispatch(self, sender_jid, resource, callback):
+        """
+        Register callback to handle incoming messages from sender_jid
+        directed to a given resource (can be None to mean "any").
+        """
+        key = (sender_jid, resource)
+        if key in self.dispatch_map:
+            raise Exception("Sender JID duplicated: %s" % sender_jid)
+        # Channels of one assistant share its lock
+        owner = getattr(callback, '__self__', callback)
+        lock = self.locks.setdefault(owner, threading.Lock())
+        self.dispatch_map[key] = (callback, lock)
+
+    def deliver(self, sender, *texts, resource=None):
+        """
+        Deliver messages from sender (bare JID) and return responses.
+
+        Multiple texts are dispatched without interleaving with other
+        senders of the same assistant, eg. ('s meeting', '.') to enter and
+        quit a context.
+        """
+        responses = []
+        dispatch = self.dispatch_map.get((sender, resource), None)
+        if dispatch is None:
+            dispatch = self.dispatch_map.get((sender, None), None)
+
+        if dispatch is None:
+            responses = [language.get('DONT_KNOW')] * len(texts)
+        else:
+            callback, lock = dispatch
+            with lock:
+                for text in texts:
+                    log.debug("Loopback message from %s: %r", sender, text)
+                    message = Message(text, sender, responses.append)
+                    callback(message)
+                    message.finish()
+        with self._lock:
+            self.messages_in += len(texts)
+            self.messages_out += len(responses)
+        return responses
+
+    def send_message(self, jid, message):
+        "Send a message - store it in an outbox"
+        with self._lock:
+            self.messages_out += 1
+            self.outbox[jid].append(message)
+
+    def pop_outbox(self, jid):
+        "Return and forget messages sent to JID"
+        with self._lock:
+            return self.outbox.pop(jid, [])
+
+    def get_metrics(self):
+        "Message counters"
+        return [
+            ('orgassist_loopback_messages_received_total', {}, self.messages_in),
+            ('orgassist_loopback_messages_sent_total', {}, self.messages_out),
+        ]
+
+    def close(self):
+        "Nothing to disconnect"
@@ -0,0 +1,328 @@
+import os
+import json
+import socket
+import tempfile
+import threading
+import unittest
+import http.client
+import datetime as dt
+
+from orgassist.config import Config, ConfigError
+from orgassist.assistant import Assistant
+from orgassist.helpers import Scheduler
+from orgassist.control import ControlServer, register_commands
+from orgassist.helpers.sockets import SocketInUse
+import orgassist.plugins
+
+from .loopback_bot import LoopbackBot
+from .http_bot import HttpBot
+
+
+class TestLoopback(unittest.TestCase):
+    "Test in-process message delivery"
+
+    def setUp(self):
+        config = Config.from_dict({
+            'timezone': 'UTC',
+            'channels': [
+                {'jid': 'boss@example.com'},
+                {'jid': 'boss@example.com', 'resource': 'phone'},
+            ],
+            'plugins': {
+                'calendar': {},
+            },
+        })
+        self.bot = LoopbackBot()
+        self.scheduler = Scheduler()
+        self.assistant = Assistant('test', config, self.scheduler)
+        self.assistant.register_xmpp_bot(self.bot)
+        self.loop = start_main_loop(self, self.scheduler)
+
+    def test_dispatch(self):
+        "Commands are dispatched to the assistant of the sender"
+        responses = self.bot.deliver('boss@example.com', 'stats')
+        self.assertEqual(len(responses), 1)
+
+        responses = self.bot.deliver('boss@example.com', 'nonsense')
+        self.assertEqual(len(responses), 1)
+
+        # Unknown senders get no access to the assistant
+        responses = self.bot.deliver('stranger@example.com', 'stats')
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(self.assistant.stats.histograms['command.stats'].count, 1)
+
+        # Context is entered and quit within a single delivery
+        responses = self.bot.deliver('boss@example.com', 's meeting', '.')
+        self.assertEqual(len(responses), 2)
+        self.assertIsNone(self.assistant.command.context)
+
+        self.assertEqual(self.bot.messages_in, 5)
+
+    def test_main_loop(self):
+        "Commands run in the main loop, deliveries are locked per assistant"
+        config = Config.from_dict({
+            'timezone': 'UTC',
+            'channels': [
+                {'jid': 'other@example.com'},
+            ],
+            'plugins': {},
+        })
+        other = Assistant('other', config, self.scheduler)
+        other.register_xmpp_bot(self.bot)
+
+        threads = []
+        self.assistant.command.register('where', lambda message: threads.append(
+            threading.current_thread()))
+        self.bot.deliver('boss@example.com', 'where')
+        self.assertEqual(threads, [self.loop])
+
+        # Channels of an assistant share its lock
+        self.assertIs(self.bot.dispatch_map[('boss@example.com', None)][1],
+                      self.bot.dispatch_map[('boss@example.com', 'phone')][1])
+        self.assertIsNot(self.bot.dispatch_map[('boss@example.com', None)][1],
+                         self.bot.dispatch_map[('other@example.com', None)][1])
+        self.assertEqual(len(self.bot.locks), 2)
+
+    def test_outbox(self):
+        "Messages initiated by the assistant are kept in outboxes"
+        self.assistant.tell_boss("Hello")
+        self.assertEqual(self.bot.pop_outbox('boss@example.com'), ["Hello"])
+        self.assertEqual(self.bot.pop_outbox('boss@example.com'), [])
+
+
+def start_main_loop(test, scheduler):
+    "Run scheduler jobs in a thread until the test ends"
+    stop = threading.Event()
+    def main_loop():
+        while not stop.is_set():
+            scheduler.run_pending()
+            scheduler.wait(0.1)
+    loop = threading.Thread(target=main_loop, daemon=True)
+    loop.start()
+    test.addCleanup(loop.join)
+    test.addCleanup(stop.set)
+    return loop
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    "HTTP connection over a Unix socket"
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class TestHttp(unittest.TestCase):
+    "Test local HTTP command interface"
+
+    def start(self, **config):
+        "Start a bot with an echoing assistant"
+        bot = HttpBot(Config.from_dict(config))
+        def echo(message):
+            message.respond(message.text)
+            message.respond(message.sender)
+        bot.add_dispatch('secret', echo)
+        bot.start()
+        self.addCleanup(bot.close)
+        return bot
+
+    def post(self, connection, body, token='secret'):
+        "Send a command and return status and decoded response"
+        headers = {'Authorization': 'Bearer ' + token,
+                   'Content-Type': 'application/json'}
+        connection.request('POST', '/command', body=json.dumps(body),
+                           headers=headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def test_tcp(self):
+        "Commands over a kept-alive TCP connection"
+        bot = self.start(host='127.0.0.1', port=0)
+        host, port = bot.address
+        connection = http.client.HTTPConnection(host, port)
+        self.addCleanup(connection.close)
+
+        status, data = self.post(connection, {'text': 'ag'})
+        self.assertEqual(status, 200)
+        self.assertEqual(data, {'responses': ['ag', 'http']})
+        sock = connection.sock
+
+        status, _ = self.post(connection, {'text': 'ag'}, token='wrong')
+        self.assertEqual(status, 401)
+        status, _ = self.post(connection, {'txt': 'ag'})
+        self.assertEqual(status, 400)
+
+        # Still the same connection
+        self.assertIs(connection.sock, sock)
+        self.assertEqual(bot.messages_in, 1)
+
+    def test_unix(self):
+        "Commands over a Unix socket"
+        path = os.path.join(tempfile.mkdtemp(), 'orgassist.sock')
+        bot = self.start(socket=path)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        connection = UnixHTTPConnection(path)
+        self.addCleanup(connection.close)
+        status, data = self.post(connection, {'text': 'note milk'})
+        self.assertEqual(status, 200)
+        self.assertEqual(data['responses'][0], 'note milk')
+
+    def test_running(self):
+        "Address of a running bot is not taken over"
+        bot = self.start(host='127.0.0.1', port=0)
+        host, port = bot.address
+        second = HttpBot(Config.from_dict({'host': host, 'port': port}))
+        self.assertRaises(SocketInUse, second.start)
+        second.close()
+
+        path = os.path.join(tempfile.mkdtemp(), 'orgassist.sock')
+        bot = self.start(socket=path)
+        second = HttpBot(Config.from_dict({'socket': path}))
+        self.assertRaises(SocketInUse, second.start)
+        second.close()
+        connection = UnixHTTPConnection(path)
+        self.addCleanup(connection.close)
+        status, _ = self.post(connection, {'text': 'ag'})
+        self.assertEqual(status, 200)
+
+    def test_assistant(self):
+        "Assistant has a separate context and runs commands in the main loop"
+        config = Config.from_dict({
+            'timezone': 'UTC',
+            'http_token': 'secret',
+            'channels': [
+                {'jid': 'boss@example.com'},
+            ],
+            'plugins': {
+                'calendar': {},
+            },
+        })
+        scheduler = Scheduler()
+        assistant = Assistant('test', config, scheduler)
+        loopback = LoopbackBot()
+        assistant.register_xmpp_bot(loopback)
+        bot = HttpBot(Config.from_dict({'host': '127.0.0.1', 'port': 0}))
+        assistant.register_http_bot(bot)
+        bot.start()
+        self.addCleanup(bot.close)
+
+        threads = []
+        assistant.command.register('where', lambda message: threads.append(
+            threading.current_thread()))
+        loop = start_main_loop(self, scheduler)
+
+        # Chat user is within a search context
+        loopback.deliver('boss@example.com', 's meeting')
+        context = assistant.command.context
+        self.assertIsNotNone(context)
+
+        connection = http.client.HTTPConnection(*bot.address)
+        self.addCleanup(connection.close)
+        status, data = self.post(connection, {'text': 'where'})
+        self.assertEqual(status, 200)
+        self.assertEqual(threads, [loop])
+        self.assertIs(assistant.command.context, context)
+
+        # HTTP search context doesn't take over the chat one
+        self.post(connection, {'text': 's other'})
+        self.assertIs(assistant.command.context, context)
+
+    def test_loopback_only(self):
+        "Refuse to listen on public addresses"
+        with self.assertRaises(ConfigError):
+            HttpBot(Config.from_dict({'host': '0.0.0.0', 'port': 0}))
+
+
+class TestControl(unittest.TestCase):
+    "Test control socket protocol and commands"
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.org_path = os.path.join(directory, 'calendar.org')
+        self.now = dt.datetime.now(dt.timezone.utc)
+        self.write_org(('Meeting', 120))
+        config = Config.from_dict({
+            'timezone': 'UTC',
+            'channels': [
+                {'jid': 'boss@example.com'},
+            ],
+            'plugins': {
+                'calendar': {'status_format': '{next}'},
+                'org': {
+                    'directory': directory,
+                    'scan_interval_s': 3600,
+                    'note': {'inbox': os.path.join(directory, 'inbox.txt')},
+                },
+            },
+        })
+        scheduler = Scheduler()
+        self.assistant = Assistant('test', config, scheduler)
+        self.assistant.register_xmpp_bot(LoopbackBot())
+        start_main_loop(self, scheduler)
+
+        self.path = os.path.join(directory, 'orgassist.ctl')
+        control = ControlServer(self.path)
+        register_commands(control, [self.assistant], scheduler)
+        control.start()
+        self.addCleanup(control.close)
+
+    def write_org(self, *appointments):
+        "Write appointments (headline, minutes from now) into the org file"
+        with open(self.org_path, 'w') as handler:
+            for headline, minutes in appointments:
+                date = self.now + dt.timedelta(minutes=minutes)
+                handler.write("* %s\n  <%s>\n" % (
+                    headline, date.strftime('%Y-%m-%d %a %H:%M')))
+
+    def request(self, *lines):
+        "Send request lines over a single connection and read responses"
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.path)
+            with sock.makefile('rwb') as stream:
+                responses = []
+                for line in lines:
+                    stream.write(line.encode('utf-8') + b'\n')
+                    stream.flush()
+                    responses.append(stream.readline().decode('utf-8'))
+        return responses
+
+    def test_protocol(self):
+        "Each request line gets a single response line"
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        status, unknown, assistant = self.request('status', 'nonsense',
+                                                  'status other')
+        self.assertTrue(status.endswith(' Meeting\n'))
+        self.assertEqual(unknown, "ERR unknown command 'nonsense'\n")
+        self.assertEqual(assistant, "ERR unknown assistant 'other'\n")
+
+    def test_reparse(self):
+        "Saved files are parsed in the main loop and reflected in status"
+        self.write_org(('Meeting', 120), ('Call', 60))
+        usage, other, reparse, status = self.request(
+            'reparse', 'reparse /nonexistent/notes.org',
+            'reparse ' + self.org_path, 'status')
+        self.assertEqual(usage, "ERR usage: reparse <path>\n")
+        self.assertTrue(other.startswith('ERR not an org file'))
+        self.assertEqual(reparse, "OK\n")
+        self.assertTrue(status.endswith(' Call\n'))
+
+    def test_running(self):
+        "Socket of a running server is not taken over, a stale one is"
+        second = ControlServer(self.path)
+        self.assertRaises(SocketInUse, second.start)
+        second.close()
+        status, = self.request('status')
+        self.assertTrue(status.endswith(' Meeting\n'))
+
+        # Left by a crashed process
+        stale_path = self.path + '.stale'
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(stale_path)
+        stale.close()
+        control = ControlServer(stale_path)
+        control.start()
+        control.close()
+        self.assertFalse(os.path.exists(stale_path))
@@ -14,6 +14,10 @@ class XmppBot:
         # (Sender JID, [local resource]) -> callback
         self.dispatch_map = {}
 
+        # Message counters for metrics
+        self.messages_in = 0
+        self.messages_out = 0
+
         self.jid = connect_cfg.jid
         self.connect(connect_cfg)
 
@@ -67,6 +71,7 @@ class XmppBot:
         if msg['type'] not in ('chat', 'normal'):
             log.warning('Unknown message type: %r %r', msg, msg['type'])
             return
+        self.messages_in += 1
 
         to_jid = msg.get_to()
         from_jid = msg.get_from()
@@ -98,8 +103,17 @@ class XmppBot:
 
     def send_message(self, jid, message):
         "Send a message"
+        self.messages_out += 1
         self.client.send_message(jid, message)
 
+    def get_metrics(self):
+        "Message counters and outbound queue depth"
+        return [
+            ('orgassist_xmpp_messages_received_total', {}, self.messages_in),
+            ('orgassist_xmpp_messages_sent_total', {}, self.messages_out),
+            ('orgassist_xmpp_send_queue', {}, self.client.send_queue.qsize()),
+        ]
+
     def close(self):
         "Disconnect / close threads"
         self.client.abort()
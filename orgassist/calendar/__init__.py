@@ -1,4 +1,5 @@
-from .event_date import EventDate, DateType
+from .event_date import EventDate, DateType, Repeater
 from .event import Event, EventState
 from .calendar import Calendar
 
+from .query import Query, QueryError
@@ -2,32 +2,120 @@
 Org-mode compatible calendar implementation - handles a number of events in
 time.
 """
+import os
+import heapq
 import datetime as dt
+from bisect import bisect_left, bisect_right
 
 
 from orgassist import log
 from orgassist.calendar import DateType
 from orgassist import helpers
 
+from . import columnar
+from .tag_index import TagIndex
+from .dedup import FingerprintIndex
+from .trace import QueryTracer
+
 class Calendar:
     """
     Manages multiple events, generates agenda
     """
-    def __init__(self, agenda_path=None, agenda_content=None):
-        "Initialize calendar"
+    # Number of rendered agendas to keep
+    AGENDA_CACHE_SIZE = 16
+
+    def __init__(self, agenda_path=None, agenda_content=None, use_columnar=False,
+                 dedup=True, dedup_prefer=None, cold_days=None):
+        """
+        Initialize calendar
+
+        use_columnar enables a NumPy index which speeds up queries on large
+        calendars (requires the optional numpy module).
+
+        dedup merges the same appointment read from different sources;
+        dedup_prefer lists internal tags of sources whose copy is kept.
 
-        # Events sorted by sort_date
+        cold_days enables tiering: closed events older than this number of
+        days (see demote) are moved out of self.events into a cold tier
+        read only by queries reaching into the past.
+        """
+
+        # Hot tier: events sorted by sort_date
         self.events = []
 
+        # Cold tier: old closed events sorted by sort_date, their timestamps
+        # and state name -> events (built lazily). Events older than the
+        # cutoff are placed here when added.
+        self.cold_days = cold_days
+        self.cold = []
+        self.cold_cutoff = None
+        self._cold_stamps = None
+        self._cold_states = None
+
+        # Subset of events with cyclic dates - expanded lazily in queries.
+        self.repeating = []
+
+        # Columnar index, rebuilt lazily after changes.
+        if use_columnar and not columnar.is_available():
+            raise ImportError("Columnar calendar requires the numpy module")
+        self.use_columnar = use_columnar
+        self._index = None
+
+        # Tag posting lists, updated incrementally per source.
+        self.tag_index = TagIndex()
+
+        # Fingerprints of appointments of all sources and duplicates hidden
+        # from self.events
+        self._fingerprints = FingerprintIndex() if dedup else None
+        self.dedup_prefer = list(dedup_prefer or [])
+        self.hidden = []
+
+        # Bookkeeping is kept here, not in the event meta - events of a
+        # shared source are added to calendars of multiple assistants.
+        # id(event) -> internal tag of its source
+        self._sources = {}
+        # id(hidden duplicate) -> kept event
+        self._kept = {}
+
+        # Timestamps of sorted events and state name -> events, built lazily
+        self._stamps = None
+        self._states = None
+
+        # Incremented on each change of events
+        self.version = 0
+
+        # Called with lists of added and removed events after each change
+        # (update_events notifies once). Duplicates hidden by a preferred
+        # copy are reported as removed, shown again ones as added.
+        self.listeners = []
+
+        # Sampled tracing of queries, disabled by default
+        self.tracer = QueryTracer()
+
+        # Rendered agendas: (version, minute, horizons, template mtime) ->
+        # (text, listed unfinished events)
+        self._agenda_cache = {}
+        # (mtime, template)
+        self._template = None
+
         # Path to agenda
         self.agenda_path = agenda_path
         self.agenda_content = agenda_content
         assert self.agenda_content != self.agenda_path
 
     def add_events(self, events, internal_tag=None):
-        "Add new events to the calendar"
+        """
+        Add new events to the calendar. Visible events hidden as duplicates
+        of the new ones are reported to listeners as removed.
+        """
+        replaced = self._add(events, internal_tag)
+        self._changed(added=events, removed=replaced)
+
+    def _add(self, events, internal_tag):
+        "Insert events of a source and return replaced duplicates"
         for event in events:
-            event.meta['calendar_tag'] = internal_tag
+            self._sources[id(event)] = internal_tag
+            self._kept.pop(id(event), None)
 
             # Check: sort_dates can't be naive
             if event.relevant_date is not None:
@@ -35,27 +123,428 @@ class Calendar:
                 if isinstance(date, dt.datetime):
                     if date.tzinfo is None:
                         raise Exception("Trying to add a naive datetime - use time.localize")
-        self.events += events
-        self.events.sort()
+        return self._insert(events)
 
     def del_events(self, internal_tag=None):
         "Delete events by internal tag"
         if internal_tag is None:
+            removed = self.events + self.cold + self.hidden
             self.events = []
+            self.cold = []
+            self.repeating = []
+            self.hidden = []
+            self._sources = {}
+            self._kept = {}
+            if self._fingerprints is not None:
+                self._fingerprints = FingerprintIndex()
+            self.tag_index.remove(internal_tag)
+            self._changed(removed=removed)
+            return
+
+        removed = [
+            event
+            for event in self.events + self.cold + self.hidden
+            if self.source_of(event) == internal_tag
+        ]
+        shown = self._remove(removed)
+        self.tag_index.remove(internal_tag)
+        self._changed(added=shown, removed=removed)
+
+    def _remove(self, removed):
+        """
+        Remove given events from the sorted lists and indices. Return hidden
+        duplicates shown again in place of removed events.
+        """
+        removed_ids = set(id(event) for event in removed)
+
+        def is_removed(event):
+            return id(event) in removed_ids
+
+        self.events = [
+            event
+            for event in self.events
+            if not is_removed(event)
+        ]
+        self.cold = [
+            event
+            for event in self.cold
+            if not is_removed(event)
+        ]
+        self.repeating = [
+            event
+            for event in self.repeating
+            if not is_removed(event)
+        ]
+        self._discard_tagged(removed)
+
+        if self._fingerprints is not None:
+            self._fingerprints.remove(removed)
+            # Duplicates kept in favour of removed events are shown again
+            orphans = [
+                event for event in self.hidden
+                if not is_removed(event) and is_removed(self.duplicate_of(event))
+            ]
+            self.hidden = [
+                event for event in self.hidden
+                if not is_removed(event) and not is_removed(self.duplicate_of(event))
+            ]
+            for event in removed + orphans:
+                self._kept.pop(id(event), None)
+            self._insert(orphans, indexed=True)
         else:
+            orphans = []
+
+        for event in removed:
+            self._sources.pop(id(event), None)
+        return orphans
+
+    def source_of(self, event):
+        "Internal tag of the source an event (or its occurrence) was added by"
+        return self._sources.get(id(event.occurrence_of or event))
+
+    def duplicate_of(self, event):
+        "Event kept in place of a hidden duplicate or None"
+        return self._kept.get(id(event))
+
+    def _discard_tagged(self, events):
+        "Remove events from tag postings of their sources"
+        by_source = {}
+        for event in events:
+            by_source.setdefault(self.source_of(event), []).append(event)
+        for internal_tag, tagged in by_source.items():
+            self.tag_index.discard(tagged, internal_tag)
+
+    def _source_rank(self, event):
+        "Lower rank wins when merging duplicates"
+        tag = self.source_of(event)
+        if tag in self.dedup_prefer:
+            return self.dedup_prefer.index(tag)
+        return len(self.dedup_prefer)
+
+    def _merge_duplicate(self, event):
+        """
+        Find a visible duplicate of an event from other source and hide the
+        less preferred one (existing on a tie). Return the hidden event.
+        """
+        duplicate = self._fingerprints.find(event, self.source_of(event),
+                                            self._kept)
+        if duplicate is None:
+            return None
+        if self._source_rank(event) < self._source_rank(duplicate):
+            kept, hidden = event, duplicate
+        else:
+            kept, hidden = duplicate, event
+        self._kept[id(hidden)] = kept
+        self.hidden.append(hidden)
+        log.debug("Merged duplicate %r into %r", hidden, kept)
+        return hidden
+
+    def _insert(self, events, indexed=False):
+        """
+        Insert events into the sorted list and indices. Duplicates are merged
+        at insert time, so queries don't need to deduplicate. Return events
+        which were visible and got hidden by a preferred copy.
+        """
+        hidden = []
+        if self._fingerprints is not None:
+            for event in events:
+                duplicate = self._merge_duplicate(event)
+                if duplicate is not None:
+                    hidden.append(duplicate)
+                if not indexed:
+                    self._fingerprints.add(event, self.source_of(event))
+
+        # Existing events replaced by a preferred copy
+        inserted = set(id(event) for event in events)
+        replaced = [event for event in hidden if id(event) not in inserted]
+        if replaced:
+            replaced_ids = set(id(event) for event in replaced)
             self.events = [
-                event
-                for event in self.events
-                if event.meta['calendar_tag'] != internal_tag
+                event for event in self.events
+                if id(event) not in replaced_ids
+            ]
+            self.cold = [
+                event for event in self.cold
+                if id(event) not in replaced_ids
+            ]
+            self._discard_tagged(replaced)
+
+        visible = [
+            event for event in events
+            if id(event) not in self._kept
+        ]
+        cold = [event for event in visible if self.is_cold(event)]
+        if cold:
+            cold_ids = set(id(event) for event in cold)
+            self.cold += cold
+            self.cold.sort()
+            self.events += [
+                event for event in visible if id(event) not in cold_ids
+            ]
+        else:
+            self.events += visible
+        self.events.sort()
+        self.repeating = [event for event in self.events if event.repeating]
+
+        by_source = {}
+        for event in visible:
+            by_source.setdefault(self.source_of(event), []).append(event)
+        for internal_tag, tagged in by_source.items():
+            self.tag_index.add(tagged, internal_tag)
+        return replaced
+
+    def _changed(self, added=(), removed=()):
+        "Bump version and invalidate structures derived from events"
+        self._invalidate()
+        self._notify(added, removed)
+
+    def _invalidate(self):
+        "Bump version and forget structures derived from tiers"
+        self.version += 1
+        self._index = None
+        self._stamps = None
+        self._states = None
+        self._cold_stamps = None
+        self._cold_states = None
+        self._agenda_cache.clear()
+
+    def is_cold(self, event):
+        "Does the event belong to the cold tier?"
+        if self.cold_cutoff is None or event.relevant_date is None:
+            return False
+        if event.state is not None and event.state.is_open:
+            return False
+        if event.repeating:
+            return False
+        return event.relevant_date.sort_date < self.cold_cutoff
+
+    def demote(self, relative_to):
+        """
+        Move the cutoff of the cold tier to cold_days before relative_to and
+        move events which got old into the cold tier. Only hot events older
+        than the cutoff are checked - the rest of the calendar is untouched.
+        Return the number of demoted events.
+        """
+        if self.cold_days is None:
+            return 0
+        cutoff = relative_to - dt.timedelta(days=self.cold_days)
+        if self.cold_cutoff is not None and cutoff <= self.cold_cutoff:
+            return 0
+        self.cold_cutoff = cutoff
+
+        high = bisect_left(self._get_stamps(), cutoff.timestamp())
+        demoted = [event for event in self.events[:high] if self.is_cold(event)]
+        if not demoted:
+            return 0
+        demoted_ids = set(id(event) for event in demoted)
+        self.events = [
+            event for event in self.events if id(event) not in demoted_ids
+        ]
+        self.cold = list(heapq.merge(self.cold, demoted))
+        # The set of events is the same - listeners are not notified
+        self._invalidate()
+        log.info("Demoted %d events older than %s to the cold tier",
+                 len(demoted), cutoff)
+        return len(demoted)
+
+    def get_all(self):
+        "Events of both tiers sorted by date"
+        if not self.cold:
+            return list(self.events)
+        return list(heapq.merge(self.cold, self.events))
+
+    def get_cold(self, since=None, until=None):
+        "Cold events within a window (None - unbounded) sorted by date"
+        if self._cold_stamps is None:
+            self._cold_stamps = [
+                event.relevant_date.sort_date.timestamp()
+                for event in self.cold
             ]
+        low = 0 if since is None else bisect_left(self._cold_stamps,
+                                                  since.timestamp())
+        high = (len(self.cold) if until is None
+                else bisect_right(self._cold_stamps, until.timestamp()))
+        return self.cold[low:high]
+
+    def _notify(self, added, removed):
+        "Call listeners after a change of events"
+        for listener in self.listeners:
+            listener(added, removed)
+
+    def _get_index(self):
+        "Return a columnar index if enabled - build it when needed"
+        if not self.use_columnar:
+            return None
+        if self._index is None:
+            self._index = columnar.ColumnarIndex(self.events, self.source_of)
+        return self._index
 
     def update_events(self, events, internal_tag):
         """
-        Replace tagged events and send notifications on new events.
+        Replace tagged events. Events are compared by identity - unchanged
+        ones stay in place, so a source which reuses objects of unchanged
+        events (eg. org files which were not parsed again) causes only a
+        small change. Listeners are notified once with the difference.
+        """
+        current = [
+            event
+            for event in self.events + self.cold + self.hidden
+            if self.source_of(event) == internal_tag
+        ]
+        new_ids = set(id(event) for event in events)
+        current_ids = set(id(event) for event in current)
+        removed = [event for event in current if id(event) not in new_ids]
+        added = [event for event in events if id(event) not in current_ids]
+        if not added and not removed:
+            return
+
+        shown = self._remove(removed)
+        replaced = self._add(added, internal_tag)
+        self._changed(added=added + shown, removed=removed + replaced)
+
+    def _expand_repeating(self, since, until, appointments_only=True,
+                          events=None):
+        """
+        Return occurrences of cyclic events which fall into a given window.
+
+        Occurrences are generated lazily, so a daily habit costs only as many
+        objects as there are days within the window.
+        """
+        occurrences = []
+        for event in self.repeating if events is None else events:
+            for event_date in event.dates:
+                if appointments_only and not event_date.appointment:
+                    continue
+                for occurrence in event_date.occurrences(since, until):
+                    occurrences.append(event.occurrence(occurrence))
+        return occurrences
+
+    def get_tagged(self, tags, since=None, until=None):
+        """
+        Get events having all given tags (including inherited ones, case
+        insensitive) within an optional date window, sorted by date.
+
+        Cyclic events are expanded into occurrences if the window is given.
+        """
+        tagged, repeating = self.tag_index.query(tags, since, until)
+        if repeating:
+            if since is not None and until is not None:
+                repeating = self._expand_repeating(since, until,
+                                                   appointments_only=False,
+                                                   events=repeating)
+            tagged += repeating
+            tagged.sort()
+        return tagged
+
+    def get_between(self, since=None, until=None):
+        """
+        Get events with relevant date within a window (None - unbounded),
+        sorted by date. Date-less events are skipped.
+
+        Cyclic events are expanded in bounded windows, otherwise only their
+        nearest occurrence is included.
         """
-        # TODO: Detect and send notifications
-        self.del_events(internal_tag)
-        self.add_events(events, internal_tag)
+        stamps = self._get_stamps()
+        low = 0 if since is None else bisect_left(stamps, since.timestamp())
+        high = (bisect_left(stamps, float('inf')) if until is None
+                else bisect_right(stamps, until.timestamp()))
+        events = [
+            event for event in self.events[low:high]
+            if not event.repeating
+        ]
+        if self.cold and (since is None or since < self.cold_cutoff):
+            events += self.get_cold(since, until)
+
+        events += self.resolve_repeating(self.repeating, since, until)
+        events.sort()
+        return events
+
+    def resolve_repeating(self, events, since=None, until=None):
+        """
+        Replace cyclic events with occurrences relevant to a window (None -
+        unbounded), other events are kept. Queries resolve candidates of
+        every index the same way:
+
+        - bounded window: all occurrences within it,
+        - open end: the nearest occurrence since the start,
+        - open start: the event itself if it starts before the end,
+        - unbounded: the event itself.
+        """
+        resolved = []
+        for event in events:
+            if not event.repeating or event.occurrence_of is not None:
+                resolved.append(event)
+            elif since is not None and until is not None:
+                resolved += self._expand_repeating(since, until,
+                                                   appointments_only=False,
+                                                   events=[event])
+            elif since is not None:
+                dates = [date.next_occurrence(since) for date in event.dates]
+                dates = [date for date in dates if date is not None]
+                if dates:
+                    resolved.append(event.occurrence(min(dates)))
+            elif until is None or event.relevant_date.sort_date <= until:
+                resolved.append(event)
+        return resolved
+
+    def _get_stamps(self):
+        "Return timestamps of hot events - build them when needed"
+        if self._stamps is None:
+            self._stamps = [
+                event.relevant_date.sort_date.timestamp()
+                if event.relevant_date is not None else float('inf')
+                for event in self.events
+            ]
+        return self._stamps
+
+    def _get_states(self):
+        "Return state name -> hot events mapping - build it when needed"
+        if self._states is None:
+            self._states = {}
+            for event in self.events:
+                if event.state is not None:
+                    self._states.setdefault(event.state.name, []).append(event)
+        return self._states
+
+    def _get_cold_states(self):
+        "Return state name -> cold events mapping - build it when needed"
+        if self._cold_states is None:
+            self._cold_states = {}
+            for event in self.cold:
+                if event.state is not None:
+                    self._cold_states.setdefault(event.state.name, []).append(event)
+        return self._cold_states
+
+    def get_by_state(self, names):
+        "Get events in one of the given states sorted by date"
+        events = []
+        tiers = [self._get_states()]
+        if self.cold:
+            tiers.append(self._get_cold_states())
+        for states in tiers:
+            for name in names:
+                events += states.get(name, ())
+        if len(names) > 1 or len(tiers) > 1:
+            events.sort()
+        return events
+
+    def count_by_state(self, name):
+        "Number of events in a state"
+        return len(self._get_states().get(name, ()))
+
+    def count_by_tag(self):
+        "Count events of both tiers by internal (source) tag"
+        index = self._get_index()
+        if index is not None:
+            counts = index.count_by_tag()
+            events = self.cold
+        else:
+            counts = {}
+            events = self.events + self.cold
+        for event in events:
+            tag = self.source_of(event)
+            counts[tag] = counts.get(tag, 0) + 1
+        return counts
 
     def get_planned(self, horizon,
                     relative_to):
@@ -75,44 +564,78 @@ class Calendar:
           relative_to (datetime): The relative "now" time.
           list_unfinished_appointments (bool): Return all open or just scheduled.
         """
-        print("GET UNFINISHED")
+        trace = self.tracer.start('unfinished')
+        index = self._get_index()
+        if index is not None:
+            unfinished = index.get_unfinished(horizon,
+                                              list_unfinished_appointments,
+                                              relative_to)
+            if trace is not None:
+                self.tracer.finish(trace, 'columnar', len(self.events),
+                                   len(unfinished))
+            return unfinished
+
         unfinished = []
+        scanned = 0
         for event in self.events:
-            print("  ", event)
+            scanned += 1
+            if event.relevant_date is None:
+                # Date-less events are sorted last
+                break
             date = event.relevant_date.sort_date
             if date < horizon:
-                print("  BEFORE HORIZON")
+                if trace is not None:
+                    trace.reject('before horizon')
                 continue
             if event.state is None:
-                print("  NO STATE, SO NOT AN OPEN STATE")
+                if trace is not None:
+                    trace.reject('no state')
                 continue
             if not event.state.is_open:
-                print("  NOT OPEN STATE")
+                if trace is not None:
+                    trace.reject('closed')
                 continue
             if list_unfinished_appointments is False:
-                print("  CHECK IF APP", event.date_types)
                 if (DateType.SCHEDULED not in event.date_types and
                     DateType.DEADLINE not in event.date_types):
-                    print("  NOT SCHEDULED")
+                    if trace is not None:
+                        trace.reject('not scheduled')
                     continue
             if date > relative_to:
                 # We are in future - not unfinished.
                 break
 
-            print("  GOT YOU")
             unfinished.append(event)
+        if trace is not None:
+            self.tracer.finish(trace, 'scan', scanned, len(unfinished))
         return unfinished
 
     def get_appointments(self, since, horizon):
         "Get a list of scheduled and planned events"
-        appointments = []
+        index = self._get_index()
+        if index is not None:
+            appointments = index.get_appointments(since, horizon)
+        else:
+            appointments = self._scan_appointments(since, horizon)
+
+        repeating = self._expand_repeating(since, horizon)
+        if repeating:
+            appointments += repeating
+            appointments.sort()
+        return appointments
 
+    def _scan_appointments(self, since, horizon):
+        "Find non-cyclic appointments by scanning events"
         appointments = []
         for event in self.events:
             # Include only appointments
             if event.relevant_date is None or not event.relevant_date.appointment:
                 continue
 
+            # Cyclic events are expanded separately
+            if event.repeating:
+                continue
+
             # Check horizon
             date = event.relevant_date.sort_date
             if date < since:
@@ -124,39 +647,112 @@ class Calendar:
 
     def get_scheduled(self, horizon, relative_to):
         "Get tasks scheduled or deadlining in given period"
+        trace = self.tracer.start('scheduled')
+        index = self._get_index()
+        if index is not None:
+            scheduled = index.get_appointments(relative_to, horizon)
+            path, scanned = 'columnar', len(self.events)
+        else:
+            scheduled = []
+            path, scanned = 'scan', 0
+            for event in self.events:
+                scanned += 1
+                if event.relevant_date is None:
+                    # Date-less events are sorted last
+                    break
+                date = event.relevant_date.sort_date
+                if date < relative_to:
+                    if trace is not None:
+                        trace.reject('in past')
+                    continue
+                if date > horizon:
+                    break
 
-        print("GET SCHEDULED")
-        scheduled = []
-        for event in self.events:
-            date = event.relevant_date.sort_date
-            print("  ", event)
-            if date < relative_to:
-                print("    IN PAST")
-                continue
-            if date > horizon:
-                print("    OVER HORIZON")
-                break
+                # State doesn't matter as long as the date is accurate
+                if not event.relevant_date.appointment:
+                    if trace is not None:
+                        trace.reject('not appointment')
+                    continue
 
-            # State doesn't matter as long as the date is accurate
-            if not event.relevant_date.appointment:
-                continue
+                # Cyclic events are expanded separately
+                if event.repeating:
+                    if trace is not None:
+                        trace.reject('repeating')
+                    continue
 
-            print("  GOT YOU")
-            scheduled.append(event)
+                scheduled.append(event)
 
+        repeating = self._expand_repeating(relative_to, horizon)
+        if repeating:
+            scheduled += repeating
+            scheduled.sort()
+        if trace is not None:
+            self.tracer.finish(trace, path, scanned, len(scheduled))
         return scheduled
 
-    def get_agenda(self, horizon_incoming, horizon_unfinished,
-                   list_unfinished_appointments, relative_to):
-        "Generate agenda in a text format"
+    def get_status(self, horizon, relative_to):
+        """
+        Summarize calendar for status bars: number of open tasks and
+        appointments today (including overdue tasks), tomorrow and later
+        (until the horizon, each cyclic event counted once), open date-less
+        tasks and the next appointment.
+        """
+        today = relative_to.replace(hour=0, minute=0, second=0, microsecond=0)
+        end_today = today + dt.timedelta(days=1, microseconds=-1)
+        end_tomorrow = end_today + dt.timedelta(days=1)
 
-        log.info("Getting agenda from %r to %r",
-                 horizon_unfinished, horizon_incoming)
+        status = {
+            'today': 0,
+            'tomorrow': 0,
+            'later': 0,
+            'undated': 0,
+            'next': None,
+        }
+
+        def is_relevant(event):
+            return event.state is None or event.state.is_open
+
+        for events in self._get_states().values():
+            if not events[0].state.is_open:
+                continue
+            for event in events:
+                if event.relevant_date is None:
+                    status['undated'] += 1
+                elif not event.repeating and event.relevant_date.sort_date < today:
+                    # Overdue
+                    status['today'] += 1
+
+        for event in self.get_between(today, None):
+            if not is_relevant(event):
+                continue
+            date = event.relevant_date.sort_date
+            if date > horizon:
+                break
+            if date <= end_today:
+                status['today'] += 1
+            elif date <= end_tomorrow:
+                status['tomorrow'] += 1
+            else:
+                status['later'] += 1
 
-        # Open and read when needed so the file can be updated
-        # without restarting bot.
-        template = helpers.get_template(self.agenda_path, self.agenda_content)
+        for event in self.get_between(relative_to, None):
+            date = event.relevant_date
+            if date.sort_date > horizon:
+                break
+            if date.appointment and date.sort_date > relative_to and is_relevant(event):
+                status['next'] = event
+                break
+        return status
 
+    def get_agenda_context(self, horizon_incoming, horizon_unfinished,
+                           list_unfinished_appointments, relative_to,
+                           queries=None):
+        """
+        Gather events displayed in the agenda
+
+        queries is an optional dictionary of name -> compiled Query, results
+        are available in the template as `queries'.
+        """
         since = relative_to.replace(hour=0, minute=0)
         if (relative_to - since).total_seconds() < 4*60*60:
             # Include more past
@@ -173,9 +769,61 @@ class Calendar:
             'appointments': self.get_appointments(since=since,
                                                   horizon=horizon_incoming),
             'now': relative_to,
+            'queries': {
+                name: query.execute(self, relative_to)
+                for name, query in (queries or {}).items()
+            },
         }
+        return ctx
+
+    def _get_agenda_template(self):
+        """
+        Return agenda template and its modification time. Template is read
+        again only when the file changes - so it can be updated without
+        restarting bot.
+        """
+        if self.agenda_path is None:
+            mtime = None
+        else:
+            mtime = os.stat(self.agenda_path).st_mtime_ns
+        if self._template is None or self._template[0] != mtime:
+            template = helpers.get_template(self.agenda_path, self.agenda_content)
+            self._template = (mtime, template)
+        return self._template
+
+    def get_agenda(self, horizon_incoming, horizon_unfinished,
+                   list_unfinished_appointments, relative_to, queries=None,
+                   with_unfinished=False):
+        """
+        Generate agenda in a text format. With with_unfinished return also
+        unfinished events listed in it: (agenda, unfinished).
+
+        Rendered agendas are cached - if calendar didn't change the result
+        depends only on the minute of relative_to.
+        """
+        mtime, template = self._get_agenda_template()
+        key = (self.version,
+               relative_to.replace(second=0, microsecond=0),
+               horizon_incoming, horizon_unfinished,
+               list_unfinished_appointments, mtime,
+               tuple((name, query.text)
+                     for name, query in (queries or {}).items()))
+        cached = self._agenda_cache.get(key)
+        if cached is not None:
+            return cached if with_unfinished else cached[0]
+
+        log.info("Getting agenda from %r to %r",
+                 horizon_unfinished, horizon_incoming)
+
+        ctx = self.get_agenda_context(horizon_incoming, horizon_unfinished,
+                                      list_unfinished_appointments,
+                                      relative_to, queries)
+        agenda = template.render(ctx)
 
-        return template.render(ctx)
+        if len(self._agenda_cache) >= self.AGENDA_CACHE_SIZE:
+            self._agenda_cache.clear()
+        self._agenda_cache[key] = (agenda, ctx['unfinished'])
+        return (agenda, ctx['unfinished']) if with_unfinished else agenda
 
     def __repr__(self):
         txt = "<Calendar events=%d>"
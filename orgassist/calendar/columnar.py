@@ -0,0 +1,108 @@
+"""
+Optional columnar (NumPy) index over calendar events.
+
+Calendar queries scan events and filter them by a few attributes. With
+hundreds of thousands of events Python loops dominate the query time - this
+index keeps the attributes in arrays, so queries are vectorized masks over a
+binary-searched date window. Event objects are materialized only for hits.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .event_date import DateType
+
+# Bit of each date type in the date_types column
+DATE_TYPE_BITS = {
+    date_type: 1 << index
+    for index, date_type in enumerate(DateType)
+}
+
+SCHEDULED_OR_DEADLINE = (DATE_TYPE_BITS[DateType.SCHEDULED] |
+                         DATE_TYPE_BITS[DateType.DEADLINE])
+
+
+def is_available():
+    "Is the optional numpy dependency installed?"
+    return np is not None
+
+
+class ColumnarIndex:
+    """
+    Immutable columnar view of a sorted list of events. Rebuild it when
+    events change.
+    """
+    def __init__(self, events, source_of):
+        """
+        Build columns out of events sorted by the relevant date; source_of
+        returns the internal tag of an event.
+        """
+        assert np is not None, "Columnar index requires numpy"
+        self.events = events
+        count = len(events)
+
+        # Date-less events sort last - so do infinities.
+        self.epoch = np.full(count, np.inf, dtype=np.float64)
+        self.date_types = np.zeros(count, dtype=np.uint8)
+        self.is_open = np.zeros(count, dtype=bool)
+        self.appointment = np.zeros(count, dtype=bool)
+        self.repeating = np.zeros(count, dtype=bool)
+        self.source = np.zeros(count, dtype=np.int32)
+
+        # Source tag <-> integer code
+        self.source_codes = {}
+        self.source_tags = []
+
+        for i, event in enumerate(events):
+            if event.relevant_date is not None:
+                self.epoch[i] = event.relevant_date.sort_date.timestamp()
+                self.appointment[i] = event.relevant_date.appointment
+            bits = 0
+            for date_type in event.date_types:
+                bits |= DATE_TYPE_BITS[date_type]
+            self.date_types[i] = bits
+            self.is_open[i] = event.state is not None and event.state.is_open
+            self.repeating[i] = event.repeating
+
+            tag = source_of(event)
+            code = self.source_codes.get(tag)
+            if code is None:
+                code = self.source_codes[tag] = len(self.source_tags)
+                self.source_tags.append(tag)
+            self.source[i] = code
+
+    def _window(self, since, until):
+        "Indices of the [since, until] date window"
+        low = np.searchsorted(self.epoch, since.timestamp(), side='left')
+        high = np.searchsorted(self.epoch, until.timestamp(), side='right')
+        return low, high
+
+    def _materialize(self, mask, offset):
+        "Return events for a window mask"
+        return [self.events[i] for i in (np.nonzero(mask)[0] + offset)]
+
+    def get_appointments(self, since, until):
+        "Non-cyclic appointments within a window"
+        low, high = self._window(since, until)
+        mask = self.appointment[low:high] & ~self.repeating[low:high]
+        return self._materialize(mask, low)
+
+    def get_unfinished(self, horizon, list_unfinished_appointments,
+                       relative_to):
+        "Open events between horizon and relative_to"
+        low, high = self._window(horizon, relative_to)
+        mask = self.is_open[low:high]
+        if list_unfinished_appointments is False:
+            mask = mask & ((self.date_types[low:high] &
+                            SCHEDULED_OR_DEADLINE) != 0)
+        return self._materialize(mask, low)
+
+    def count_by_tag(self):
+        "Count events by their source tag"
+        counts = np.bincount(self.source, minlength=len(self.source_tags))
+        return {
+            tag: int(counts[code])
+            for code, tag in enumerate(self.source_tags)
+        }
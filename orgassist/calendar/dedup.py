@@ -0,0 +1,92 @@
+"""
+Fingerprint index used to detect the same appointment coming from multiple
+sources - eg. a meeting read from Exchange and captured into org-mode.
+
+Appointments are bucketed by their start minute. Within a bucket events
+with compatible end dates and similar headlines (Jaccard similarity of
+normalized word sets) are considered duplicates.
+"""
+
+import re
+
+# Minimal similarity of headline word sets of duplicates
+SIMILARITY = 0.5
+
+_WORD_RE = re.compile(r'\w+')
+
+
+def tokens(headline):
+    "Normalized set of headline words"
+    return frozenset(_WORD_RE.findall(headline.lower()))
+
+
+def similarity(first, second):
+    "Jaccard similarity of two sets"
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+def _end(event):
+    "End of a ranged appointment or None"
+    return event.relevant_date.date_end
+
+
+class FingerprintIndex:
+    "Index of appointments of all sources by their (start, end, words)"
+    def __init__(self):
+        # start minute -> [(end, words, source, event)]
+        self.buckets = {}
+
+    @staticmethod
+    def key(event):
+        "Bucket key or None if event is not deduplicated"
+        date = event.relevant_date
+        if date is None or not date.appointment or event.repeating:
+            return None
+        return int(date.sort_date.timestamp() // 60)
+
+    def add(self, event, source):
+        "Add event of a source (internal tag) to the index"
+        key = self.key(event)
+        if key is None:
+            return
+        entry = (_end(event), tokens(event.headline), source, event)
+        self.buckets.setdefault(key, []).append(entry)
+
+    def remove(self, events):
+        "Remove events from the index"
+        removed = set(id(event) for event in events)
+        keys = set(self.key(event) for event in events)
+        keys.discard(None)
+        for key in keys:
+            bucket = [
+                entry for entry in self.buckets.get(key, [])
+                if id(entry[3]) not in removed
+            ]
+            if bucket:
+                self.buckets[key] = bucket
+            else:
+                self.buckets.pop(key, None)
+
+    def find(self, event, source, hidden):
+        """
+        Find a visible duplicate of the event from a different source.
+        hidden contains ids of hidden duplicates.
+        """
+        key = self.key(event)
+        if key is None:
+            return None
+        end = _end(event)
+        words = tokens(event.headline)
+        for entry in self.buckets.get(key, []):
+            other_end, other_words, other_source, other = entry
+            if other is event or other_source == source:
+                continue
+            if id(other) in hidden:
+                continue
+            if end is not None and other_end is not None and end != other_end:
+                continue
+            if similarity(words, other_words) >= SIMILARITY:
+                return other
+        return None
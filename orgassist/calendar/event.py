@@ -2,6 +2,7 @@
 Abstract events away from the org plugin so they can be used in other
 modules and "agenda" handling can be shared.
 """
+import copy
 import datetime as dt
 import jinja2
 
@@ -54,6 +55,13 @@ class Event:
 
         self.tags = set()
 
+        # Tags including ones inherited from parents (eg. org outline).
+        # Immutable, possibly shared between events.
+        self.all_tags = frozenset()
+
+        # Headlines of parent entries, outermost first
+        self.path = ()
+
         # A, B, C (letter)
         self.priority = None
 
@@ -69,13 +77,17 @@ class Event:
         # Set of all date types for this event
         self.date_types = set()
 
-        # Event body content
-        self.body = ""
+        # Event body content, possibly computed lazily - see set_lazy_body
+        self._body = ""
+        self._body_loader = None
 
         # Metadata, eg. location in org-mode tree.
         # Controlled freely by creator.
         self.meta = {}
 
+        # For occurrences of cyclic events - the original event.
+        self.occurrence_of = None
+
     def add_date(self, event_date, relative_to=None):
         "Add date to the event"
         assert event_date not in self.dates
@@ -92,6 +104,66 @@ class Event:
         # Update event type
         self.date_types.add(event_date.date_type)
 
+    @property
+    def body(self):
+        "Event body content - computed and memoized on first access"
+        if self._body_loader is not None:
+            self._body = self._body_loader()
+            self._body_loader = None
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        "Set body content"
+        self._body = value
+        self._body_loader = None
+
+    def set_lazy_body(self, loader):
+        """
+        Defer body processing until the body is actually used.
+
+        Loader is a callable returning the body. Most events are never
+        displayed nor searched, so their bodies are never processed.
+        """
+        self._body = None
+        self._body_loader = loader
+
+    @property
+    def repeating(self):
+        "True if any of event dates has a repeater"
+        return any(date.repeater is not None for date in self.dates)
+
+    def as_dict(self):
+        "Describe event with JSON-serializable values (without the body)"
+        date = self.relevant_date
+        if date is not None:
+            date = {
+                'date': date.date.isoformat(),
+                'end': date.date_end.isoformat() if date.date_end else None,
+                'type': date.date_type.name,
+                'appointment': date.appointment,
+                'repeater': str(date.repeater) if date.repeater else None,
+            }
+        return {
+            'headline': self.headline,
+            'state': self.state.name if self.state else None,
+            'open': self.state.is_open if self.state else None,
+            'priority': self.priority,
+            'tags': sorted(self.all_tags),
+            'path': list(self.path),
+            'date': date,
+        }
+
+    def occurrence(self, event_date):
+        """
+        Create a lightweight copy of the event representing a single
+        occurrence of a cyclic event at a given date.
+        """
+        occurrence = copy.copy(self)
+        occurrence.relevant_date = event_date
+        occurrence.occurrence_of = self
+        return occurrence
+
     def set_state(self, state):
         "Handle state as object or string - if string, cast to object"
         if isinstance(state, str):
@@ -104,6 +176,7 @@ class Event:
         if isinstance(tags, str):
             tags = {tags}
         self.tags.update(tags)
+        self.all_tags = self.all_tags.union(tags)
         return self
 
     def format_notice(self, template, relative_to):
@@ -3,6 +3,9 @@ Abstract dates away from the org plugin so they can be used in other
 modules and "agenda" handling can be shared.
 """
 
+import re
+import math
+import calendar
 import datetime as dt
 import enum
 
@@ -18,15 +21,113 @@ class DateType(enum.Enum):
     SCHEDULED = 3
     RANGE = 4
 
+class Repeater:
+    """
+    Org-mode repeater cookie attached to a date: +1w, .+1d, ++1m.
+
+    All three kinds describe the same series of future occurrences starting
+    at the base date - they differ only in how org shifts the base date when
+    the task gets marked as done.
+    """
+    _RE_COOKIE = re.compile(r'^(\.\+|\+\+|\+)(\d+)([hdwmy])$')
+
+    # Length of fixed-size units in seconds. Months and years are handled
+    # using a calendar arithmetic.
+    UNIT_SECONDS = {
+        'h': 60 * 60,
+        'd': 24 * 60 * 60,
+        'w': 7 * 24 * 60 * 60,
+    }
+
+    def __init__(self, kind, count, unit):
+        assert kind in ('+', '++', '.+')
+        assert unit in ('h', 'd', 'w', 'm', 'y')
+        assert count > 0
+        self.kind = kind
+        self.count = count
+        self.unit = unit
+
+    @classmethod
+    def parse(cls, cookie):
+        "Create a repeater from a textual cookie (eg. '.+1d')"
+        match = cls._RE_COOKIE.match(cookie.strip())
+        if match is None:
+            raise ValueError("Invalid repeater cookie: %r" % cookie)
+        kind, count, unit = match.groups()
+        return cls(kind, int(count), unit)
+
+    def shift(self, date, times):
+        "Shift date or datetime by a given number of repeater intervals"
+        if self.unit in self.UNIT_SECONDS:
+            delta = dt.timedelta(seconds=self.UNIT_SECONDS[self.unit])
+            return date + delta * (self.count * times)
+
+        months = self.count * times
+        if self.unit == 'y':
+            months *= 12
+        year, month = divmod(date.month - 1 + months, 12)
+        year += date.year
+        month += 1
+        day = min(date.day, calendar.monthrange(year, month)[1])
+        return date.replace(year=year, month=month, day=day)
+
+    def in_days(self):
+        """
+        Repeater of time-less dates, which can't repeat more often than
+        daily - hours are rounded up to whole days.
+        """
+        if self.unit != 'h':
+            return self
+        return Repeater(self.kind, int(math.ceil(self.count / 24)), 'd')
+
+    def estimate_times(self, date, since):
+        """
+        Estimate the number of intervals needed to shift date to reach
+        `since'. Might be off by one - caller has to correct it.
+        """
+        if self.unit in self.UNIT_SECONDS:
+            step = self.UNIT_SECONDS[self.unit] * self.count
+            delta = (since - date).total_seconds()
+            return max(0, int(math.ceil(delta / step)))
+
+        months = (since.year - date.year) * 12 + since.month - date.month
+        if self.unit == 'y':
+            months //= 12
+        return max(0, months // self.count)
+
+    def __eq__(self, other):
+        return (isinstance(other, Repeater) and
+                (self.kind, self.count, self.unit) ==
+                (other.kind, other.count, other.unit))
+
+    def __hash__(self):
+        return hash((self.kind, self.count, self.unit))
+
+    def __str__(self):
+        return '%s%d%s' % (self.kind, self.count, self.unit)
+
+    def __repr__(self):
+        return '<Repeater %s>' % self
+
+
 class EventDate:
     """
     Handle operations on a date, distinguishes different date types, date
     ranges and cyclic dates.
     """
-    def __init__(self, date, date_type, timezone=None):
+    def __init__(self, date, date_type, timezone=None, repeater=None):
         """
         For time-less dates, or naive datetime passing timezone is obligatory.
+
+        Repeater (a Repeater instance or a cookie string) makes the date
+        cyclic - see occurrences().
         """
+        if isinstance(repeater, str):
+            repeater = Repeater.parse(repeater)
+        start = date[0] if isinstance(date, tuple) else date
+        if repeater is not None and not isinstance(start, dt.datetime):
+            repeater = repeater.in_days()
+        self.repeater = repeater
 
         # Date is an appointment if it has hour and minutes.
         self.appointment = False
@@ -71,6 +172,68 @@ class EventDate:
         else:
             return date
 
+    @staticmethod
+    def _shift(date, repeater, times):
+        "Shift date keeping a correct (DST-aware) timezone offset"
+        if date is None or times == 0:
+            return date
+        if not isinstance(date, dt.datetime) or date.tzinfo is None:
+            return repeater.shift(date, times)
+        tzinfo = date.tzinfo
+        shifted = repeater.shift(date.replace(tzinfo=None), times)
+        if hasattr(tzinfo, 'localize'):
+            # pytz timezone
+            return tzinfo.localize(shifted)
+        return shifted.replace(tzinfo=tzinfo)
+
+    def _occurrence(self, times):
+        "Create a non-repeating date of the n-th occurrence"
+        if times == 0 and self.repeater is None:
+            return self
+        date = self._shift(self.date, self.repeater, times)
+        if self.date_type == DateType.RANGE:
+            date = (date, self._shift(self.date_end, self.repeater, times))
+        return EventDate(date, self.date_type, self.timezone)
+
+    def occurrences(self, since, until):
+        """
+        Lazily generate non-repeating dates of all occurrences which sort
+        between `since' and `until' (inclusive).
+
+        Non-repeating date yields at most itself.
+        """
+        if self.repeater is None:
+            if since <= self.sort_date <= until:
+                yield self
+            return
+
+        # Jump directly near the window instead of iterating the whole
+        # history - daily habits can be years old.
+        times = self.repeater.estimate_times(self.sort_date, since)
+        occurrence = self._occurrence(times)
+        while times > 0:
+            previous = self._occurrence(times - 1)
+            if previous.sort_date < since:
+                break
+            times, occurrence = times - 1, previous
+
+        while occurrence.sort_date <= until:
+            if occurrence.sort_date >= since:
+                yield occurrence
+            times += 1
+            occurrence = self._occurrence(times)
+
+    def next_occurrence(self, relative_to):
+        "Return the first occurrence at or after a given date (or None)"
+        if self.repeater is None:
+            return self if self.sort_date >= relative_to else None
+        times = self.repeater.estimate_times(self.sort_date, relative_to)
+        occurrence = self._occurrence(times)
+        while occurrence.sort_date < relative_to:
+            times += 1
+            occurrence = self._occurrence(times)
+        return occurrence
+
     def __lt__(self, event_date):
         "Compare dates"
         return self.sort_date < event_date.sort_date
@@ -138,6 +301,7 @@ class EventDate:
             ranged = '<->[%s]' % format_date(self.date_end)
         else:
             ranged = ''
-        txt = '<EventDate [%s]%s %s>' % (format_date(self.date), ranged,
-                                         self.date_type.name)
+        repeater = ' ' + str(self.repeater) if self.repeater else ''
+        txt = '<EventDate [%s%s]%s %s>' % (format_date(self.date), repeater,
+                                           ranged, self.date_type.name)
         return txt
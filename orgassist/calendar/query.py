@@ -0,0 +1,338 @@
+"""
+Small query language for filtering calendar events, eg.:
+
+    todo:TODO tag:work prio:A due:<3d "weekly report"
+
+Terms are ANDed:
+  todo:TODO,NEXT  - event in one of the states (or todo:open, todo:closed)
+  tag:work        - event tagged (including inherited tags, case insensitive)
+  prio:A,B        - event with one of priorities
+  due:<3d         - relevant date before now+3d; also >2w, today, overdue.
+                    Units: h, d, w.
+  word, "a text"  - case insensitive text in headline or body
+
+A query is parsed once. On execution the plan fetches candidates using the
+cheapest available index (date window, tag postings or states) and checks
+the remaining predicates, most selective first.
+"""
+
+import re
+import datetime as dt
+
+from .tag_index import normalize_tag
+
+
+class QueryError(ValueError):
+    "Invalid query"
+
+
+TOKEN_RE = re.compile(r'"([^"]*)"|(\S+)')
+FIELD_RE = re.compile(r'^(\w+):(.+)$')
+DUE_RE = re.compile(r'^([<>]?)(-?\d+)([hdw])$')
+
+DURATION_UNITS = {
+    'h': 'hours',
+    'd': 'days',
+    'w': 'weeks',
+}
+
+# Estimated fraction of matching events for predicates without an index.
+PRIORITY_FRACTION = 0.1
+OPEN_FRACTION = 0.5
+# Text matching is slow - always check it last.
+TEXT_COST = 10
+
+
+class Term:
+    "Single predicate of a query"
+    def matches(self, event, relative_to):
+        "Does the event match?"
+        raise NotImplementedError
+
+    def estimate(self, calendar):
+        "Estimate a number of matching events in a calendar"
+        return len(calendar.events)
+
+
+class TextTerm(Term):
+    "Case-insensitive text in headline or body"
+    def __init__(self, text):
+        self.text = text.casefold()
+
+    def matches(self, event, relative_to):
+        # Not kept - it would be a second copy of every searched body
+        return (self.text in event.headline.casefold() or
+                self.text in event.body.casefold())
+
+    def estimate(self, calendar):
+        return len(calendar.events) * TEXT_COST
+
+    def __repr__(self):
+        return '"%s"' % self.text
+
+
+class TagTerm(Term):
+    "Event has a tag (including inherited ones)"
+    def __init__(self, tag):
+        self.tag = normalize_tag(tag.strip(':'))
+
+    def matches(self, event, relative_to):
+        return any(normalize_tag(tag) == self.tag for tag in event.all_tags)
+
+    def estimate(self, calendar):
+        return calendar.tag_index.count(self.tag)
+
+    def __repr__(self):
+        return 'tag:%s' % self.tag
+
+
+class StateTerm(Term):
+    "Event in one of states, or in any open or closed state"
+    def __init__(self, value):
+        value = value.upper()
+        self.is_open = {'OPEN': True, 'CLOSED': False}.get(value)
+        self.names = None if self.is_open is not None else set(value.split(','))
+
+    def matches(self, event, relative_to):
+        if event.state is None:
+            return False
+        if self.names is None:
+            return event.state.is_open == self.is_open
+        return event.state.name in self.names
+
+    def estimate(self, calendar):
+        if self.names is None:
+            return len(calendar.events) * OPEN_FRACTION
+        return sum(calendar.count_by_state(name) for name in self.names)
+
+    def __repr__(self):
+        if self.names is None:
+            return 'todo:%s' % ('open' if self.is_open else 'closed')
+        return 'todo:%s' % ','.join(sorted(self.names))
+
+
+class PriorityTerm(Term):
+    "Event with one of priorities"
+    def __init__(self, value):
+        self.priorities = set(value.upper().split(','))
+
+    def matches(self, event, relative_to):
+        return event.priority in self.priorities
+
+    def estimate(self, calendar):
+        return len(calendar.events) * PRIORITY_FRACTION
+
+    def __repr__(self):
+        return 'prio:%s' % ','.join(sorted(self.priorities))
+
+
+class DueTerm(Term):
+    "Relevant date within a window relative to now"
+    def __init__(self, value):
+        self.value = value.lower()
+        if self.value in ('today', 'overdue'):
+            return
+        match = DUE_RE.match(self.value)
+        if match is None:
+            raise QueryError("Invalid due '%s' - use eg. due:<3d, due:>1w, "
+                             "due:today or due:overdue" % value)
+        operator, count, unit = match.groups()
+        self.before = operator != '>'
+        self.delta = dt.timedelta(**{DURATION_UNITS[unit]: int(count)})
+
+    def window(self, relative_to):
+        "Return (since, until) window - None for an unbounded side"
+        if self.value == 'today':
+            since = relative_to.replace(hour=0, minute=0, second=0,
+                                        microsecond=0)
+            return since, since + dt.timedelta(days=1, microseconds=-1)
+        if self.value == 'overdue':
+            return None, relative_to
+        if self.before:
+            return None, relative_to + self.delta
+        return relative_to + self.delta, None
+
+    def matches(self, event, relative_to):
+        if event.relevant_date is None:
+            return False
+        since, until = self.window(relative_to)
+        date = event.relevant_date.sort_date
+        if since is not None and date < since:
+            return False
+        if until is not None and date > until:
+            return False
+        return True
+
+    def __repr__(self):
+        return 'due:%s' % self.value
+
+
+FIELDS = {
+    'todo': StateTerm,
+    'state': StateTerm,
+    'tag': TagTerm,
+    'prio': PriorityTerm,
+    'due': DueTerm,
+}
+
+
+def parse(text):
+    "Parse query text into a list of terms"
+    terms = []
+    for quoted, word in TOKEN_RE.findall(text):
+        if quoted:
+            terms.append(TextTerm(quoted))
+            continue
+        match = FIELD_RE.match(word)
+        if match is not None and match.group(1).lower() in FIELDS:
+            field, value = match.groups()
+            terms.append(FIELDS[field.lower()](value))
+        else:
+            terms.append(TextTerm(word))
+    if not terms:
+        raise QueryError("Empty query")
+    return terms
+
+
+class Plan:
+    "Index used to fetch candidates and predicates checked on them"
+    def __init__(self, index, fetch, predicates):
+        self.index = index
+        self.fetch = fetch
+        self.predicates = predicates
+
+    def describe(self):
+        "Describe the plan in a single line"
+        checks = ' '.join(repr(term) for term in self.predicates) or 'nothing'
+        return "using %s index, checking %s" % (self.index, checks)
+
+
+class Query:
+    """
+    Compiled query. Plans are cached for a calendar version as they depend
+    on the index statistics.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.terms = parse(text)
+        self.due = [term for term in self.terms if isinstance(term, DueTerm)]
+        self.tags = [term for term in self.terms if isinstance(term, TagTerm)]
+        self.states = [
+            term for term in self.terms
+            if isinstance(term, StateTerm) and term.names is not None
+        ]
+        # (calendar id, version) -> plan
+        self._plan_key = None
+        self._plan = None
+
+    def window(self, relative_to):
+        "Intersect windows of all due terms or return None"
+        if not self.due:
+            return None
+        since, until = None, None
+        for term in self.due:
+            term_since, term_until = term.window(relative_to)
+            if term_since is not None and (since is None or term_since > since):
+                since = term_since
+            if term_until is not None and (until is None or term_until < until):
+                until = term_until
+        return since, until
+
+    def plan(self, calendar, index=None):
+        """
+        Choose the cheapest index (or use a given one, eg. for tests) and
+        order remaining predicates
+        """
+        key = (id(calendar), calendar.version)
+        if index is None and self._plan_key == key:
+            return self._plan
+
+        # (estimate, index name, fetch(relative_to), consumed terms)
+        options = [
+            (len(calendar.events), 'no', lambda now: calendar.get_all(), [])
+        ]
+        if self.tags:
+            tags = [term.tag for term in self.tags]
+            def fetch_tagged(now):
+                since, until = self.window(now) or (None, None)
+                return calendar.get_tagged(tags, since, until)
+            estimate = min(term.estimate(calendar) for term in self.tags)
+            # Cyclic events are not windowed in open windows - keep the
+            # due predicates.
+            options.append((estimate, 'tag', fetch_tagged, self.tags))
+        if self.due:
+            def fetch_window(now):
+                return calendar.get_between(*self.window(now))
+            # Bisection is cheaper than anything else - prefer it on ties.
+            estimate = len(calendar.events) / 2
+            options.append((estimate, 'date', fetch_window, self.due))
+        for term in self.states:
+            def fetch_states(now, names=term.names):
+                return calendar.get_by_state(names)
+            options.append((term.estimate(calendar), 'state', fetch_states,
+                            [term]))
+
+        if index is not None:
+            options = [option for option in options if option[1] == index]
+            if not options:
+                raise QueryError("Index '%s' can't be used" % index)
+        _, chosen, fetch, consumed = min(options, key=lambda option: option[0])
+        predicates = [
+            term for term in self.terms
+            if not any(term is used for used in consumed)
+        ]
+        predicates.sort(key=lambda term: term.estimate(calendar))
+
+        plan = Plan(chosen, fetch, predicates)
+        if index is None:
+            self._plan = plan
+            self._plan_key = key
+        return plan
+
+    def filter(self, events, relative_to):
+        "Filter a list of events without using indices"
+        return [
+            event for event in events
+            if all(term.matches(event, relative_to) for term in self.terms)
+        ]
+
+    def execute(self, calendar, relative_to, index=None):
+        """
+        Return matching events of the calendar sorted by date. Cyclic events
+        are resolved to occurrences within the due window, so results don't
+        depend on the chosen index.
+        """
+        trace = calendar.tracer.start('query', self.text)
+        plan = self.plan(calendar, index)
+        events = plan.fetch(relative_to)
+        window = self.window(relative_to)
+        if window is not None:
+            events = calendar.resolve_repeating(events, *window)
+            events.sort()
+        if trace is not None:
+            return self._execute_traced(plan, events, relative_to, trace,
+                                        calendar.tracer)
+        if not plan.predicates:
+            return events
+        return [
+            event for event in events
+            if all(term.matches(event, relative_to)
+                   for term in plan.predicates)
+        ]
+
+    @staticmethod
+    def _execute_traced(plan, events, relative_to, trace, tracer):
+        "Filter fetched events counting rejections of each predicate"
+        matched = []
+        for event in events:
+            for term in plan.predicates:
+                if not term.matches(event, relative_to):
+                    trace.reject(repr(term))
+                    break
+            else:
+                matched.append(event)
+        tracer.finish(trace, '%s index' % plan.index, len(events), len(matched))
+        return matched
+
+    def __repr__(self):
+        return '<Query %s>' % ' '.join(repr(term) for term in self.terms)
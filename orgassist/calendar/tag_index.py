@@ -0,0 +1,211 @@
+"""
+Tag -> events index (posting lists) used for tag-filtered queries.
+
+Postings are kept separately for each calendar source (internal tag), so
+refreshing one source drops only its own postings. Each posting list is
+sorted by the event sort date and has a parallel list of timestamps, so a
+date window is found with a binary search. Added events are merged into
+the sorted lists and discarded ones are removed by their position, without
+rebuilding the index.
+"""
+
+import heapq
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+
+
+def normalize_tag(tag):
+    "Tags are matched case-insensitively"
+    return tag.lower()
+
+
+class Postings:
+    "Events with a given tag sorted by date, with parallel timestamps"
+    def __init__(self):
+        self.events = []
+        self.stamps = []
+
+    def window(self, since=None, until=None):
+        "Return events with sort date in [since, until] (None - unbounded)"
+        low = 0 if since is None else bisect_left(self.stamps,
+                                                  since.timestamp())
+        high = (len(self.stamps) if until is None
+                else bisect_right(self.stamps, until.timestamp()))
+        return self.events[low:high]
+
+    def add(self, events):
+        "Merge sorted events into the postings"
+        if len(events) == 1:
+            event = events[0]
+            position = bisect_right(self.events, event)
+            self.events.insert(position, event)
+            self.stamps.insert(position, _stamp(event))
+            return
+        merged = list(heapq.merge(zip(self.events, self.stamps),
+                                  ((event, _stamp(event)) for event in events),
+                                  key=itemgetter(0)))
+        self.events = [event for event, _ in merged]
+        self.stamps = [stamp for _, stamp in merged]
+
+    def discard(self, event):
+        "Remove an event found by its position - return False if missing"
+        low = bisect_left(self.events, event)
+        high = bisect_right(self.events, event)
+        position = next((i for i in range(low, high)
+                         if self.events[i] is event), None)
+        if position is None:
+            # Date changed since it was indexed
+            position = next((i for i, indexed in enumerate(self.events)
+                             if indexed is event), None)
+            if position is None:
+                return False
+        del self.events[position]
+        del self.stamps[position]
+        return True
+
+
+def _stamp(event):
+    "Sort key of an event - date-less events sort last"
+    if event.relevant_date is None:
+        return float('inf')
+    return event.relevant_date.sort_date.timestamp()
+
+
+def _tags(event):
+    "Normalized tags of an event"
+    return set(normalize_tag(tag) for tag in event.all_tags)
+
+
+class SourceIndex:
+    "Posting lists of a single calendar source"
+    def __init__(self):
+        # Cyclic events have no single date - matched when querying
+        self.repeating = []
+        # tag -> Postings
+        self.postings = {}
+
+    def add(self, events):
+        "Index new events"
+        by_tag = {}
+        for event in sorted(events):
+            if event.repeating:
+                self.repeating.append(event)
+                continue
+            for tag in _tags(event):
+                by_tag.setdefault(tag, []).append(event)
+
+        for tag, tagged in by_tag.items():
+            postings = self.postings.get(tag)
+            if postings is None:
+                postings = self.postings[tag] = Postings()
+            postings.add(tagged)
+
+    def discard(self, events):
+        "Remove indexed events"
+        repeating = set(id(event) for event in events if event.repeating)
+        if repeating:
+            self.repeating = [
+                event for event in self.repeating
+                if id(event) not in repeating
+            ]
+        for event in events:
+            if event.repeating:
+                continue
+            for tag in _tags(event):
+                postings = self.postings.get(tag)
+                if postings is None or not postings.discard(event):
+                    continue
+                if not postings.events:
+                    del self.postings[tag]
+
+    def query(self, tags, since, until):
+        """
+        Return non-cyclic events with all tags within a window.
+
+        The shortest posting list is windowed and the remaining tags are
+        checked against the immutable tag set of each candidate.
+        """
+        candidates = []
+        for tag in tags:
+            postings = self.postings.get(tag)
+            if postings is None:
+                return []
+            candidates.append(postings)
+        shortest = min(candidates, key=lambda postings: len(postings.events))
+        events = shortest.window(since, until)
+        if len(tags) == 1:
+            return events
+        return [
+            event for event in events
+            if tags.issubset(normalize_tag(tag) for tag in event.all_tags)
+        ]
+
+    def tagged_repeating(self, tags):
+        "Cyclic events with all tags"
+        return [
+            event for event in self.repeating
+            if tags.issubset(normalize_tag(tag) for tag in event.all_tags)
+        ]
+
+
+class TagIndex:
+    "Tag index of all calendar sources"
+    def __init__(self):
+        # internal (source) tag -> SourceIndex
+        self.sources = {}
+
+    def add(self, events, internal_tag):
+        "Index new events of a source"
+        current = self.sources.get(internal_tag)
+        if current is None:
+            current = self.sources[internal_tag] = SourceIndex()
+        current.add(events)
+
+    def remove(self, internal_tag=None):
+        "Forget events of a source or of all sources"
+        if internal_tag is None:
+            self.sources = {}
+        else:
+            self.sources.pop(internal_tag, None)
+
+    def discard(self, events, internal_tag):
+        "Forget individual events of a source, eg. merged duplicates"
+        current = self.sources.get(internal_tag)
+        if current is not None:
+            current.discard(events)
+
+    def query(self, tags, since=None, until=None):
+        """
+        Return non-cyclic events having all given tags (including inherited
+        ones) sorted by date and a list of cyclic events having them.
+        """
+        tags = frozenset(normalize_tag(tag) for tag in tags)
+        if not tags:
+            return [], []
+        per_source = [
+            source.query(tags, since, until)
+            for source in self.sources.values()
+        ]
+        repeating = [
+            event
+            for source in self.sources.values()
+            for event in source.tagged_repeating(tags)
+        ]
+        return list(heapq.merge(*per_source)), repeating
+
+    def count(self, tag):
+        "Number of non-cyclic events with a tag"
+        tag = normalize_tag(tag)
+        return sum(
+            len(source.postings[tag].events)
+            for source in self.sources.values()
+            if tag in source.postings
+        )
+
+    def tags(self):
+        "Return counts of events by tag"
+        counts = {}
+        for source in self.sources.values():
+            for tag, postings in source.postings.items():
+                counts[tag] = counts.get(tag, 0) + len(postings.events)
+        return counts
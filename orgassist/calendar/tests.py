@@ -4,8 +4,11 @@ import random
 import datetime as dt
 
 from orgassist.calendar import EventDate, Event, DateType
-from orgassist.calendar import EventState
-from orgassist.calendar import Calendar
+from orgassist.calendar import EventState, Repeater
+from orgassist.calendar import Calendar, Query, QueryError
+from orgassist.calendar import columnar
+from orgassist.calendar.trace import QueryTracer
+from orgassist.calendar.query import TextTerm
 
 class TestEvent(unittest.TestCase):
     """
@@ -139,6 +142,93 @@ class TestEvent(unittest.TestCase):
         self.assertTrue(DateType.TIMESTAMP in event.date_types)
         self.assertEqual(event.relevant_date, app_date)
 
+    def test_repeaters(self):
+        "Test cyclic dates and lazy occurrence generation"
+        now = self.day_starts()
+
+        repeater = Repeater.parse('.+2d')
+        self.assertEqual(repeater.kind, '.+')
+        self.assertEqual(str(repeater), '.+2d')
+        with self.assertRaises(ValueError):
+            Repeater.parse('+1x')
+
+        # Month arithmetic clamps the day
+        monthly = Repeater.parse('+1m')
+        self.assertEqual(monthly.shift(dt.date(2019, 1, 31), 1),
+                         dt.date(2019, 2, 28))
+        self.assertEqual(Repeater.parse('++1y').shift(dt.date(2019, 3, 1), 2),
+                         dt.date(2021, 3, 1))
+
+        # Daily habit started years ago
+        habit = EventDate(now - dt.timedelta(days=3 * 365),
+                          DateType.TIMESTAMP, repeater='+1d')
+        since = now + dt.timedelta(days=10)
+        until = since + dt.timedelta(days=3)
+        occurrences = list(habit.occurrences(since, until))
+        self.assertEqual(len(occurrences), 4)
+        for occurrence in occurrences:
+            self.assertIsNone(occurrence.repeater)
+            self.assertTrue(since <= occurrence.sort_date <= until)
+            self.assertEqual(occurrence.date.time(), habit.date.time())
+
+        nxt = habit.next_occurrence(now)
+        self.assertTrue(now <= nxt.sort_date < now + dt.timedelta(days=1))
+
+        # Time-less date repeats at most daily
+        hourly = EventDate(dt.date(2026, 1, 1), DateType.TIMESTAMP,
+                           timezone=pytz.utc, repeater='+1h')
+        self.assertEqual(str(hourly.repeater), '+1d')
+        self.assertEqual(str(EventDate(dt.date(2026, 1, 1), DateType.TIMESTAMP,
+                                       timezone=pytz.utc,
+                                       repeater='.+36h').repeater), '.+2d')
+        since = pytz.utc.localize(dt.datetime(2026, 1, 1))
+        occurrences = list(hourly.occurrences(since,
+                                              since + dt.timedelta(days=2)))
+        self.assertEqual([occurrence.date for occurrence in occurrences],
+                         [dt.date(2026, 1, 1), dt.date(2026, 1, 2)])
+
+        # Nothing before the base date
+        weekly = EventDate(now + dt.timedelta(days=7), DateType.TIMESTAMP,
+                           repeater='+1w')
+        self.assertEqual(list(weekly.occurrences(now, now + dt.timedelta(days=6))),
+                         [])
+
+        # Calendar expands occurrences only within the window
+        event = Event("Weekly meeting")
+        event.add_date(weekly)
+        single = Event("Single meeting")
+        single.add_date(EventDate(now + dt.timedelta(hours=1), DateType.TIMESTAMP))
+        calendar = Calendar(agenda_content="")
+        calendar.add_events([event, single], internal_tag='org')
+        self.assertEqual(calendar.repeating, [event])
+
+        appointments = calendar.get_appointments(since=now,
+                                                 horizon=now + dt.timedelta(days=22))
+        self.assertEqual([e.headline for e in appointments],
+                         ["Single meeting"] + ["Weekly meeting"] * 3)
+        self.assertIs(appointments[1].occurrence_of, event)
+        self.assertEqual(appointments[2].relevant_date.sort_date,
+                         weekly.sort_date + dt.timedelta(days=7))
+
+    def test_lazy_body(self):
+        "Body is processed only when used, and only once"
+        calls = []
+        def loader():
+            calls.append(1)
+            return "Body TEXT"
+
+        event = Event("Headline")
+        event.set_lazy_body(loader)
+        self.assertEqual(calls, [])
+        self.assertEqual(event.body, "Body TEXT")
+        self.assertTrue(TextTerm("body text").matches(event, None))
+        self.assertTrue(TextTerm("HEADLINE").matches(event, None))
+        self.assertEqual(event.body, "Body TEXT")
+        self.assertEqual(calls, [1])
+
+        event.body = "Other"
+        self.assertFalse(TextTerm("body text").matches(event, None))
+
     def test_tags(self):
         "Test tags on event"
 
@@ -149,6 +239,380 @@ class TestEvent(unittest.TestCase):
         event.add_tags(["TEST", "PRIVATE"])
         self.assertIn('TEST', event.tags)
 
+    def test_tag_index(self):
+        "Test tag queries"
+        now = self.day_starts()
+        calendar = Calendar(agenda_content="")
+        org, exch = [], []
+        for day in range(10):
+            event = Event('org %d' % day)
+            event.add_date(EventDate(now + dt.timedelta(days=day),
+                                     DateType.TIMESTAMP))
+            event.add_tags(['WORK'] if day % 2 else ['HOME'])
+            if day % 3 == 0:
+                event.add_tags('CODE')
+            org.append(event)
+        weekly = Event('weekly')
+        weekly.add_date(EventDate(now - dt.timedelta(days=14), DateType.TIMESTAMP,
+                                  repeater=Repeater.parse('+1w')))
+        weekly.add_tags('WORK')
+        org.append(weekly)
+
+        meeting = Event('meeting')
+        meeting.add_date(EventDate(now + dt.timedelta(days=1, hours=1),
+                                   DateType.TIMESTAMP))
+        meeting.add_tags('work')
+        exch.append(meeting)
+
+        calendar.add_events(org, internal_tag='org')
+        calendar.add_events(exch, internal_tag='exch')
+
+        week = now + dt.timedelta(days=6, hours=1)
+        tagged = calendar.get_tagged(['work'], since=now, until=week)
+        self.assertEqual([event.headline for event in tagged],
+                         ['weekly', 'org 1', 'meeting', 'org 3', 'org 5'])
+
+        tagged = calendar.get_tagged(['WORK', 'code'])
+        self.assertEqual([event.headline for event in tagged],
+                         ['org 3', 'org 9'])
+
+        # Events are merged into and removed from existing postings
+        late = Event('late')
+        late.add_date(EventDate(now + dt.timedelta(days=2, hours=12),
+                                DateType.TIMESTAMP))
+        late.add_tags(['WORK', 'CODE'])
+        calendar.add_events([late], internal_tag='org')
+        calendar.tag_index.discard([org[3]], 'org')
+        tagged = calendar.get_tagged(['work'], since=now, until=week)
+        self.assertEqual([event.headline for event in tagged],
+                         ['weekly', 'org 1', 'meeting', 'late', 'org 5'])
+        postings = calendar.tag_index.sources['org'].postings['work']
+        self.assertEqual(postings.stamps, sorted(postings.stamps))
+        self.assertEqual(calendar.tag_index.count('code'), 4)
+
+        # Updating one source keeps the other indexed
+        calendar.update_events([], 'org')
+        tagged = calendar.get_tagged(['work'], since=now, until=week)
+        self.assertEqual([event.headline for event in tagged], ['meeting'])
+        self.assertEqual(calendar.get_tagged(['home']), [])
+
+    def test_dedup(self):
+        "Test merging duplicates of different sources"
+        now = self.day_starts().replace(second=0, microsecond=0)
+
+        def appointment(headline, hours, tag='WORK'):
+            event = Event(headline)
+            event.add_date(EventDate(now + dt.timedelta(hours=hours),
+                                     DateType.TIMESTAMP))
+            event.add_tags(tag)
+            return event
+
+        calendar = Calendar(agenda_content="", dedup_prefer=['org'])
+        exch = [
+            appointment('Weekly sync meeting', 1, 'EXCH'),
+            appointment('Lunch', 2, 'EXCH'),
+        ]
+        org = [
+            appointment('Weekly sync', 1),
+            # Same time, different headline
+            appointment('Dentist', 2),
+        ]
+        calendar.add_events(exch, internal_tag='exch')
+        calendar.add_events(org, internal_tag='org')
+
+        headlines = sorted(event.headline for event in calendar.events)
+        self.assertEqual(headlines, ['Dentist', 'Lunch', 'Weekly sync'])
+        self.assertIs(calendar.duplicate_of(exch[0]), org[0])
+        self.assertEqual(calendar.get_tagged(['exch']), [exch[1]])
+
+        # Not preferred source updated - the org copy is kept
+        calendar.update_events(exch, 'exch')
+        headlines = sorted(event.headline for event in calendar.events)
+        self.assertEqual(headlines, ['Dentist', 'Lunch', 'Weekly sync'])
+
+        # Preferred copy removed - the other one is shown again
+        calendar.update_events([], 'org')
+        headlines = sorted(event.headline for event in calendar.events)
+        self.assertEqual(headlines, ['Lunch', 'Weekly sync meeting'])
+        self.assertEqual(len(calendar.get_tagged(['exch'])), 2)
+        self.assertEqual(calendar.hidden, [])
+
+        # Without preferences the first copy is kept
+        calendar = Calendar(agenda_content="", dedup=True)
+        calendar.add_events(exch, internal_tag='exch')
+        calendar.add_events(org, internal_tag='org')
+        self.assertEqual(len(calendar.events), 3)
+        self.assertIs(calendar.duplicate_of(org[0]), exch[0])
+
+        calendar = Calendar(agenda_content="", dedup=False)
+        calendar.add_events(exch, internal_tag='exch')
+        calendar.add_events(org, internal_tag='org')
+        self.assertEqual(len(calendar.events), 4)
+
+        # Events of a shared source are added to calendars of multiple
+        # assistants - bookkeeping of one doesn't affect the other.
+        first = Calendar(agenda_content="", dedup_prefer=['exch'])
+        first.add_events(exch, internal_tag='exch')
+        first.add_events(org, internal_tag='org')
+        self.assertIs(first.duplicate_of(org[0]), exch[0])
+        second = Calendar(agenda_content="")
+        second.add_events(org, internal_tag='shared')
+        self.assertIsNone(second.duplicate_of(org[0]))
+        self.assertEqual(second.source_of(org[0]), 'shared')
+        self.assertEqual(first.source_of(org[0]), 'org')
+        first.update_events([], 'exch')
+        headlines = sorted(event.headline for event in first.events)
+        self.assertEqual(headlines, ['Dentist', 'Weekly sync'])
+
+    def test_status(self):
+        "Test status summary and change listeners"
+        utc = pytz.timezone('UTC')
+        now = utc.localize(dt.datetime(2020, 5, 10, 12, 0))
+        calendar = Calendar(agenda_content="")
+        changes = []
+        calendar.listeners.append(lambda added, removed: changes.append(
+            (len(added), len(removed))))
+
+        def add(headline, date=None, state=None, date_type=DateType.TIMESTAMP):
+            event = Event(headline, state=state)
+            if date is not None:
+                event.add_date(EventDate(date, date_type))
+            events.append(event)
+
+        events = []
+        add('Overdue', now - dt.timedelta(days=3), 'TODO', DateType.SCHEDULED)
+        add('Done', now - dt.timedelta(days=3), EventState('DONE', is_open=False),
+            DateType.SCHEDULED)
+        add('Past meeting', now - dt.timedelta(hours=2))
+        add('Meeting', now + dt.timedelta(hours=2))
+        add('Tomorrow', now + dt.timedelta(days=1), 'TODO', DateType.DEADLINE)
+        add('Later', now + dt.timedelta(days=5))
+        add('Too far', now + dt.timedelta(days=50))
+        add('Undated', state='TODO')
+        add('Note')
+        calendar.update_events(events, 'org')
+        self.assertEqual(changes, [(9, 0)])
+
+        status = calendar.get_status(now + dt.timedelta(days=30), now)
+        self.assertEqual(status['today'], 3)
+        self.assertEqual(status['tomorrow'], 1)
+        self.assertEqual(status['later'], 1)
+        self.assertEqual(status['undated'], 1)
+        self.assertEqual(status['next'].headline, 'Meeting')
+
+        # Unchanged events are kept, listeners see the difference
+        version = calendar.version
+        calendar.update_events(events, 'org')
+        self.assertEqual(calendar.version, version)
+        calendar.update_events(events[:-1], 'org')
+        self.assertEqual(changes[-1], (0, 1))
+        self.assertEqual(len(calendar.events), 8)
+
+        calendar.del_events('org')
+        self.assertEqual(changes[-1], (0, 8))
+        status = calendar.get_status(now + dt.timedelta(days=30), now)
+        self.assertEqual(status['today'], 0)
+        self.assertIsNone(status['next'])
+
+    def test_query(self):
+        "Test query language and plans"
+        now = self.day_starts()
+        events = []
+        for day in range(-3, 10):
+            event = Event('task %d' % day, state='TODO' if day % 2 else 'DONE')
+            event.add_date(EventDate(now + dt.timedelta(days=day),
+                                     DateType.SCHEDULED))
+            if day % 3 == 0:
+                event.add_tags('WORK')
+            event.priority = 'A' if day == 3 else None
+            events.append(event)
+        note = Event('weekly report')
+        note.add_tags('WORK')
+        events.append(note)
+
+        calendar = Calendar(agenda_content="")
+        calendar.add_events(events, internal_tag='org')
+
+        def headlines(text):
+            query = Query(text)
+            return [event.headline for event in query.execute(calendar, now)]
+
+        self.assertEqual(headlines('todo:TODO due:<2d due:>-2d'),
+                         ['task -1', 'task 1'])
+        self.assertEqual(headlines('tag:work todo:open'),
+                         ['task -3', 'task 3', 'task 9'])
+        self.assertEqual(headlines('tag:work prio:A'), ['task 3'])
+        self.assertEqual(headlines('due:overdue todo:done'),
+                         ['task -2', 'task 0'])
+        self.assertEqual(headlines('"weekly report"'), ['weekly report'])
+        self.assertEqual(headlines('weekly tag:WORK'), ['weekly report'])
+
+        # Plans use the cheapest index
+        self.assertEqual(Query('tag:work "task"').plan(calendar).index, 'tag')
+        self.assertEqual(Query('due:today').plan(calendar).index, 'date')
+        plan = Query('"task" prio:A todo:DONE due:>2d').plan(calendar)
+        self.assertEqual(plan.index, 'state')
+        self.assertEqual([repr(term) for term in plan.predicates],
+                         ['prio:A', 'due:>2d', '"task"'])
+
+        # Filtering without indices gives the same results
+        query = Query('tag:work todo:open')
+        self.assertEqual(query.filter(calendar.events, now),
+                         query.execute(calendar, now))
+
+        # Cyclic events are resolved the same way by every index
+        weekly = Event('weekly sync', state='TODO')
+        weekly.add_date(EventDate(now - dt.timedelta(days=2, hours=-10),
+                                  DateType.SCHEDULED, repeater='+1w'))
+        weekly.add_tags('WORK')
+        calendar.add_events([weekly], internal_tag='org')
+        for text in ['due:>1d tag:work todo:TODO', 'due:<3d tag:work todo:TODO',
+                     'due:today tag:work todo:TODO',
+                     'due:<2w due:>1d tag:work todo:TODO']:
+            query = Query(text)
+            results = [
+                [(event.headline, event.relevant_date.sort_date)
+                 for event in query.execute(calendar, now, index)]
+                for index in ['no', 'tag', 'date', 'state']
+            ]
+            for result in results[1:]:
+                self.assertEqual(result, results[0], text)
+        weekly_results = [
+            event.relevant_date.sort_date
+            for event in Query('due:>1d tag:work').execute(calendar, now, 'tag')
+            if event.headline == 'weekly sync'
+        ]
+        self.assertEqual(weekly_results, [now + dt.timedelta(days=5, hours=10)])
+
+        # Unbounded window includes cyclic events
+        self.assertIn(weekly, calendar.get_between(None, None))
+        calendar.del_events('org')
+        calendar.add_events(events, internal_tag='org')
+
+        with self.assertRaises(QueryError):
+            Query('due:soon')
+        with self.assertRaises(QueryError):
+            Query('  ')
+
+        # Queries in agenda
+        calendar = Calendar(agenda_content=
+                            "{% for e in queries['Work'] %}{{ e.headline }};{% endfor %}")
+        calendar.add_events(events, internal_tag='org')
+        agenda = calendar.get_agenda(now, now, False, now,
+                                     queries={'Work': Query('tag:work due:<1w')})
+        self.assertEqual(agenda, 'task -3;task 0;task 3;task 6;')
+
+    def test_trace(self):
+        "Test sampled query tracing"
+        now = self.day_starts()
+        events = []
+        for day in range(-3, 4):
+            event = Event('task %d' % day, state='TODO' if day % 2 else 'DONE')
+            event.add_date(EventDate(now + dt.timedelta(days=day),
+                                     DateType.SCHEDULED))
+            if day > 0:
+                event.add_tags('WORK')
+            events.append(event)
+        calendar = Calendar(agenda_content="")
+        calendar.add_events(events, internal_tag='org')
+        horizon = now - dt.timedelta(days=2)
+
+        # Off by default
+        unfinished = calendar.get_unfinished(horizon, False, now)
+        self.assertEqual([event.headline for event in unfinished], ['task -1'])
+        self.assertEqual(len(calendar.tracer.traces), 0)
+
+        # Selected by name and by query text
+        calendar.tracer = QueryTracer(queries=['unfinished', 'todo:open'])
+        self.assertEqual(calendar.get_unfinished(horizon, False, now),
+                         unfinished)
+        calendar.get_scheduled(now + dt.timedelta(days=1), now)
+        Query('todo:open').execute(calendar, now)
+        Query('tag:work').execute(calendar, now)
+
+        traces = list(calendar.tracer.traces)
+        self.assertEqual([trace.name for trace in traces],
+                         ['unfinished', 'query'])
+        self.assertEqual(traces[0].rejected,
+                         {'before horizon': 1, 'closed': 2})
+        self.assertEqual(traces[0].matched, 1)
+        self.assertEqual(traces[1].detail, 'todo:open')
+        self.assertEqual(traces[1].matched, 4)
+        self.assertTrue(calendar.tracer.summary())
+
+        # Sampled
+        calendar.tracer = QueryTracer(sample=1.0)
+        calendar.get_scheduled(now + dt.timedelta(days=1), now)
+        trace = calendar.tracer.traces[-1]
+        self.assertEqual(trace.rejected, {'in past': 3})
+        self.assertIn('scheduled', trace.describe())
+
+    def test_tiers(self):
+        "Test moving old closed events into the cold tier"
+        now = self.day_starts()
+        events = []
+        for day in range(-30, 10):
+            state = ['TODO', 'DONE', None][day % 3]
+            event = Event('task %d' % day, state=state)
+            event.add_date(EventDate(now + dt.timedelta(days=day),
+                                     DateType.SCHEDULED if state else
+                                     DateType.TIMESTAMP))
+            if day % 2:
+                event.add_tags('WORK')
+            events.append(event)
+        habit = Event('habit', state='DONE')
+        habit.add_date(EventDate(now - dt.timedelta(days=20, hours=-1),
+                                 DateType.SCHEDULED, repeater='+1d'))
+        events.append(habit)
+
+        plain = Calendar(agenda_content="")
+        plain.add_events(events, internal_tag='org')
+        tiered = Calendar(agenda_content="", cold_days=10)
+        self.assertEqual(tiered.demote(now), 0)
+        tiered.add_events(events, internal_tag='org')
+
+        # Closed and state-less events before the cutoff are cold
+        self.assertEqual(len(tiered.cold), 13)
+        self.assertEqual(len(tiered.events) + len(tiered.cold), len(events))
+        self.assertTrue(all(event.state is None or not event.state.is_open
+                            for event in tiered.cold))
+        self.assertNotIn(habit, tiered.cold)
+        self.assertEqual(tiered.count_by_tag(), {'org': len(events)})
+        if columnar.is_available():
+            tiered.use_columnar = True
+            self.assertEqual(tiered.count_by_tag(), {'org': len(events)})
+            tiered.use_columnar = False
+
+        def same(call):
+            "Compare results - occurrences of cyclic events are new objects"
+            def described(cal):
+                return [(event.headline, event.relevant_date.sort_date)
+                        for event in call(cal)]
+            self.assertEqual(described(tiered), described(plain))
+
+        horizon = now - dt.timedelta(days=40)
+        same(lambda cal: cal.get_unfinished(horizon, True, now))
+        same(lambda cal: cal.get_appointments(now, now + dt.timedelta(days=5)))
+        same(lambda cal: cal.get_between(horizon, now))
+        same(lambda cal: cal.get_between(None, now))
+        same(lambda cal: cal.get_by_state(['DONE']))
+        same(lambda cal: cal.get_tagged(['work'], horizon, now))
+        for text in ['todo:done', 'due:overdue', 'tag:work "task"', '"task 2"']:
+            same(lambda cal: Query(text).execute(cal, now))
+
+        # Time passes - only newly old events are moved
+        version = tiered.version
+        self.assertEqual(tiered.demote(now + dt.timedelta(days=3)), 2)
+        self.assertEqual(len(tiered.cold), 15)
+        self.assertGreater(tiered.version, version)
+        self.assertEqual(tiered.demote(now + dt.timedelta(days=3)), 0)
+
+        # Cold events are replaced and removed with their source
+        tiered.update_events(events[:1] + events[2:], 'org')
+        self.assertEqual(len(tiered.cold), 14)
+        tiered.del_events('org')
+        self.assertEqual((tiered.events, tiered.cold), ([], []))
+
     def test_calendar(self):
         "Test calendar behaviour"
         dates = self.create_dates()
@@ -184,6 +648,52 @@ class TestEvent(unittest.TestCase):
                                      relative_to=dates.now)
 
         print("AGENDA:", type(agenda), agenda, "END")
+
+    def test_agenda_cache(self):
+        "Agenda is rendered again only when calendar or minute changes"
+        now = self.day_starts()
+        calendar = Calendar(agenda_content="{{ appointments|length }}")
+        args = (now + dt.timedelta(days=1), now - dt.timedelta(days=1), False)
+
+        version = calendar.version
+        first = calendar.get_agenda(*args, relative_to=now)
+        self.assertIs(calendar.get_agenda(*args, relative_to=now), first)
+        self.assertEqual(first, "0")
+
+        event = Event("Meeting")
+        event.add_date(EventDate(now + dt.timedelta(hours=1), DateType.TIMESTAMP))
+        calendar.add_events([event], 'org')
+        self.assertGreater(calendar.version, version)
+        self.assertEqual(calendar.get_agenda(*args, relative_to=now), "1")
+
+    @unittest.skipIf(not columnar.is_available(), "requires numpy")
+    def test_columnar(self):
+        "Columnar queries return the same events as scanning"
+        dates = self.create_dates()
+        now = dates.now
+        events = []
+        for i, (name, value) in enumerate(sorted(dates.__dict__.items())):
+            if isinstance(value, EventDate):
+                event = Event(name, state=['TODO', None, 'TODO', 'DONE'][i % 4])
+                event.add_date(value)
+                events.append(event)
+        events.append(Event("Date-less", state="TODO"))
+
+        scanned = Calendar(agenda_content="")
+        vectorized = Calendar(agenda_content="", use_columnar=True)
+        for calendar in scanned, vectorized:
+            calendar.add_events(list(events), internal_tag='org')
+
+        since = now - dt.timedelta(days=3)
+        horizon = now + dt.timedelta(days=3)
+        for list_all in True, False:
+            unfinished = vectorized.get_unfinished(since, list_all, now)
+            self.assertTrue(unfinished)
+            self.assertEqual(scanned.get_unfinished(since, list_all, now),
+                             unfinished)
+        self.assertEqual(scanned.get_appointments(since, horizon),
+                         vectorized.get_appointments(since, horizon))
+        self.assertEqual(vectorized.count_by_tag(), {'org': len(events)})
         #self.assertGreaterEqual(len(unfinished), 2)
         #self.assertGreaterEqual(len(scheduled), 0)
         #self.assertGreaterEqual(len(agenda.split('\n')), 5)
@@ -0,0 +1,112 @@
+"""
+Sampled tracing of calendar queries. Disabled by default - when a query is
+selected by name or by the sampling rate, the number of events rejected by
+each predicate and the query time are recorded in memory and can be
+inspected with the `trace' command.
+"""
+
+import random
+import datetime as dt
+from time import monotonic
+from collections import Counter, deque
+
+
+class QueryTrace:
+    "Statistics of a single query execution"
+    def __init__(self, name, detail=None):
+        self.name = name
+        # Eg. text of a query
+        self.detail = detail
+        self.started = dt.datetime.now()
+        self._start = monotonic()
+
+        # Rejection reason (predicate) -> number of events
+        self.rejected = Counter()
+        # How events were fetched: scan, columnar or an index name
+        self.path = None
+        self.scanned = 0
+        self.matched = 0
+        self.duration = None
+
+    def reject(self, reason):
+        "Count an event rejected by a predicate"
+        self.rejected[reason] += 1
+
+    def finish(self, path, scanned, matched):
+        "Record results and measure the query time"
+        self.duration = monotonic() - self._start
+        self.path = path
+        self.scanned = scanned
+        self.matched = matched
+
+    def describe(self):
+        "Single line description"
+        name = self.name
+        if self.detail:
+            name += " '%s'" % self.detail
+        rejected = ", ".join("%s: %d" % item
+                             for item in self.rejected.most_common())
+        return "%s %s via %s: %d/%d in %.2fms%s" % (
+            self.started.strftime("%H:%M:%S"), name, self.path,
+            self.matched, self.scanned, self.duration * 1000,
+            " (rejected %s)" % rejected if rejected else "")
+
+
+class QueryTracer:
+    """
+    Decide which queries are traced and keep their recent traces.
+
+    Queries are selected by name (eg. unfinished, scheduled, query) or by
+    query text, others are sampled with a given probability.
+    """
+    def __init__(self, sample=0.0, queries=(), keep=50):
+        self.sample = sample
+        self.queries = set(queries)
+        self.traces = deque(maxlen=keep)
+        self.random = random.Random()
+
+    @property
+    def enabled(self):
+        "Can any query be traced?"
+        return bool(self.sample or self.queries)
+
+    def start(self, name, detail=None):
+        "Return a new trace if the query should be traced or None"
+        if not self.sample and not self.queries:
+            return None
+        if name not in self.queries and detail not in self.queries:
+            if self.random.random() >= self.sample:
+                return None
+        return QueryTrace(name, detail)
+
+    def finish(self, trace, path, scanned, matched):
+        "Finish and store a trace"
+        trace.finish(path, scanned, matched)
+        self.traces.append(trace)
+
+    def clear(self):
+        "Forget recorded traces"
+        self.traces.clear()
+
+    def summary(self):
+        "Lines aggregating recorded traces by query name"
+        traces = list(self.traces)
+        by_name = {}
+        for trace in traces:
+            by_name.setdefault(trace.name, []).append(trace)
+
+        lines = []
+        for name, group in sorted(by_name.items()):
+            durations = [trace.duration for trace in group]
+            rejected = Counter()
+            for trace in group:
+                rejected.update(trace.rejected)
+            line = "%s: %d traced, avg %.2fms, max %.2fms, %.1f/%.1f matched" % (
+                name, len(group),
+                sum(durations) / len(group) * 1000, max(durations) * 1000,
+                sum(trace.matched for trace in group) / len(group),
+                sum(trace.scanned for trace in group) / len(group))
+            lines.append(line)
+            for reason, count in rejected.most_common():
+                lines.append("  %s: %d" % (reason, count))
+        return lines
@@ -27,7 +27,7 @@ class Config:
     def from_file(path):
         "Create a config by reading a file"
         with open(path) as handler:
-            data = yaml.load(handler)
+            data = yaml.safe_load(handler)
         return Config(data, path=path)
 
     @staticmethod
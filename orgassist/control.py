@@ -0,0 +1,188 @@
+"""
+Control socket of a running daemon - a Unix socket with a line protocol for
+status bars and local scripts:
+
+    $ echo status | socat - UNIX-CONNECT:~/.org/orgassist.ctl
+    2->1-->5 3 | 14:00 Meeting
+
+Each request is a single line: a command and optional arguments. Each
+response is a single line; failures start with "ERR ". Connections can be
+kept open and polled.
+
+Editors can report saved files, so they are reflected immediately, eg. in
+Emacs:
+
+    (add-hook 'after-save-hook
+              (lambda ()
+                (when (derived-mode-p 'org-mode)
+                  (call-process "sh" nil 0 nil "-c"
+                                (concat "echo reparse "
+                                        (shell-quote-argument buffer-file-name)
+                                        " | socat - UNIX-CONNECT:$HOME/.org/orgassist.ctl")))))
+"""
+
+import os
+import threading
+import socketserver
+
+from orgassist import log
+from orgassist.helpers.sockets import remove_stale_socket
+
+
+class ControlError(Exception):
+    "Command failed - message is sent to the client"
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    "Answer request lines until the client disconnects"
+
+    # Idle connections are closed after this many seconds
+    timeout = 300
+
+    def handle(self):
+        try:
+            for raw in self.rfile:
+                line = raw.decode('utf-8', 'replace').strip()
+                if not line:
+                    continue
+                response = self.server.control.execute(line)
+                self.wfile.write(response.encode('utf-8') + b'\n')
+                self.wfile.flush()
+        except (TimeoutError, ConnectionError):
+            pass
+
+
+class ControlSocketServer(socketserver.ThreadingMixIn,
+                          socketserver.UnixStreamServer):
+    "Threaded server on a Unix socket accessible only by the owner"
+    daemon_threads = True
+
+    def server_bind(self):
+        "Remove a stale socket and restrict access"
+        remove_stale_socket(self.server_address)
+        super().server_bind()
+        os.chmod(self.server_address, 0o600)
+
+
+class ControlServer:
+    """
+    Dispatch control socket commands to registered callbacks. Callbacks are
+    called with the rest of the line and return a response line. They run
+    in connection threads - they should only read precomputed data or hand
+    work over to the main loop (see call_in_main_loop).
+    """
+    def __init__(self, path):
+        self.path = path
+        # command -> callback(rest of line)
+        self.commands = {}
+        # Bound only when started - a second instance (eg. --test) doesn't
+        # touch the socket of a running daemon
+        self.server = ControlSocketServer(path, ControlHandler,
+                                          bind_and_activate=False)
+        self.server.control = self
+        self.bound = False
+        self.thread = None
+
+    def register(self, command, callback):
+        "Register a command callback"
+        if command in self.commands:
+            raise Exception("Control command '%s' already registered" % command)
+        self.commands[command] = callback
+
+    def execute(self, line):
+        "Execute a request line and return the response line"
+        command, _, rest = line.partition(' ')
+        callback = self.commands.get(command)
+        if callback is None:
+            return "ERR unknown command '%s'" % command
+        try:
+            response = callback(rest.strip())
+        except ControlError as ex:
+            return "ERR %s" % ex
+        except Exception:
+            log.exception("Control command %r failed", line)
+            return "ERR internal error"
+        # Keep the protocol line-based
+        return response.replace('\n', ' ')
+
+    def start(self):
+        """
+        Bind the socket and serve in a background thread. Raise SocketInUse
+        if other process listens on it.
+        """
+        self.server.server_bind()
+        self.bound = True
+        self.server.server_activate()
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='control', daemon=True)
+        self.thread.start()
+        log.info("Control socket listening on %s", self.path)
+
+    def close(self):
+        "Stop serving and remove the socket"
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread = None
+        self.server.server_close()
+        if self.bound and os.path.exists(self.path):
+            os.unlink(self.path)
+        self.bound = False
+
+
+def find_assistant(assistants, name):
+    "Pick assistant by name or the first one"
+    if name:
+        for assistant in assistants:
+            if assistant.assistant_name == name:
+                return assistant
+        raise ControlError("unknown assistant '%s'" % name)
+    if not assistants:
+        raise ControlError("no assistants")
+    return assistants[0]
+
+
+def call_in_main_loop(scheduler, func, timeout=10):
+    """
+    Run func as a scheduler job (woken main loop runs it immediately) and
+    wait for its result. Plugins are not thread-safe.
+    """
+    try:
+        return scheduler.call(func, timeout)
+    except TimeoutError:
+        raise ControlError("timeout - main loop is busy")
+    except Exception as ex:
+        log.exception("Control job failed")
+        raise ControlError(str(ex))
+
+
+def register_commands(control, assistants, scheduler):
+    "Register default commands working on assistants"
+    def status(rest):
+        "Precomputed status line of an assistant"
+        assistant = find_assistant(assistants, rest)
+        line = assistant.state.get('status')
+        if line is None:
+            raise ControlError("no status - calendar plugin is not enabled")
+        return line
+
+    def reparse(rest):
+        "Parse a saved org file again"
+        if not rest:
+            raise ControlError("usage: reparse <path>")
+        path = os.path.abspath(os.path.expanduser(rest))
+
+        def run():
+            # Assistants sharing org files share one parse
+            sources = {}
+            for assistant in assistants:
+                plugin = assistant.plugins.get('org')
+                if plugin is not None:
+                    sources.setdefault(id(plugin.source), plugin)
+            return sum(plugin.reparse(path) for plugin in sources.values())
+
+        if not call_in_main_loop(scheduler, run):
+            raise ControlError("not an org file of any assistant: %s" % path)
+        return "OK"
+
+    control.register('status', status)
+    control.register('reparse', reparse)
@@ -2,4 +2,9 @@
 from .templates import get_template
 from .templates import get_default_template
 from .time import Time
+from .stats import Stats, PhaseTrace
+from .scheduler import Scheduler
+from .metrics import MetricsExporter
+from .journal import NotificationJournal, notice_key
 from . import language
+from . import sources
@@ -0,0 +1,193 @@
+"""
+Append-only journal of scheduled and sent notifications.
+
+Notification scanning keeps a position for each notify period. Without a
+journal the positions are reset to "now" on start, so notices between the
+last position and the restart are lost. The journal records positions and
+notices (as JSON lines) and is replayed on start:
+
+- positions resume where they were left,
+- notices scheduled but not sent before the restart rewind the position, so
+  they are scheduled again,
+- sent notices are remembered and never sent twice.
+
+The file is compacted on each start - only records which still matter are
+kept, so it never needs to be scanned for long.
+"""
+
+import os
+import json
+import tempfile
+import datetime as dt
+
+from orgassist import log
+
+
+def notice_key(event, period):
+    """
+    Identify a notice about an event for a given notify period. The source
+    is not a part of the key - a copy of a merged duplicate from a different
+    source is the same notice.
+    """
+    return '%d|%s|%s' % (period,
+                         event.relevant_date.sort_date.isoformat(),
+                         event.headline)
+
+
+class NotificationJournal:
+    "Journal of notification positions and notices stored in a file"
+
+    # Compact the file after this number of appended records
+    COMPACT_AFTER = 1000
+
+    def __init__(self, path):
+        self.path = path
+
+        # period -> last scanned position
+        self.positions = {}
+        # key -> (period, event date) of scheduled, but unsent notices
+        self.pending = {}
+        # key -> event date of sent notices
+        self.sent = {}
+
+        self._handle = None
+        self._appended = 0
+
+    def replay(self, now):
+        """
+        Read the journal file and compact it. Pending notices of events
+        which already started are dropped.
+        """
+        try:
+            with open(self.path) as handle:
+                for number, line in enumerate(handle, 1):
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError):
+                        # Possibly a partial write during a crash
+                        log.warning("Ignoring broken journal line %d in %s",
+                                    number, self.path)
+        except FileNotFoundError:
+            pass
+
+        for key, (_, date) in list(self.pending.items()):
+            if date <= now:
+                log.warning("Notice %s was not sent before the event started",
+                            key)
+                del self.pending[key]
+        self.compact()
+
+    def _apply(self, record):
+        "Apply a single journal record"
+        kind = record['type']
+        if kind == 'position':
+            self.positions[record['period']] = self._parse(record['position'])
+        elif kind == 'scheduled':
+            self.pending[record['key']] = (record['period'],
+                                           self._parse(record['date']))
+        elif kind == 'sent':
+            self.pending.pop(record['key'], None)
+            self.sent[record['key']] = self._parse(record['date'])
+        elif kind == 'cancelled':
+            self.pending.pop(record['key'], None)
+
+    @staticmethod
+    def _parse(value):
+        "Parse ISO datetime"
+        return dt.datetime.fromisoformat(value)
+
+    def resume_position(self, period):
+        """
+        Return a position from which notifications for a period should be
+        scanned again or None when the journal doesn't know the period.
+        """
+        position = self.positions.get(period)
+        for pending_period, date in self.pending.values():
+            if pending_period != period:
+                continue
+            # Scanning skips events at the window start - go just before.
+            date -= dt.timedelta(microseconds=1)
+            if position is None or date < position:
+                position = date
+        return position
+
+    def was_sent(self, key):
+        "Was the notice already sent?"
+        return key in self.sent
+
+    def _append(self, record):
+        "Append a record to the journal file"
+        self._apply(record)
+        if self._handle is None:
+            self._handle = open(self.path, 'a')
+        self._handle.write(json.dumps(record) + '\n')
+        self._handle.flush()
+        self._appended += 1
+        if self._appended >= self.COMPACT_AFTER:
+            self.compact()
+
+    def position(self, period, position):
+        "Record a new scan position for a period"
+        if self.positions.get(period) == position:
+            return
+        self._append({'type': 'position', 'period': period,
+                      'position': position.isoformat()})
+
+    def scheduled(self, key, period, date):
+        "Record a scheduled notice"
+        self._append({'type': 'scheduled', 'key': key, 'period': period,
+                      'date': date.isoformat()})
+
+    def notice_sent(self, key, date):
+        "Record a sent notice"
+        self._append({'type': 'sent', 'key': key, 'date': date.isoformat()})
+
+    def cancelled(self, key):
+        "Record a notice cancelled before it was sent (eg. event removed)"
+        if key in self.pending:
+            self._append({'type': 'cancelled', 'key': key})
+
+    def compact(self):
+        """
+        Rewrite the journal with records which still matter: positions,
+        pending notices and sent notices not older than the oldest position.
+        """
+        positions = [self.resume_position(period) for period in self.positions]
+        oldest = min(positions) if positions else None
+        self.sent = {
+            key: date
+            for key, date in self.sent.items()
+            if oldest is None or date > oldest
+        }
+
+        records = [
+            {'type': 'position', 'period': period,
+             'position': position.isoformat()}
+            for period, position in sorted(self.positions.items())
+        ]
+        records += [
+            {'type': 'scheduled', 'key': key, 'period': period,
+             'date': date.isoformat()}
+            for key, (period, date) in sorted(self.pending.items())
+        ]
+        records += [
+            {'type': 'sent', 'key': key, 'date': date.isoformat()}
+            for key, date in sorted(self.sent.items())
+        ]
+
+        self.close()
+        self._appended = 0
+
+        directory = os.path.dirname(self.path) or '.'
+        handle, tmp_path = tempfile.mkstemp(prefix='.orgassist-journal-',
+                                            dir=directory)
+        with os.fdopen(handle, 'w') as tmp:
+            for record in records:
+                tmp.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        "Close the journal file"
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
@@ -9,6 +9,7 @@ _templates = {
     ],
     'NO_CONTEXT': "No active context to quit.",
     'QUIT_CONTEXT': "Out of context: {}",
+    'BUSY': "I'm busy right now, try again in a moment.",
 }
 
 def get(key):
@@ -0,0 +1,73 @@
+"""
+Export metrics in the Prometheus text format into a file read by the
+node-exporter textfile collector.
+
+Metric samples are tuples: (name, {label: value}, value). Names ending with
+_total are exported as counters, all others as gauges.
+"""
+
+import os
+import tempfile
+
+from orgassist import log
+
+
+def _escape(value):
+    "Escape label value"
+    value = str(value)
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_samples(samples):
+    "Format samples grouped by metric name in a Prometheus text format"
+    grouped = {}
+    for name, labels, value in samples:
+        grouped.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(grouped):
+        kind = 'counter' if name.endswith('_total') else 'gauge'
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in grouped[name]:
+            if labels:
+                label_str = ','.join('%s="%s"' % (key, _escape(labels[key]))
+                                     for key in sorted(labels))
+                lines.append('%s{%s} %s' % (name, label_str, value))
+            else:
+                lines.append('%s %s' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    """
+    Gathers samples from sources (callables returning a list of samples)
+    and atomically replaces the metrics file.
+    """
+    def __init__(self, path, sources):
+        self.path = path
+        self.sources = sources
+
+    def gather(self):
+        "Gather samples from all sources"
+        samples = []
+        for source in self.sources:
+            samples += source()
+        return samples
+
+    def write(self):
+        "Write metrics file - temporary file and rename, so no partial reads"
+        content = format_samples(self.gather())
+        directory = os.path.dirname(self.path) or '.'
+        handle, tmp_path = tempfile.mkstemp(prefix='.orgassist-metrics-',
+                                            dir=directory)
+        try:
+            with os.fdopen(handle, 'w') as tmp:
+                tmp.write(content)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            log.exception("Unable to write metrics file %s", self.path)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
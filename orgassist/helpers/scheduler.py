@@ -0,0 +1,406 @@
+"""
+Scheduler shared by all assistants, instrumented with timing statistics.
+
+Supports the subset of the `schedule' library API used by plugins:
+
+    scheduler.every(30).seconds.do(func, *args, **kwargs)
+    scheduler.every().day.at('07:00').do(func)
+
+and one-shot jobs which are removed after they run:
+
+    scheduler.once(120).do(func)
+
+Jobs are kept in a heap ordered by the next run, so adding and running a job
+costs O(log n) and the next wakeup is known in O(1). Cancelled jobs are
+removed lazily - heap entries which don't match the job's current entry are
+skipped.
+
+Jobs can be added from other threads (bots, control socket); the main loop
+sleeping in `wait' is woken up when such a job should run before the first
+scheduled one, so it runs without delay.
+"""
+
+import heapq
+import threading
+import functools
+import itertools
+import datetime as dt
+from time import monotonic, time
+from collections import namedtuple
+
+from orgassist import log
+
+from .stats import Stats, format_duration
+
+# Main loop was not running: since (naive local datetime), duration in
+# seconds and a kind - 'suspend' (wall clock jumped, monotonic didn't) or
+# 'hang' (eg. a long blocking job).
+Stall = namedtuple('Stall', 'since, duration, kind')
+
+
+class ScheduleValueError(ValueError):
+    "Invalid job specification"
+
+
+class CancelJob:
+    "Return this class from a periodic job to cancel it"
+
+
+def job_name(job):
+    "Human readable name of a scheduled job, eg. OrgPlugin.refresh_db"
+    func = getattr(job.job_func, 'func', job.job_func)
+    return getattr(func, '__qualname__', repr(func))
+
+
+class Job:
+    """
+    Periodic or one-shot job. Created by Scheduler.every/once and added to
+    the scheduler by calling `do'.
+    """
+    UNITS = {
+        'seconds': 1,
+        'minutes': 60,
+        'hours': 60 * 60,
+        'days': 24 * 60 * 60,
+        'weeks': 7 * 24 * 60 * 60,
+    }
+
+    def __init__(self, interval, scheduler, one_shot=False):
+        self.interval = interval
+        self.scheduler = scheduler
+        self.one_shot = one_shot
+        self.unit = 'seconds' if one_shot else None
+        self.at_time = None
+        self.job_func = None
+        self.next_run = None
+        self.last_run = None
+        # Sequence number of the current heap entry, None when not scheduled
+        self.entry = None
+
+    def _set_unit(self, unit):
+        "Set unit of the interval"
+        self.unit = unit
+        return self
+
+    # Singular forms are equivalent, eg. every().day
+    second = seconds = property(lambda self: self._set_unit('seconds'))
+    minute = minutes = property(lambda self: self._set_unit('minutes'))
+    hour = hours = property(lambda self: self._set_unit('hours'))
+    day = days = property(lambda self: self._set_unit('days'))
+    week = weeks = property(lambda self: self._set_unit('weeks'))
+
+    def at(self, time_str):
+        "Run daily job at a given time of day (H:MM, HH:MM or HH:MM:SS)"
+        if self.unit != 'days':
+            raise ScheduleValueError("Time of day can be used only with days")
+        parts = time_str.split(':')
+        if (len(parts) not in (2, 3) or
+                not all(part.isdigit() and len(part) <= 2 for part in parts) or
+                any(len(part) != 2 for part in parts[1:])):
+            raise ScheduleValueError("Invalid time format '%s'" % time_str)
+        hour, minute = int(parts[0]), int(parts[1])
+        second = int(parts[2]) if len(parts) == 3 else 0
+        if hour > 23 or minute > 59 or second > 59:
+            raise ScheduleValueError("Invalid time '%s'" % time_str)
+        self.at_time = dt.time(hour, minute, second)
+        return self
+
+    def do(self, job_func, *args, **kwargs):
+        "Set the function to run and add the job to the scheduler"
+        if self.unit is None:
+            raise ScheduleValueError("Unit of the interval was not given")
+        self.job_func = functools.partial(job_func, *args, **kwargs)
+        self._schedule_next(dt.datetime.now())
+        self.scheduler.add(self)
+        return self
+
+    @property
+    def period(self):
+        "Interval as a timedelta"
+        return dt.timedelta(seconds=self.interval * self.UNITS[self.unit])
+
+    def _schedule_next(self, now):
+        "Compute the next run"
+        if self.at_time is None:
+            self.next_run = now + self.period
+            return
+        if self.next_run is None:
+            next_run = dt.datetime.combine(now.date(), self.at_time)
+            if next_run <= now:
+                next_run += dt.timedelta(days=1)
+        else:
+            next_run = self.next_run + self.period
+            # Skip runs missed eg. during a suspend
+            while next_run <= now:
+                next_run += self.period
+        self.next_run = next_run
+
+    def run(self):
+        "Run the job, return True if it should run again"
+        try:
+            ret = self.job_func()
+        finally:
+            # Failed periodic jobs run again at their next time
+            self.last_run = dt.datetime.now()
+            if not self.one_shot:
+                self._schedule_next(self.last_run)
+        if self.one_shot or ret is CancelJob or isinstance(ret, CancelJob):
+            return False
+        return True
+
+    def __lt__(self, other):
+        return self.next_run < other.next_run
+
+    def __repr__(self):
+        kind = 'once' if self.one_shot else 'every %s %s' % (self.interval,
+                                                             self.unit)
+        at_time = ' at %s' % self.at_time if self.at_time else ''
+        return '<Job %s%s do %s next=%s>' % (kind, at_time,
+                                             job_name(self) if self.job_func else None,
+                                             self.next_run)
+
+
+class Scheduler:
+    """
+    Heap-based scheduler which measures duration of each job and how late it
+    was executed compared to the time it was planned for.
+    """
+    # Main loop iteration longer than expected by this number of seconds is
+    # considered a stall.
+    STALL_THRESHOLD = 60
+
+    def __init__(self):
+        # Heap of (next_run, sequence, job)
+        self._heap = []
+        self._sequence = itertools.count()
+        # Jobs which are scheduled and not cancelled
+        self._live = set()
+
+        self.stats = Stats()
+
+        # Called with a Stall before overdue jobs are executed
+        self.stall_handlers = []
+        self._last_check = None
+
+        # Guards the heap; set when another thread adds a job which should
+        # run before the current first one
+        self._lock = threading.RLock()
+        self._wakeup = threading.Event()
+        # Thread running jobs (main loop) - it doesn't need to be woken up
+        self._runner = None
+
+    def every(self, interval=1):
+        "Create a periodic job - set its unit and call `do' to add it"
+        return Job(interval, self)
+
+    def once(self, delay):
+        "Create a one-shot job run after `delay' seconds"
+        return Job(delay, self, one_shot=True)
+
+    def add(self, job):
+        "Add a job with computed next_run (or reschedule it)"
+        with self._lock:
+            head = self._peek()
+            job.entry = next(self._sequence)
+            self._live.add(job)
+            heapq.heappush(self._heap, (job.next_run, job.entry, job))
+        # The main loop computes its sleep after running jobs
+        if threading.get_ident() == self._runner:
+            return
+        if head is None or head is job or job.next_run < head.next_run:
+            self._wakeup.set()
+
+    def call(self, func, timeout=10):
+        """
+        Run func in the main loop (as a job due immediately) and wait for its
+        result. Used by bot and control threads - plugins are not
+        thread-safe. Exceptions of func are raised here, TimeoutError if the
+        main loop is busy for too long (func might still run later).
+
+        Called from the main loop itself func is run directly.
+        """
+        if threading.get_ident() == self._runner:
+            return func()
+        done = threading.Event()
+        result = {}
+
+        def call_job():
+            try:
+                result['value'] = func()
+            except Exception as ex:
+                result['error'] = ex
+            finally:
+                done.set()
+
+        job = self.once(0).do(call_job)
+        if not done.wait(timeout):
+            self.cancel_job(job)
+            raise TimeoutError("Main loop is busy")
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    def wait(self, timeout):
+        """
+        Sleep up to timeout seconds - return earlier when a job is added
+        meanwhile.
+        """
+        woken = self._wakeup.wait(timeout)
+        self._wakeup.clear()
+        return woken
+
+    @staticmethod
+    def _is_stale(item):
+        "Is the heap entry cancelled or replaced?"
+        return item[1] != item[2].entry
+
+    def cancel_job(self, job):
+        "Cancel job - it's removed from the heap lazily"
+        with self._lock:
+            self._cancel_job(job)
+
+    def _cancel_job(self, job):
+        "Cancel job holding the lock"
+        if job in self._live:
+            self._live.remove(job)
+            job.entry = None
+            # Don't let cancelled jobs pile up
+            if len(self._heap) > 2 * len(self._live) + 16:
+                self._heap = [item for item in self._heap
+                              if not self._is_stale(item)]
+                heapq.heapify(self._heap)
+
+    def clear(self):
+        "Remove all jobs"
+        with self._lock:
+            for job in self._live:
+                job.entry = None
+            self._live = set()
+            self._heap = []
+
+    @property
+    def jobs(self):
+        "List of scheduled jobs"
+        with self._lock:
+            return list(self._live)
+
+    def _peek(self):
+        "Return the first job to run (or None) dropping stale entries"
+        while self._heap and self._is_stale(self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][2] if self._heap else None
+
+    @property
+    def next_run(self):
+        "Time of the next job run or None"
+        with self._lock:
+            job = self._peek()
+            return job.next_run if job is not None else None
+
+    @property
+    def idle_seconds(self):
+        "Seconds until the next job should run (negative if late) or None"
+        next_run = self.next_run
+        if next_run is None:
+            return None
+        return (next_run - dt.datetime.now()).total_seconds()
+
+    def run_pending(self):
+        """
+        Run all jobs which are due. Jobs added meanwhile (even if due) are
+        run on the next call.
+        """
+        self._runner = threading.get_ident()
+        now = dt.datetime.now()
+        due = []
+        with self._lock:
+            while True:
+                job = self._peek()
+                if job is None or job.next_run > now:
+                    break
+                heapq.heappop(self._heap)
+                due.append((job, job.entry))
+
+        for i, (job, entry) in enumerate(due):
+            # Could be cancelled by a previous job
+            if job.entry != entry:
+                continue
+            try:
+                self._run_job(job)
+            except Exception:
+                # Put back the remaining due jobs - they run on the next call
+                with self._lock:
+                    for job, entry in due[i + 1:]:
+                        if job.entry == entry:
+                            heapq.heappush(self._heap,
+                                           (job.next_run, entry, job))
+                raise
+
+    def run_all(self):
+        "Run all jobs regardless of their schedule"
+        for job in sorted(self.jobs):
+            if job.entry is not None:
+                self._run_job(job)
+
+    def _run_job(self, job):
+        "Run a job and schedule it again if it's periodic"
+        name = job_name(job)
+        entry = job.entry
+        lateness = (dt.datetime.now() - job.next_run).total_seconds()
+        self.stats.record('scheduler.lateness', max(0, lateness))
+
+        start = monotonic()
+        # A failing periodic job is scheduled again - the exception is
+        # propagated to the main loop.
+        again = not job.one_shot
+        try:
+            again = job.run()
+        finally:
+            self.stats.record('job.' + name, monotonic() - start)
+
+            with self._lock:
+                if job.entry != entry:
+                    # Cancelled (or rescheduled) by itself
+                    pass
+                elif again:
+                    self.add(job)
+                else:
+                    self._live.discard(job)
+                    job.entry = None
+                self.stats.set('scheduler.jobs', len(self._live))
+
+    def check_stall(self, expected=0):
+        """
+        Detect a stall of the main loop - call it after each sleep with the
+        expected sleep duration. Compares wall clock with a monotonic clock
+        which doesn't advance during suspend.
+        """
+        wall, mono = time(), monotonic()
+        last, self._last_check = self._last_check, (wall, mono)
+        if last is None:
+            return None
+
+        wall_elapsed = wall - last[0]
+        mono_elapsed = mono - last[1]
+        late = wall_elapsed - expected
+        if late < self.STALL_THRESHOLD:
+            return None
+
+        if wall_elapsed - mono_elapsed >= self.STALL_THRESHOLD:
+            kind = 'suspend'
+        else:
+            kind = 'hang'
+        stall = Stall(since=dt.datetime.fromtimestamp(last[0]),
+                      duration=late, kind=kind)
+        log.warning("Main loop stalled (%s) for %s", kind,
+                    format_duration(late))
+        self.stats.incr('scheduler.stalls')
+        for handler in self.stall_handlers:
+            handler(stall)
+        return stall
+
+    def get_metrics(self):
+        "Number of jobs waiting in the scheduler"
+        return [
+            ('orgassist_scheduler_jobs', {}, len(self._live)),
+        ]
@@ -0,0 +1,40 @@
+"""
+Unix sockets of local interfaces (control socket, HTTP). A socket file
+left by a crashed daemon is removed; a live one is never taken over.
+"""
+
+import os
+import stat
+import errno
+import socket
+
+
+class SocketInUse(Exception):
+    "Other process (eg. a running daemon) listens on the address"
+
+
+def remove_stale_socket(path):
+    """
+    Remove a Unix socket nobody listens on. Raise SocketInUse if it's
+    accepting connections or the path is not a socket.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise SocketInUse("%s exists and is not a socket" % path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as ex:
+        if ex.errno == errno.ENOENT:
+            return
+        if ex.errno == errno.ECONNREFUSED:
+            os.unlink(path)
+            return
+        raise
+    finally:
+        sock.close()
+    raise SocketInUse("%s is in use - is orgassist already running?" % path)
@@ -0,0 +1,117 @@
+"""
+Process-wide registry of event sources shared between assistants.
+
+Two assistants configured with the same org directory or the same Exchange
+mailbox use a single SharedSource - data is parsed/fetched once and the
+immutable result is published to calendars of all subscribed assistants.
+"""
+
+import threading
+from time import monotonic
+
+
+def make_key(kind, config):
+    """
+    Create a hashable, normalized key out of a source kind and a dictionary
+    with its configuration.
+    """
+    def normalize(value):
+        "Recursively convert value into a hashable form"
+        if isinstance(value, dict):
+            return tuple(sorted((key, normalize(val))
+                                for key, val in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(normalize(val) for val in value)
+        if isinstance(value, (set, frozenset)):
+            return tuple(sorted(normalize(val) for val in value))
+        if value is None or isinstance(value, (str, int, float, bool)):
+            return value
+        return str(value)
+    return (kind, normalize(config))
+
+
+class SharedSource:
+    """
+    Loads the data once for all subscribers.
+
+    Loader is a callable returning an immutable result (or None on a
+    transient error, which is not published).
+    """
+    def __init__(self, key, loader):
+        self.key = key
+        self.loader = loader
+
+        self.result = None
+        self.loaded_at = None
+        self.generation = 0
+        # Did the last load fail (loader returned None)?
+        self.failed = False
+
+        self.subscribers = []
+        # Refresh can be triggered by a scheduler and by a bot thread.
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        "Subscribe to results. Receive the current result immediately."
+        self.subscribers.append(callback)
+        if self.result is not None:
+            callback(self.result)
+
+    def is_fresh(self, max_age):
+        "Was the result loaded less than max_age seconds ago?"
+        if self.result is None or not max_age:
+            return False
+        return monotonic() - self.loaded_at < max_age
+
+    def refresh(self, max_age=0, **kwargs):
+        """
+        Reload data unless it's fresher than max_age seconds and publish it
+        to all subscribers. Return the current result - the previous one if
+        the load failed (see `failed').
+
+        Additional keyword arguments are passed to the loader.
+        """
+        with self._lock:
+            if self.is_fresh(max_age):
+                return self.result
+
+            result = self.loader(**kwargs)
+            self.failed = result is None
+            if result is None:
+                return self.result
+
+            self.result = result
+            self.loaded_at = monotonic()
+            self.generation += 1
+            subscribers = list(self.subscribers)
+
+        for callback in subscribers:
+            callback(result)
+        return result
+
+
+class SourceRegistry:
+    "Registry of shared sources keyed by normalized configuration"
+    def __init__(self):
+        self.sources = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """
+        Return a shared source for a given key. Loader is used only when the
+        source gets created.
+        """
+        with self._lock:
+            source = self.sources.get(key)
+            if source is None:
+                source = self.sources[key] = SharedSource(key, loader)
+            return source
+
+    def clear(self):
+        "Forget all sources"
+        with self._lock:
+            self.sources = {}
+
+
+# Process-wide registry
+registry = SourceRegistry()
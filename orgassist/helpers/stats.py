@@ -0,0 +1,202 @@
+"""
+Lightweight runtime statistics: timing histograms of commands and scheduled
+jobs, counters and gauges. Cheap enough to be always enabled.
+"""
+
+import threading
+from time import monotonic
+from contextlib import contextmanager
+
+
+def format_duration(seconds):
+    "Format duration in a short human readable way"
+    if seconds < 1:
+        return '%.1fms' % (seconds * 1000)
+    return '%.2fs' % seconds
+
+
+class Histogram:
+    """
+    Keep count, total, extremes and a fixed log-scale buckets of durations.
+    """
+    # Upper bounds of buckets in seconds. Last bucket is unbounded.
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(self.BUCKETS) + 1)
+
+    def add(self, value):
+        "Add a single measurement"
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    @property
+    def average(self):
+        "Average value or None when empty"
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, fraction):
+        """
+        Estimate a percentile as the upper bound of a bucket which contains
+        it. Percentiles within the last (unbounded) bucket return maximum.
+        """
+        if not self.count:
+            return None
+        needed = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets[:-1]):
+            seen += count
+            if seen >= needed:
+                return min(self.BUCKETS[i], self.max)
+        return self.max
+
+    def describe(self):
+        "Describe histogram in a single line"
+        return "n=%d avg=%s p50<=%s p99<=%s max=%s" % (
+            self.count,
+            format_duration(self.average),
+            format_duration(self.percentile(0.5)),
+            format_duration(self.percentile(0.99)),
+            format_duration(self.max),
+        )
+
+
+class Stats:
+    """
+    Registry of named timing histograms, counters and gauges.
+
+    Bots dispatch messages from their own threads, so all updates are
+    guarded by a lock.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        "Record a duration in a named histogram"
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        "Time the execution of a code block"
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, monotonic() - start)
+
+    def incr(self, name, value=1):
+        "Increment a counter"
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        "Set a gauge to a current value"
+        with self._lock:
+            self.gauges[name] = value
+
+    def report(self):
+        "Return a list of lines describing all statistics"
+        with self._lock:
+            lines = [
+                "%s: %s" % (name, histogram.describe())
+                for name, histogram in sorted(self.histograms.items())
+            ]
+            lines += [
+                "%s: %s" % (name, value)
+                for name, value in sorted(self.counters.items())
+            ]
+            lines += [
+                "%s: %s" % (name, value)
+                for name, value in sorted(self.gauges.items())
+            ]
+        return lines
+
+
+class Phase:
+    "Single measured phase of a traced operation"
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.items = None
+
+    def describe(self):
+        "Describe phase in a single line"
+        items = ' (%d items)' % self.items if self.items is not None else ''
+        return "%s: %s%s" % (self.name, format_duration(self.seconds), items)
+
+
+class PhaseTrace:
+    """
+    Trace of a multi-phase operation: duration and item count of each phase
+    and durations of individual items (eg. parsed files).
+    """
+    def __init__(self, name):
+        self.name = name
+        self.phases = []
+        # item -> seconds
+        self.items = {}
+
+    @contextmanager
+    def phase(self, name):
+        "Measure a phase. Set `items' on the yielded phase to count items."
+        phase = Phase(name)
+        start = monotonic()
+        try:
+            yield phase
+        finally:
+            phase.seconds = monotonic() - start
+            self.phases.append(phase)
+
+    def copy(self):
+        "Copy trace so more phases can be added without altering original"
+        trace = PhaseTrace(self.name)
+        trace.phases = list(self.phases)
+        trace.items = self.items
+        return trace
+
+    @property
+    def total(self):
+        "Total duration of all phases"
+        return sum(phase.seconds for phase in self.phases)
+
+    def slowest(self, count=5):
+        "Return `count' slowest items as (item, seconds) tuples"
+        ordered = sorted(self.items.items(), key=lambda item: item[1],
+                         reverse=True)
+        return ordered[:count]
+
+    def describe(self, slowest=5):
+        "Return a list of lines describing the trace"
+        lines = ["%s: %s total" % (self.name, format_duration(self.total))]
+        lines += ["  " + phase.describe() for phase in self.phases]
+        if self.items and slowest:
+            lines.append("  slowest:")
+            lines += [
+                "    %s %s" % (format_duration(seconds), item)
+                for item, seconds in self.slowest(slowest)
+            ]
+        return lines
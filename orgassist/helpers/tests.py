@@ -0,0 +1,278 @@
+import os
+import tempfile
+import threading
+import unittest
+import datetime as dt
+from time import monotonic
+
+import pytz
+
+from .stats import Histogram, Stats, PhaseTrace
+from .metrics import MetricsExporter, format_samples
+from .sources import SourceRegistry, make_key
+from .journal import NotificationJournal
+from .scheduler import Scheduler, CancelJob, ScheduleValueError
+
+class TestStats(unittest.TestCase):
+    "Test timing statistics"
+
+    def test_histogram(self):
+        "Test histogram buckets and percentiles"
+        histogram = Histogram()
+        self.assertIsNone(histogram.percentile(0.5))
+
+        for _ in range(98):
+            histogram.add(0.002)
+        histogram.add(0.3)
+        histogram.add(120)
+
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.min, 0.002)
+        self.assertEqual(histogram.max, 120)
+        self.assertEqual(histogram.percentile(0.5), 0.005)
+        self.assertEqual(histogram.percentile(0.99), 0.5)
+        self.assertEqual(histogram.percentile(1), 120)
+        self.assertIn('n=100', histogram.describe())
+
+    def test_stats(self):
+        "Test stats registry"
+        stats = Stats()
+        with stats.timer('command.agenda'):
+            pass
+        stats.incr('messages')
+        stats.incr('messages', 2)
+        stats.set('events.org', 42)
+
+        self.assertEqual(stats.histograms['command.agenda'].count, 1)
+        self.assertEqual(stats.counters['messages'], 3)
+        report = stats.report()
+        self.assertEqual(len(report), 3)
+        self.assertIn('events.org: 42', report)
+
+    def test_phase_trace(self):
+        "Test phase tracing"
+        trace = PhaseTrace('refresh')
+        with trace.phase('walk') as phase:
+            phase.items = 3
+        with trace.phase('parse'):
+            trace.items.update({'a.org': 0.1, 'b.org': 0.3, 'c.org': 0.2})
+
+        self.assertEqual([phase.name for phase in trace.phases],
+                         ['walk', 'parse'])
+        self.assertEqual(trace.phases[0].items, 3)
+        self.assertEqual(trace.slowest(2), [('b.org', 0.3), ('c.org', 0.2)])
+        lines = trace.describe(slowest=1)
+        self.assertIn('(3 items)', lines[1])
+        self.assertTrue(lines[-1].endswith('b.org'))
+
+
+class TestMetrics(unittest.TestCase):
+    "Test Prometheus metrics export"
+
+    def test_format(self):
+        "Test text format"
+        samples = [
+            ('orgassist_org_nodes', {'assistant': 'main'}, 12),
+            ('orgassist_xmpp_messages_sent_total', {}, 3),
+            ('orgassist_org_parse_seconds', {'file': 'a"b.org'}, 0.5),
+        ]
+        text = format_samples(samples)
+        self.assertIn('# TYPE orgassist_xmpp_messages_sent_total counter', text)
+        self.assertIn('# TYPE orgassist_org_nodes gauge', text)
+        self.assertIn('orgassist_org_nodes{assistant="main"} 12', text)
+        self.assertIn(r'orgassist_org_parse_seconds{file="a\"b.org"} 0.5', text)
+
+    def test_write(self):
+        "Test atomic file write"
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'orgassist.prom')
+            exporter = MetricsExporter(path, [lambda: [('metric', {}, 1)]])
+            exporter.write()
+            exporter.write()
+            self.assertEqual(os.listdir(directory), ['orgassist.prom'])
+            with open(path) as handle:
+                self.assertIn('metric 1', handle.read())
+
+
+class TestSources(unittest.TestCase):
+    "Test sources shared between assistants"
+
+    def test_shared_source(self):
+        "Data is loaded once and published to all subscribers"
+        loads = []
+        def loader():
+            loads.append(1)
+            return (len(loads),)
+
+        registry = SourceRegistry()
+        key = make_key('org', {'base': '/org', 'todos': ['TODO'], 'x': {1, 2}})
+        self.assertEqual(key, make_key('org', {'x': {2, 1}, 'todos': ['TODO'],
+                                               'base': '/org'}))
+
+        first, second = [], []
+        source = registry.get(key, loader)
+        source.subscribe(first.append)
+        self.assertEqual(source.refresh(max_age=60), (1,))
+
+        # Second assistant gets the current result without loading
+        self.assertIs(registry.get(key, loader), source)
+        source.subscribe(second.append)
+        self.assertEqual(source.refresh(max_age=60), (1,))
+        self.assertEqual(len(loads), 1)
+
+        # Forced refresh is published to everyone
+        source.refresh()
+        self.assertEqual(first, [(1,), (2,)])
+        self.assertEqual(second, [(1,), (2,)])
+        self.assertFalse(source.failed)
+
+        # Failed load keeps the previous result and is reported
+        failing = registry.get(make_key('exch', {}), lambda: None)
+        self.assertIsNone(failing.refresh())
+        self.assertTrue(failing.failed)
+        source.loader = lambda: None
+        self.assertEqual(source.refresh(), (2,))
+        self.assertTrue(source.failed)
+        self.assertEqual(first, [(1,), (2,)])
+
+
+class TestJournal(unittest.TestCase):
+    "Test notification journal"
+
+    def test_replay(self):
+        "Journal resumes positions and remembers sent notices"
+        utc = pytz.utc
+        now = utc.localize(dt.datetime(2024, 1, 1, 10, 0))
+        first = now + dt.timedelta(minutes=15)
+        second = now + dt.timedelta(minutes=30)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'journal')
+            journal = NotificationJournal(path)
+            journal.replay(now)
+            self.assertIsNone(journal.resume_position(10))
+
+            journal.scheduled('first', 10, first)
+            journal.scheduled('second', 10, second)
+            journal.position(10, second)
+            journal.notice_sent('first', first)
+            self.assertTrue(journal.was_sent('first'))
+            journal.close()
+            # Partial write during a crash
+            with open(path, 'a') as handle:
+                handle.write('{"type": "sent", "ke')
+
+            # Restart - the second notice was never sent
+            journal = NotificationJournal(path)
+            journal.replay(now + dt.timedelta(minutes=5))
+            self.assertFalse(journal.was_sent('second'))
+            position = journal.resume_position(10)
+            self.assertTrue(first < position < second)
+            # Scanning won't reach the first notice again - compacted
+            self.assertEqual(journal.sent, {})
+            self.assertIsNone(journal.resume_position(30))
+
+            # Restart after the event started - resume from last position
+            journal.close()
+            journal = NotificationJournal(path)
+            journal.replay(second)
+            self.assertEqual(journal.resume_position(10), second)
+            self.assertEqual(journal.pending, {})
+            with open(path) as handle:
+                self.assertEqual(len(handle.readlines()), 1)
+
+
+class TestScheduler(unittest.TestCase):
+    "Test instrumented scheduler"
+
+    def test_stall(self):
+        "Stalls are detected by comparing wall and monotonic clocks"
+        scheduler = Scheduler()
+        stalls = []
+        scheduler.stall_handlers.append(stalls.append)
+        self.assertIsNone(scheduler.check_stall())
+        self.assertIsNone(scheduler.check_stall())
+
+        # Suspended: wall clock jumped, monotonic didn't
+        wall, mono = scheduler._last_check
+        scheduler._last_check = (wall - 3600, mono)
+        stall = scheduler.check_stall(expected=30)
+        self.assertEqual(stall.kind, 'suspend')
+        self.assertAlmostEqual(stall.duration, 3570, delta=1)
+
+        # Long blocking job
+        wall, mono = scheduler._last_check
+        scheduler._last_check = (wall - 600, mono - 600)
+        self.assertEqual(scheduler.check_stall().kind, 'hang')
+        self.assertEqual(len(stalls), 2)
+        self.assertEqual(scheduler.stats.counters['scheduler.stalls'], 2)
+
+    def test_jobs(self):
+        "Test periodic, daily and one-shot jobs"
+        scheduler = Scheduler()
+        calls = []
+        periodic = scheduler.every(60).seconds.do(calls.append, 'periodic')
+        daily = scheduler.every().day.at('7:30').do(calls.append, 'daily')
+        once = scheduler.once(-1).do(calls.append, 'once')
+        cancelled = scheduler.once(-2).do(calls.append, 'cancelled')
+        scheduler.cancel_job(cancelled)
+        self.assertEqual(daily.next_run.time(), dt.time(7, 30))
+        self.assertEqual(len(scheduler.jobs), 3)
+        self.assertLess(scheduler.idle_seconds, 0)
+
+        scheduler.run_pending()
+        self.assertEqual(calls, ['once'])
+        self.assertEqual(set(scheduler.jobs), {periodic, daily})
+        self.assertEqual(scheduler.next_run, periodic.next_run)
+
+        # Periodic jobs are rescheduled, CancelJob removes them
+        periodic.job_func = lambda: CancelJob
+        scheduler.run_all()
+        self.assertEqual(scheduler.jobs, [daily])
+        self.assertIn('daily', calls)
+
+        # Failing periodic job stays scheduled for its next run
+        def fail():
+            raise RuntimeError("Refresh failed")
+        failing = scheduler.every(60).seconds.do(fail)
+        failing.next_run = dt.datetime.now() - dt.timedelta(seconds=1)
+        scheduler.add(failing)
+        with self.assertRaises(RuntimeError):
+            scheduler.run_pending()
+        self.assertIn(failing, scheduler.jobs)
+        self.assertGreater(failing.next_run, dt.datetime.now())
+        self.assertEqual(scheduler.next_run, failing.next_run)
+
+        for time_str in ['25:00', '7:5', 'noon', '07:00:00:00']:
+            with self.assertRaises(ScheduleValueError):
+                scheduler.every().day.at(time_str)
+        with self.assertRaises(ScheduleValueError):
+            scheduler.every(5).seconds.at('07:00')
+
+    def test_wakeup(self):
+        "Adding a job from another thread ends the wait"
+        scheduler = Scheduler()
+        scheduler.wait(0)
+        timer = threading.Timer(0.05, lambda: scheduler.once(0).do(lambda: None))
+        timer.start()
+        start = monotonic()
+        self.assertTrue(scheduler.wait(10))
+        self.assertLess(monotonic() - start, 5)
+        self.assertFalse(scheduler.wait(0.01))
+
+        # Jobs rescheduled or added by the main loop don't wake it up
+        scheduler.every(60).seconds.do(lambda: None)
+        scheduler.run_pending()
+        self.assertFalse(scheduler.wait(0.01))
+        scheduler.once(30).do(lambda: None)
+        self.assertFalse(scheduler.wait(0.01))
+
+        # Other threads wake it up only with a job due before the first one
+        timer = threading.Timer(0, lambda: scheduler.once(120).do(lambda: None))
+        timer.start()
+        timer.join()
+        self.assertFalse(scheduler.wait(0.01))
+        timer = threading.Timer(0, lambda: scheduler.once(1).do(lambda: None))
+        timer.start()
+        timer.join()
+        self.assertTrue(scheduler.wait(0.01))
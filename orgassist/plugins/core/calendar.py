@@ -4,18 +4,30 @@ Glue between a calendar and other plugins and bot commands.
 
 import datetime as dt
 import traceback as tb
-import schedule
 
 from orgassist import log
 from orgassist.assistant import Assistant, AssistantPlugin
-from orgassist.calendar import Calendar
+from orgassist.calendar import Calendar, Query, QueryError
+from orgassist.calendar import columnar
+from orgassist.calendar.trace import QueryTracer
+from orgassist.config import ConfigError
 from orgassist import helpers
+from orgassist.helpers.scheduler import ScheduleValueError, Stall
 
 from .search import SearchContext
 
 @Assistant.plugin('calendar')
 class CalendarCore(AssistantPlugin):
 
+    # Maximal number of events listed by the tag and query commands
+    LIST_LIMIT = 20
+
+    # Seconds between recomputing the status summary without changes
+    STATUS_INTERVAL = 60
+
+    # Seconds between moving old events into the cold tier
+    DEMOTE_INTERVAL = 60 * 60
+
     def initialize(self):
         # Scan calendar periodically and schedule notifications
         self.scheduler.every(self.scan_interval).seconds.do(self.schedule_notifications)
@@ -24,28 +36,84 @@ class CalendarCore(AssistantPlugin):
         for time in self.agenda_times:
             try:
                 self.scheduler.every().day.at(time).do(self.send_agenda)
-            except schedule.ScheduleValueError:
+            except ScheduleValueError:
                 log.error("Invalid agenda time specified '%s', use HH:MM format",
                           time)
                 raise
 
+        # Number of notices scheduled but not yet sent
+        self.pending_notices = 0
+
         # When scheduling notifications, store time of last scheduled event so
         # it won't be scheduled again. Do it separately for each
+        now = self.time.now()
         self.notify_positions = {
-            delta: self.time.now() + dt.timedelta(minutes=delta)
+            delta: now + dt.timedelta(minutes=delta)
             for delta in self.notify_periods
         }
 
-    def send_notice(self, event):
+        # Resume where the previous run has left off. Windows between the
+        # resumed positions and now are swept by the first scan.
+        self.resumed = False
+        if self.journal_path is not None and not self.assistant.read_only:
+            self.journal = helpers.NotificationJournal(self.journal_path)
+            self.journal.replay(now)
+            for delta in self.notify_periods:
+                position = self.journal.resume_position(delta)
+                if position is not None:
+                    self.notify_positions[delta] = position
+                    self.resumed = True
+        else:
+            self.journal = None
+
+        # After suspend or a hang send a single summary of missed notices.
+        self.scheduler.stall_handlers.append(self.catch_up)
+
+        # Edits of the calendar update already scheduled notices
+        self.calendar.listeners.append(self.reschedule_notifications)
+
+        # Old closed events are moved out of the hot tier as time goes
+        if self.cold_days is not None:
+            self.calendar.demote(now)
+            self.scheduler.every(self.DEMOTE_INTERVAL).seconds.do(self.demote_events)
+
+        # Status summary is recomputed on calendar changes and as time goes
+        self.calendar.listeners.append(self.update_status)
+        self.scheduler.every(self.STATUS_INTERVAL).seconds.do(self.update_status)
+        self.update_status()
+
+    def demote_events(self):
+        "Move events which got old into the cold tier"
+        self.calendar.demote(self.time.now())
+
+    def update_status(self, added=(), removed=()):
+        """
+        Precompute a status line (state['status']) served to status bars
+        by the control socket.
+        """
+        now = self.time.now()
+        horizon = now + dt.timedelta(hours=self.horizon_incoming)
+        status = self.calendar.get_status(horizon, now)
+
+        event = status['next']
+        if event is None:
+            status['next'] = '-'
+        else:
+            date = self.time.normalize(event.relevant_date.sort_date)
+            fmt = '%H:%M' if date.date() == now.date() else '%a %H:%M'
+            status['next'] = '%s %s' % (date.strftime(fmt), event.headline)
+        self.state['status'] = self.status_format.format(**status)
+
+    def send_notice(self, event, key=None):
         "Notify user in advance about incoming event."
         # Read just-in-time so it can be updated without restarting.
         template = helpers.get_template(self.notice_path)
         notice = event.format_notice(template, self.time.now())
 
         self.assistant.tell_boss(notice)
-
-        # Do it always once only.
-        return schedule.CancelJob
+        self.pending_notices -= 1
+        if self.journal is not None:
+            self.journal.notice_sent(key, event.relevant_date.sort_date)
 
     def schedule_notifications(self):
         "Schedule incoming notifications"
@@ -59,6 +127,10 @@ class CalendarCore(AssistantPlugin):
 
         now = self.time.now()
 
+        if self.resumed:
+            self.resumed = False
+            self.catch_up_restart(now)
+
         for notify_period in self.notify_periods:
             # Calculate window
             wnd_start = now + dt.timedelta(minutes=notify_period)
@@ -66,30 +138,196 @@ class CalendarCore(AssistantPlugin):
             wnd_start = max(wnd_start, self.notify_positions[notify_period])
 
             last_scheduled = wnd_start
-            for event in self.calendar.events:
-                # Ignore date-less events
-                if event.relevant_date is None:
-                    continue
-
+            # Query only appointments (including occurrences of cyclic events)
+            # within the window.
+            appointments = self.calendar.get_appointments(since=wnd_start,
+                                                          horizon=wnd_end)
+            for event in appointments:
                 date = event.relevant_date.sort_date
                 # We want to schedule an event if it lies between now+notify_period and
                 # now+notify_period+prepare_before
-
-                if not event.relevant_date.appointment:
-                    continue
-
                 if date <= wnd_start:
                     continue
-                if date > wnd_end:
-                    continue
-
-                log.info("Scheduling %dm notification for event %r", notify_period, event)
-                delta = (date - self.time.now()).total_seconds() - notify_period * 60
-                self.scheduler.every(delta).seconds.do(self.send_notice, event)
+                self._schedule_notice(event, notify_period, now)
                 last_scheduled = max(last_scheduled, date)
 
             self.notify_positions[notify_period] = last_scheduled
-
+            if self.journal is not None:
+                self.journal.position(notify_period, last_scheduled)
+
+
+    def _schedule_notice(self, event, notify_period, now):
+        "Schedule a notice unless the event started or it was already sent"
+        date = event.relevant_date.sort_date
+        # Resumed after a restart - the event already started.
+        if date <= now:
+            return
+
+        key = None
+        if self.journal is not None:
+            key = helpers.notice_key(event, notify_period)
+            if self.journal.was_sent(key):
+                return
+            self.journal.scheduled(key, notify_period, date)
+
+        log.info("Scheduling %dm notification for event %r", notify_period, event)
+        delta = (date - self.time.now()).total_seconds() - notify_period * 60
+        self.scheduler.once(delta).do(self.send_notice, event, key)
+        self.pending_notices += 1
+
+    def reschedule_notifications(self, added, removed):
+        """
+        Update scheduled notices after a calendar change: cancel notices of
+        removed events and schedule added events within windows which were
+        already scanned. Other notices are left alone.
+        """
+        removed_ids = set(id(event) for event in removed)
+        if removed_ids:
+            for job in self.scheduler.jobs:
+                func = getattr(job.job_func, 'func', None)
+                if func != self.send_notice:
+                    continue
+                event = job.job_func.args[0]
+                if id(event.occurrence_of or event) in removed_ids:
+                    log.info("Cancelling notification for removed event %r",
+                             event)
+                    self.scheduler.cancel_job(job)
+                    self.pending_notices -= 1
+                    key = job.job_func.args[1]
+                    if self.journal is not None and key is not None:
+                        self.journal.cancelled(key)
+
+        added = [
+            event for event in added
+            if self.calendar.duplicate_of(event) is None
+        ]
+        if not added:
+            return
+        now = self.time.now()
+        for notify_period in self.notify_periods:
+            since = now + dt.timedelta(minutes=notify_period)
+            until = self.notify_positions[notify_period]
+            if until <= since:
+                continue
+            for event in self._appointments_within(added, since, until):
+                self._schedule_notice(event, notify_period, now)
+
+    @staticmethod
+    def _appointments_within(events, since, until):
+        "Appointments (and occurrences of cyclic ones) within (since, until]"
+        for event in events:
+            if event.repeating:
+                for event_date in event.dates:
+                    if not event_date.appointment:
+                        continue
+                    for occurrence in event_date.occurrences(since, until):
+                        if occurrence.sort_date > since:
+                            yield event.occurrence(occurrence)
+                continue
+            date = event.relevant_date
+            if date is None or not date.appointment:
+                continue
+            if since < date.sort_date <= until:
+                yield event
+
+    def catch_up_restart(self, now):
+        """
+        After a restart, notices between the journaled positions and the
+        current windows were not scanned - send them as a catch-up summary.
+        """
+        gap_start = None
+        for notify_period in self.notify_periods:
+            position = self.notify_positions[notify_period]
+            if position >= now + dt.timedelta(minutes=notify_period):
+                continue
+            start = position - dt.timedelta(minutes=notify_period)
+            if gap_start is None or start < gap_start:
+                gap_start = start
+        if gap_start is None:
+            return
+        duration = max(0, (now - gap_start).total_seconds())
+        self.catch_up(Stall(since=gap_start, duration=duration, kind='restart'))
+
+    def catch_up(self, stall):
+        """
+        Handle a stall of the main loop: cancel overdue notices, sweep
+        notification windows which were not scanned in time and coalesce
+        everything into one summary message.
+        """
+        now = self.time.now()
+        missed = {}
+
+        def add(event, key):
+            "Add event to the summary and mark its notice as sent"
+            date = event.relevant_date.sort_date
+            missed[(date, event.headline)] = event
+            if self.journal is not None and key is not None:
+                self.journal.notice_sent(key, date)
+
+        # Scheduled notices which would be sent all at once now
+        wall_now = dt.datetime.now()
+        for job in list(self.scheduler.jobs):
+            func = getattr(job.job_func, 'func', None)
+            if func != self.send_notice or job.next_run > wall_now:
+                continue
+            self.scheduler.cancel_job(job)
+            self.pending_notices -= 1
+            add(*job.job_func.args)
+
+        # Windows which notification scanning didn't reach
+        for notify_period in self.notify_periods:
+            start = self.notify_positions[notify_period]
+            end = now + dt.timedelta(minutes=notify_period)
+            if end <= start:
+                continue
+            for event in self.calendar.get_appointments(since=start,
+                                                        horizon=end):
+                if event.relevant_date.sort_date <= start:
+                    continue
+                key = None
+                if self.journal is not None:
+                    key = helpers.notice_key(event, notify_period)
+                    if self.journal.was_sent(key):
+                        continue
+                add(event, key)
+            self.notify_positions[notify_period] = end
+            if self.journal is not None:
+                self.journal.position(notify_period, end)
+
+        if not missed:
+            return
+
+        hours, minutes = divmod(int(stall.duration) // 60, 60)
+        lines = ["I was unavailable for %dh%02dm (%s). Missed notifications:" %
+                 (hours, minutes, stall.kind)]
+        events = [missed[key] for key in sorted(missed)]
+        for event in events[:self.catch_up_limit]:
+            date = event.relevant_date.sort_date
+            minutes = int((date - now).total_seconds() // 60)
+            if minutes >= 0:
+                when = "in %dm" % minutes
+            else:
+                when = "started %dm ago" % -minutes
+            lines.append("  %s %s (%s)" % (date.strftime("%H:%M"),
+                                           event.headline, when))
+        if len(events) > self.catch_up_limit:
+            lines.append("  ... and %d more" %
+                         (len(events) - self.catch_up_limit))
+        self.assistant.tell_boss("\n".join(lines))
+
+    def get_metrics(self):
+        "Calendar size and pending notifications"
+        samples = [
+            ('orgassist_calendar_events', {'source': str(tag)}, count)
+            for tag, count in sorted(self.calendar.count_by_tag().items(),
+                                     key=lambda item: str(item[0]))
+        ]
+        samples += [
+            ('orgassist_calendar_size', {}, len(self.calendar.events)),
+            ('orgassist_calendar_cold_size', {}, len(self.calendar.cold)),
+            ('orgassist_notifications_pending', {}, self.pending_notices),
+        ]
+        return samples
 
     def validate_config(self):
         "Read config and apply defaults"
@@ -100,6 +338,34 @@ class CalendarCore(AssistantPlugin):
         self.scan_interval = cfg.get('scan_interval',
                                      default=60)
 
+        # Journal of sent notifications - survives restarts.
+        self.journal_path = cfg.get_path('journal_path', required=False)
+
+        # Number of missed notices listed after a stall (suspend, hang)
+        self.catch_up_limit = cfg.get('catch_up_limit', default=10,
+                                      assert_type=int)
+
+        # Vectorized queries for large calendars - optional numpy module.
+        self.use_columnar = cfg.get('columnar', default=False,
+                                    assert_type=bool)
+        if self.use_columnar and not columnar.is_available():
+            msg = ("Columnar calendar requires an optional numpy module. "
+                   "Install it with pip3 install numpy.")
+            raise ConfigError(msg)
+
+        # Closed events older than this number of days are kept in a cold
+        # tier read only by searches and queries reaching into the past.
+        self.cold_days = cfg.get('cold_days', required=False)
+        if self.cold_days is not None and (
+                not isinstance(self.cold_days, int) or self.cold_days < 1):
+            raise ConfigError("cold_days must be a positive number of days")
+
+        # Merge the same appointment read from multiple sources, keep the
+        # copy of the first preferred source (eg. [org, exch]).
+        self.dedup = cfg.get('dedup.enabled', default=True, assert_type=bool)
+        self.dedup_prefer = cfg.get('dedup.prefer', default=[],
+                                    assert_type=list, wrap=False)
+
         self.agenda_times = cfg.get('agenda.times',
                                     default=['7:00', '12:00'])
 
@@ -114,6 +380,37 @@ class CalendarCore(AssistantPlugin):
         self.list_unfinished_appointments = cfg.get('agenda.list_unfinished_appointments',
                                                     default=False)
 
+        # Query tracing for the `trace' command: queries traced always (eg.
+        # unfinished, scheduled, query or a query text) and a sampling rate
+        # of others.
+        self.trace_queries = cfg.get('trace.queries', default=[],
+                                     assert_type=list, wrap=False)
+        self.trace_sample = cfg.get('trace.sample', default=0.0)
+        if (not isinstance(self.trace_sample, (int, float)) or
+                not 0 <= self.trace_sample <= 1):
+            raise ConfigError("trace.sample must be a number between 0 and 1")
+
+        # Status line served over the control socket
+        self.status_format = cfg.get('status_format',
+                                     default='{today}->{tomorrow}-->{later} '
+                                             '{undated} | {next}',
+                                     assert_type=str)
+        try:
+            self.status_format.format(today=0, tomorrow=0, later=0,
+                                      undated=0, next='')
+        except (KeyError, IndexError, ValueError) as ex:
+            raise ConfigError("Invalid status_format: %r" % ex)
+
+        # Additional agenda sections: name -> query
+        queries = cfg.get('agenda.queries', default={}, assert_type=dict,
+                          wrap=False)
+        self.agenda_queries = {}
+        for name, text in queries.items():
+            try:
+                self.agenda_queries[name] = Query(text)
+            except QueryError as ex:
+                raise ConfigError("Invalid agenda query '%s': %s" % (name, ex))
+
         # Get template paths or calculate defaults
         self.agenda_path = cfg.get_path('agenda.agenda_template_path',
                                         required=False)
@@ -128,7 +425,13 @@ class CalendarCore(AssistantPlugin):
 
 
     def register(self):
-        self.calendar = Calendar(self.agenda_path)
+        self.calendar = Calendar(self.agenda_path,
+                                 use_columnar=self.use_columnar,
+                                 dedup=self.dedup,
+                                 dedup_prefer=self.dedup_prefer,
+                                 cold_days=self.cold_days)
+        self.calendar.tracer = QueryTracer(self.trace_sample,
+                                           self.trace_queries)
 
         # Register calendar in global state - this is our public API
         self.state['calendar'] = self.calendar
@@ -136,6 +439,9 @@ class CalendarCore(AssistantPlugin):
         commands = [
             (['agenda', 'ag'], self.handle_agenda),
             (['search', 's'], self.handle_search),
+            (['tag', 't'], self.handle_tag),
+            (['query', 'q'], self.handle_query),
+            (['trace'], self.handle_trace),
         ]
         for aliases, callback in commands:
             self.assistant.command.register(aliases, callback)
@@ -150,21 +456,142 @@ class CalendarCore(AssistantPlugin):
         """
         Enter an incremental search context
         """
-        ctx = SearchContext(self.calendar)
+        ctx = SearchContext(self.calendar, self.time.now, self.set_listed)
         ctx.handler(message)
         return ctx
 
-    def get_agenda(self):
-        "Generate agenda"
+    def handle_tag(self, message):
+        """
+        List events with given tags within a number of days, eg.:
+        tag WORK 7 - Everything tagged :WORK: from today up to a week ahead.
+        """
+        tags = []
+        days = 7
+        for word in message.text.split():
+            if word.isdigit():
+                days = int(word)
+            else:
+                tags.append(word.strip(':'))
+        if not tags:
+            message.respond("Usage: tag <tag> [<tag> ...] [days]")
+            return
+
         now = self.time.now()
+        since = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        until = now + dt.timedelta(days=days)
+        events = self.calendar.get_tagged(tags, since=since, until=until)
+        if not events:
+            message.respond("Nothing tagged %s within %d days." %
+                            (" ".join(tags), days))
+            return
+        self.respond_events(message, events)
+
+    def handle_query(self, message):
+        """
+        List events matching a query, eg.:
+        query todo:TODO tag:work prio:A due:<3d "report"
+        """
+        try:
+            query = Query(message.text)
+        except QueryError as ex:
+            message.respond("Invalid query: %s" % ex)
+            return
+
+        events = query.execute(self.calendar, self.time.now())
+        if not events:
+            message.respond("Nothing matches '%s'." % message.text)
+            return
+        self.respond_events(message, events)
+
+    def handle_trace(self, message):
+        """
+        Show traced calendar queries or control tracing:
+        trace [on|off|clear|<sampling rate>]
+        """
+        tracer = self.calendar.tracer
+        arg = message.text.strip().lower()
+        if arg in ('on', 'off'):
+            tracer.sample = 1.0 if arg == 'on' else 0.0
+            if arg == 'off':
+                tracer.queries.clear()
+            message.respond("Query tracing is %s." % arg)
+            return
+        if arg == 'clear':
+            tracer.clear()
+            message.respond("Traces cleared.")
+            return
+        if arg:
+            try:
+                sample = float(arg)
+                if not 0 <= sample <= 1:
+                    raise ValueError(arg)
+            except ValueError:
+                message.respond("Usage: trace [on|off|clear|<rate 0-1>]")
+                return
+            tracer.sample = sample
+            message.respond("Tracing %g of queries." % sample)
+            return
+
+        lines = tracer.summary()
+        if not lines:
+            if tracer.enabled:
+                message.respond("No queries traced yet.")
+            else:
+                message.respond("Query tracing is off - enable it with "
+                                "`trace on' or `trace <rate>'.")
+            return
+        lines.append("Recent:")
+        lines += [trace.describe() for trace in list(tracer.traces)[-5:]]
+        message.respond("\n".join(lines))
+
+    def set_listed(self, events):
+        """
+        Remember events listed to the user with numbers - other commands
+        (eg. done) can refer to them.
+        """
+        self.state['listed'] = list(events)
+
+    def respond_events(self, message, events):
+        "Respond with a short numbered list of events"
+        lines = []
+        for i, event in enumerate(events[:self.LIST_LIMIT]):
+            state = event.state.name + ' ' if event.state else ''
+            if event.relevant_date is not None:
+                date = event.relevant_date.sort_date.strftime("%Y-%m-%d %H:%M ")
+            else:
+                date = ''
+            lines.append("%2d. %s%s%s" % (i + 1, date, state, event.headline))
+        self.set_listed(events[:self.LIST_LIMIT])
+        if len(events) > self.LIST_LIMIT:
+            lines.append("... and %d more" % (len(events) - self.LIST_LIMIT))
+        message.respond("\n".join(lines))
+
+    def _agenda_args(self):
+        "Horizons and options of the agenda relative to now"
+        # Agenda has a minute resolution - so it can be cached.
+        now = self.time.now().replace(second=0, microsecond=0)
         horizon_unfinished = now - dt.timedelta(hours=self.horizon_unfinished)
         horizon_incoming = now + dt.timedelta(hours=self.horizon_incoming)
+        return {
+            'horizon_incoming': horizon_incoming,
+            'horizon_unfinished': horizon_unfinished,
+            'list_unfinished_appointments': self.list_unfinished_appointments,
+            'relative_to': now,
+            'queries': self.agenda_queries,
+        }
 
+    def get_agenda_context(self):
+        "Events displayed in the agenda (eg. for JSON output)"
+        return self.calendar.get_agenda_context(**self._agenda_args())
+
+    def get_agenda(self):
+        "Generate agenda"
+        args = self._agenda_args()
         try:
-            agenda = self.calendar.get_agenda(horizon_incoming,
-                                              horizon_unfinished,
-                                              self.list_unfinished_appointments,
-                                              relative_to=now)
+            agenda, unfinished = self.calendar.get_agenda(
+                with_unfinished=True, **args)
+            # Unfinished tasks are numbered in the agenda
+            self.set_listed(unfinished)
             return agenda
         except Exception:
             tb.print_exc()
@@ -2,15 +2,23 @@
 """
 
 from orgassist.assistant import CommandContext
+from orgassist.calendar import Query, QueryError
 
 class SearchContext(CommandContext):
     """
     Keep context of an incremental search
     """
 
-    def __init__(self, calendar, *args, **kwargs):
+    def __init__(self, calendar, now, on_list=None, *args, **kwargs):
         """
+        Search calendar events. `now' returns the current time for relative
+        query terms, `on_list' is called with numbered events shown to the
+        user.
         """
+        self.calendar = calendar
+        self.now = now
+        self.on_list = on_list
+
         # Copy current events
         self.events = calendar.events[:]
 
@@ -23,18 +31,17 @@ class SearchContext(CommandContext):
         super().__init__(*args, **kwargs)
 
     def narrow_down(self, new_query):
-        "Narrow search down"
-        matching = []
-        kept, dropped = 0, 0
-        new_query = new_query.lower()
-        for event in self.events:
-            txt = ' '.join([event.headline.lower(),
-                            event.body.lower()])
-            if new_query in txt:
-                matching.append(event)
-                kept += 1
-            else:
-                dropped += 1
+        """
+        Narrow search down using a query (see calendar.query). The first
+        query uses calendar indices.
+        """
+        query = Query(new_query)
+        if not self.queries[:-1]:
+            matching = query.execute(self.calendar, self.now())
+        else:
+            matching = query.filter(self.events, self.now())
+        kept = len(matching)
+        dropped = len(self.events) - kept
 
         self.stat_dropped += dropped
         self.stat_kept -= dropped
@@ -48,7 +55,12 @@ class SearchContext(CommandContext):
         is_first = self.queries == []
 
         self.queries.append(query)
-        _, dropped = self.narrow_down(query)
+        try:
+            _, dropped = self.narrow_down(query)
+        except QueryError as ex:
+            self.queries.pop()
+            message.respond("Invalid query: %s" % ex)
+            return is_first
         full_query = " ".join(self.queries)
 
         if self.stat_kept == 0:
@@ -73,6 +85,8 @@ class SearchContext(CommandContext):
                 message.respond("   " + event.body[:200] + "...")
             elif event.body:
                 message.respond("   " + event.body)
+        if self.on_list is not None:
+            self.on_list(self.events[:10])
 
         return False
 
@@ -0,0 +1,227 @@
+import io
+import os
+import sys
+import json
+import tempfile
+import unittest
+import datetime as dt
+from unittest import mock
+from contextlib import redirect_stdout
+
+from orgassist.config import Config
+from orgassist.assistant import Assistant
+from orgassist.calendar import Event, EventDate, DateType, EventState
+from orgassist.calendar.trace import QueryTracer
+from orgassist.helpers import Scheduler, NotificationJournal
+from orgassist.helpers.scheduler import Stall
+from orgassist.bots import LoopbackBot
+import orgassist.plugins
+
+import assist
+
+
+class TestCalendarCore(unittest.TestCase):
+    "Test calendar plugin notifications"
+
+    def setUp(self):
+        self.start()
+
+    def start(self, **calendar_config):
+        "Create an assistant with a calendar plugin"
+        calendar_config = dict({
+            'notify_period': [5],
+            'dedup': {'prefer': ['org']},
+        }, **calendar_config)
+        config = Config.from_dict({
+            'timezone': 'UTC',
+            'channels': [
+                {'jid': 'boss@example.com'},
+            ],
+            'plugins': {
+                'calendar': calendar_config,
+            },
+        })
+        self.bot = LoopbackBot()
+        self.scheduler = Scheduler()
+        self.assistant = Assistant('test', config, self.scheduler)
+        self.assistant.register_xmpp_bot(self.bot)
+        self.plugin = self.assistant.plugins['calendar']
+        self.calendar = self.plugin.calendar
+        self.now = self.assistant.time.now()
+
+    def appointment(self, headline, minutes):
+        "Appointment starting in a number of minutes"
+        event = Event(headline)
+        event.add_date(EventDate(self.now + dt.timedelta(minutes=minutes),
+                                 DateType.TIMESTAMP))
+        return event
+
+    def notices(self):
+        "Events with scheduled notices"
+        return [
+            job.job_func.args[0] for job in self.scheduler.jobs
+            if getattr(job.job_func, 'func', None) == self.plugin.send_notice
+        ]
+
+    def test_merged_notice(self):
+        "Duplicate replaced by a preferred copy is notified once"
+        exch = self.appointment('Weekly sync meeting', 8)
+        self.calendar.add_events([exch], 'exch')
+        self.plugin.schedule_notifications()
+        self.assertEqual(self.notices(), [exch])
+
+        org = self.appointment('Weekly sync', 8)
+        self.calendar.add_events([org], 'org')
+        self.assertEqual(self.notices(), [org])
+        self.assertEqual(self.plugin.pending_notices, 1)
+
+        # The exchange copy is notified again when the org one is gone
+        self.calendar.update_events([], 'org')
+        self.assertEqual(self.notices(), [exch])
+        self.assertEqual(self.plugin.pending_notices, 1)
+
+    def test_journal(self):
+        "Cancelled notices are journaled, restart gap is caught up"
+        path = os.path.join(tempfile.mkdtemp(), 'journal')
+        self.start(journal_path=path)
+        removed = self.appointment('Cancelled meeting', 8)
+        self.calendar.add_events([removed], 'org')
+        self.plugin.schedule_notifications()
+        self.assertEqual(self.notices(), [removed])
+        self.calendar.update_events([], 'org')
+        self.assertEqual(self.notices(), [])
+        self.assertEqual(self.plugin.journal.pending, {})
+        self.plugin.journal.close()
+
+        # Restart 30 minutes after the last scan
+        journal = NotificationJournal(path)
+        journal.replay(self.now)
+        self.assertEqual(journal.pending, {})
+        journal.position(5, self.now - dt.timedelta(minutes=30))
+        journal.close()
+
+        self.start(journal_path=path)
+        missed = self.appointment('Missed meeting', 2)
+        later = self.appointment('Later meeting', 8)
+        self.calendar.add_events([missed, later], 'org')
+        self.plugin.schedule_notifications()
+        self.assertEqual(self.notices(), [later])
+        summary = self.bot.pop_outbox('boss@example.com')
+        self.assertEqual(len(summary), 1)
+        self.assertIn('restart', summary[0])
+        self.assertIn('Missed meeting', summary[0])
+        self.assertNotIn('Later meeting', summary[0])
+        self.plugin.journal.close()
+
+    def test_catch_up(self):
+        "Notices overdue or not scanned during a stall are sent together"
+        overdue = self.appointment('Overdue meeting', 8)
+        skipped = self.appointment('Skipped meeting', 2)
+        later = self.appointment('Later meeting', 30)
+        self.calendar.add_events([overdue, skipped, later], 'org')
+        self.plugin.schedule_notifications()
+        self.assertEqual(self.notices(), [overdue])
+
+        # Main loop hung - scanning stopped 20 minutes ago and the
+        # notice job is overdue
+        for job in self.scheduler.jobs:
+            if getattr(job.job_func, 'func', None) == self.plugin.send_notice:
+                job.next_run = dt.datetime.now() - dt.timedelta(minutes=1)
+        self.plugin.notify_positions[5] = self.now - dt.timedelta(minutes=20)
+        stall = Stall(since=self.now - dt.timedelta(minutes=30),
+                      duration=1800, kind='hang')
+        self.plugin.catch_up(stall)
+
+        self.assertEqual(self.notices(), [])
+        self.assertEqual(self.plugin.pending_notices, 0)
+        self.assertGreaterEqual(self.plugin.notify_positions[5],
+                                self.now + dt.timedelta(minutes=5))
+        summary = self.bot.pop_outbox('boss@example.com')
+        self.assertEqual(len(summary), 1)
+        self.assertIn('0h30m (hang)', summary[0])
+        self.assertLess(summary[0].index('Skipped meeting'),
+                        summary[0].index('Overdue meeting'))
+        self.assertNotIn('Later meeting', summary[0])
+
+        # Nothing is sent twice
+        self.plugin.catch_up(stall)
+        self.assertEqual(self.bot.pop_outbox('boss@example.com'), [])
+
+    def test_agenda_listed(self):
+        "Cached agenda numbers unfinished events without querying them again"
+        task = Event('Write report', state=EventState('TODO'))
+        task.add_date(EventDate(self.now - dt.timedelta(hours=1),
+                                DateType.SCHEDULED))
+        self.calendar.add_events([task], 'org')
+        self.calendar.tracer = QueryTracer(queries=['unfinished'])
+
+        first = self.plugin.get_agenda()
+        self.assertEqual(self.plugin.state['listed'], [task])
+        self.plugin.set_listed([])
+        self.assertIs(self.plugin.get_agenda(), first)
+        self.assertEqual(self.plugin.state['listed'], [task])
+        traces = [trace.name for trace in self.calendar.tracer.traces]
+        self.assertEqual(traces.count('unfinished'), 1)
+
+
+class TestPrintAgenda(unittest.TestCase):
+    "Test printing agenda from the command line"
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        date = dt.datetime.now(dt.timezone.utc) + dt.timedelta(hours=2)
+        with open(os.path.join(directory, 'calendar.org'), 'w') as handler:
+            handler.write("* Meeting\n  <%s>\n" %
+                          date.strftime('%Y-%m-%d %a %H:%M'))
+        self.config_path = os.path.join(directory, 'config.yml')
+        with open(self.config_path, 'w') as handler:
+            handler.write("""
+plugins: ['orgassist.plugins']
+assistants:
+  main:
+    timezone: UTC
+    channels:
+      - jid: 'boss@example.com'
+    plugins:
+      calendar: {}
+      org:
+        directory: %(directory)s
+        scan_interval_s: 300
+        note: {inbox: %(directory)s/inbox.org}
+  empty:
+    timezone: UTC
+    channels:
+      - jid: 'boss@example.com'
+    plugins: {}
+""" % {'directory': directory})
+
+    def run_main(self, *args):
+        "Run the command with arguments and return exit code and output"
+        argv = ['assist.py', '--config', self.config_path] + list(args)
+        output = io.StringIO()
+        with mock.patch.object(sys, 'argv', argv), redirect_stdout(output):
+            code = assist.main()
+        return code, output.getvalue()
+
+    def test_text(self):
+        "Agenda of the first assistant is printed"
+        code, output = self.run_main('--agenda')
+        self.assertEqual(code, 0)
+        self.assertIn('Meeting', output)
+
+        code, output = self.run_main('--agenda', '--assistant', 'other')
+        self.assertEqual(code, 4)
+        self.assertIn('Unknown assistant', output)
+        code, output = self.run_main('--agenda', '--assistant', 'empty')
+        self.assertEqual(code, 4)
+        self.assertIn('not enabled', output)
+
+    def test_json(self):
+        "Events of the agenda are serialized with their sources"
+        code, output = self.run_main('--agenda', '--json')
+        self.assertEqual(code, 0)
+        agenda = json.loads(output)
+        self.assertEqual([event['headline'] for event in agenda['appointments']],
+                         ['Meeting'])
+        self.assertEqual(agenda['appointments'][0]['source'], 'org')
+        self.assertEqual(agenda['unfinished'], [])
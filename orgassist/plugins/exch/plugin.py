@@ -11,6 +11,7 @@ from orgassist.config import ConfigError
 
 from orgassist.calendar import Event
 from orgassist.calendar import EventDate, DateType
+from orgassist.helpers import sources
 
 Attendee = namedtuple('Attendee', 'name, email, required')
 
@@ -58,8 +59,30 @@ class ExchPlugin(AssistantPlugin):
 
     def initialize(self):
         """
-        Initialize connection and schedule periodic events.
+        Subscribe to a (possibly shared) source and schedule periodic events.
         """
+        self.connection = None
+        self.event_count = 0
+
+        # Assistants reading the same mailbox fetch events only once.
+        key = sources.make_key('exch', {
+            'url': self.url,
+            'username': self.username,
+            'horizon_incoming': self.horizon_incoming,
+            'my_email': self.my_email,
+            'timezone': self.time.timezone,
+        })
+        self.source = sources.registry.get(key, self.fetch_events)
+        self.source.subscribe(self.update_calendar)
+
+        # Initial refresh
+        interval = 60 * 10
+        self.refresh_events(max_age=interval / 2)
+        self.scheduler.every(interval).seconds.do(self.refresh_events,
+                                                  max_age=interval / 2)
+
+    def connect(self):
+        "Initialize connection to the Exchange"
         # Loading optional modules only when module is configured.
         from pyexchange import Exchange2010Service
         from pyexchange import ExchangeNTLMAuthConnection
@@ -74,13 +97,18 @@ class ExchPlugin(AssistantPlugin):
         if self.ca_path is not None:
             self.connection.session.verify = self.ca_path
 
-        # Initial refresh
-        self.refresh_events()
-        self.scheduler.every(60 * 10).seconds.do(self.refresh_events)
+    def get_metrics(self):
+        "Number of events read during the last refresh"
+        return [
+            ('orgassist_exch_events', {}, self.event_count),
+        ]
 
     def handle_refresh(self, message):
         "Handle force-refreshing and return stats on events"
         events = self.refresh_events()
+        if events is None:
+            message.respond("Unable to read events from your calendar.")
+            return
         reply = "Read %d events from your calendar." % (len(events))
         message.respond(reply)
 
@@ -161,11 +189,16 @@ class ExchPlugin(AssistantPlugin):
 
         return event
 
-    def refresh_events(self):
+    def fetch_events(self):
         """
-        Read events from exchange, convert and update calendar.
+        Read events from exchange and convert them.
+
+        Called by the shared source - only once for all assistants using the
+        same mailbox.
         """
         log.info("Periodic operation executed")
+        if self.connection is None:
+            self.connect()
 
         now = self.time.now()
 
@@ -185,14 +218,29 @@ class ExchPlugin(AssistantPlugin):
             log.exception("Connection (probably) error within exch module.")
             return None
 
-        calendar_events = []
-        for event in events.events:
-            converted = self.convert_event(event)
-            calendar_events.append(converted)
+        calendar_events = tuple(
+            self.convert_event(event)
+            for event in events.events
+        )
 
         log.info('Read %d events from exchange',
                  len(calendar_events))
+        return calendar_events
 
+    def update_calendar(self, calendar_events):
+        "Feed fetched events into the calendar"
         # Use shared state to talk to core plugins
         self.state['calendar'].update_events(calendar_events, 'exch')
-        return calendar_events
+        self.assistant.stats.set('events.exch', len(calendar_events))
+        self.event_count = len(calendar_events)
+
+    def refresh_events(self, max_age=0):
+        """
+        Read events from exchange and update calendar, unless other
+        assistant sharing the mailbox did it less than max_age seconds ago.
+        Return None if reading failed.
+        """
+        events = self.source.refresh(max_age)
+        if self.source.failed:
+            return None
+        return events
@@ -10,6 +10,12 @@ import re
 import datetime as dt
 import traceback as tb
 import os
+import fnmatch
+import functools
+import hashlib
+import pickle
+import tempfile
+from time import monotonic
 from collections import defaultdict
 
 from orgassist import log
@@ -18,6 +24,9 @@ from orgassist.calendar import EventDate, DateType
 
 from . import orgnode
 
+# Headline displayed instead of entries tagged with one of private tags
+PRIVATE_HEADLINE = 'Private entry'
+
 def unindent(body):
     "Unindent a 'common indent' of body of text"
     lines = body.split('\n')
@@ -60,53 +69,451 @@ def unindent(body):
     return "\n".join(unindented)
 
 
-def load_orgnode(cfg):
-    "Load data from all org-files using orgnode"
-    # Aggregated Orgnodes objects
-    db = []
-
+def _todo_keywords(cfg):
+    "All TODO keywords orgnode should recognize"
     todo_all = set(cfg['todos_open'])
     todo_all.update(cfg['todos_closed'])
     todo_all.add(cfg['project'])
+    return todo_all
 
-    for path in cfg['files']:
-        db += orgnode.makelist(path, todo_default=todo_all)
 
-    if not cfg['files_re']:
-        return db
+class OrgTree:
+    """
+    Finds and parses org files in the configured directory tree.
+
+    Keeps a change-detection cache between scans:
+    - files with unchanged (device, inode, mtime, size) are not parsed again,
+    - directories with unchanged mtime are not listed again (their set of
+      entries couldn't change), only files within them are stat-ed,
+    - directories and files reachable through multiple symlinks (or symlink
+      loops) are visited once - deduplicated by (st_dev, st_ino).
 
-    first = True
-    # Read by regexp
-    regexp = re.compile(cfg['files_re'], flags=re.UNICODE)
-    for root, dirs, files in os.walk(cfg['base'],
-                                     followlinks=True):
-        if '.git' in dirs:
-            dirs.remove('.git')
+    The cache can be persisted (cfg['cache_path']), so a fresh process
+    (eg. a one-shot agenda) parses only files changed since the last run.
+    """
+    # Incremented when the format of cached nodes changes
+    CACHE_VERSION = 1
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.todo_all = _todo_keywords(cfg)
+        self.exclude = cfg.get('exclude', ['.git'])
+        if cfg['files_re']:
+            self.regexp = re.compile(cfg['files_re'], flags=re.UNICODE)
+        else:
+            self.regexp = None
+
+        # dir path -> (mtime_ns, [matching file names], [subdirectory names])
+        self.dirs = {}
+        # file path -> (stat key, parsed nodes)
+        self.files = {}
+
+        # Number of files reused from cache during the last parse
+        self.reused = 0
+
+        # Result of the last walk - (path, stat) of found files
+        self.found = []
+
+        self.cache_path = cfg.get('cache_path')
+        if self.cache_path is not None:
+            self.load_cache()
+
+    def _cache_header(self):
+        "Cached data is valid only for the same format and keywords"
+        return (self.CACHE_VERSION, sorted(self.todo_all))
+
+    def load_cache(self):
+        "Read parse results stored by a previous run"
+        try:
+            with open(self.cache_path, 'rb') as handle:
+                header, dirs, files = pickle.load(handle)
+        except FileNotFoundError:
+            return
+        except Exception as ex:
+            # Broken, truncated or written by an incompatible version
+            log.warning("Ignoring unreadable org cache %s: %r",
+                        self.cache_path, ex)
+            return
+        if header != self._cache_header():
+            log.info("Org cache %s is outdated", self.cache_path)
+            return
+        self.dirs, self.files = dirs, files
+
+    def save_cache(self):
+        "Store parse results atomically"
+        directory = os.path.dirname(self.cache_path) or '.'
+        try:
+            os.makedirs(directory, exist_ok=True)
+            handle, tmp_path = tempfile.mkstemp(prefix='.orgassist-cache-',
+                                                dir=directory)
+            with os.fdopen(handle, 'wb') as tmp:
+                pickle.dump((self._cache_header(), self.dirs, self.files),
+                            tmp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cache_path)
+        except (OSError, pickle.PicklingError) as ex:
+            log.warning("Unable to write org cache %s: %r", self.cache_path, ex)
+
+    @staticmethod
+    def _file_key(stat):
+        "Key which changes when file content (probably) changed"
+        return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def is_excluded(self, path, name):
+        "Is the file or directory excluded by configured glob patterns?"
+        relative = os.path.relpath(path, self.cfg['base'])
+        return any(fnmatch.fnmatch(name, pattern) or
+                   fnmatch.fnmatch(relative, pattern)
+                   for pattern in self.exclude)
+
+    def _list_dir(self, path, cached):
+        """
+        List directory - return its stat, matching files with their stats
+        and subdirectories. Reuse cached listing if directory didn't change.
+        """
+        dir_stat = os.stat(path)
+        if cached is not None and cached[0] == dir_stat.st_mtime_ns:
+            self.dirs[path] = cached
+            files = []
+            for name in cached[1]:
+                file_path = os.path.join(path, name)
+                try:
+                    files.append((file_path, os.stat(file_path)))
+                except OSError:
+                    continue
+            return dir_stat, files, cached[2]
+
+        names, files, subdirs = [], [], []
+        with os.scandir(path) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if self.is_excluded(entry.path, entry.name):
+                    continue
+                try:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                    elif entry.is_file() and self.regexp.match(entry.name):
+                        # DirEntry caches the stat result
+                        files.append((entry.path, entry.stat()))
+                        names.append(entry.name)
+                except OSError:
+                    # Broken symlink or a race with removal
+                    continue
 
-        for filename in files:
-            if not re.match(regexp, filename):
+        self.dirs[path] = (dir_stat.st_mtime_ns, names, subdirs)
+        return dir_stat, files, subdirs
+
+    def walk(self):
+        "Return a list of (path, stat) of all org files to read"
+        found = []
+        seen_files = set()
+        seen_dirs = set()
+
+        def add(path, stat):
+            "Add file unless it was already found using a different path"
+            key = (stat.st_dev, stat.st_ino)
+            if key in seen_files:
+                return
+            seen_files.add(key)
+            found.append((path, stat))
+
+        for path in self.cfg['files']:
+            add(path, os.stat(path))
+
+        if self.regexp is None:
+            self.found = found
+            return found
+
+        old_dirs, self.dirs = self.dirs, {}
+        stack = [self.cfg['base']]
+        while stack:
+            path = stack.pop()
+            try:
+                dir_stat, files, subdirs = self._list_dir(path,
+                                                          old_dirs.get(path))
+            except OSError:
+                log.warning("Unable to read directory %s", path)
                 continue
 
-            path = os.path.join(root, filename)
+            dir_key = (dir_stat.st_dev, dir_stat.st_ino)
+            if dir_key in seen_dirs:
+                # Symlink loop or a directory reachable multiple times
+                continue
+            seen_dirs.add(dir_key)
+
+            for file_path, stat in files:
+                add(file_path, stat)
+            stack.extend(os.path.join(path, name) for name in reversed(subdirs))
+        self.found = found
+        return found
+
+    def forget(self, paths):
+        "Drop cached parse results of files, so they are parsed again"
+        for path in paths:
+            self.files.pop(path, None)
+
+    @staticmethod
+    def _location(path):
+        """
+        Normalize path of a file by resolving its directory, but not the
+        file itself - a symlinked file is found by a walk under its link
+        name.
+        """
+        directory, name = os.path.split(os.path.abspath(path))
+        return os.path.join(os.path.realpath(directory), name)
+
+    def is_tracked(self, path):
+        "Would the file (normalized with _location) be found by a walk?"
+        if path in (self._location(tracked) for tracked in self.cfg['files']):
+            return True
+        if self.regexp is None:
+            return False
+        base = os.path.realpath(self.cfg['base'])
+        relative = os.path.relpath(path, base)
+        if relative.startswith(os.pardir):
+            return False
+        name = os.path.basename(path)
+        if not self.regexp.match(name):
+            return False
+        # Check excludes of the file and all its parent directories
+        parts = relative.split(os.sep)
+        for i in range(len(parts)):
+            if self.is_excluded(os.path.join(base, *parts[:i + 1]), parts[i]):
+                return False
+        return True
+
+    def update(self, paths):
+        """
+        Update results of the last walk with changed files (eg. reported
+        by an editor) without walking the tree. New files are added and
+        removed ones dropped. Return True if any of the files is tracked.
+        """
+        by_location = {
+            self._location(path): i
+            for i, (path, _) in enumerate(self.found)
+        }
+        # Files found under a different name (eg. through a symlink)
+        by_real = {
+            os.path.realpath(path): i
+            for i, (path, _) in enumerate(self.found)
+        }
+        tracked = False
+        found = list(self.found)
+        removed = set()
+        for path in paths:
+            path = self._location(path)
+            i = by_location.get(path)
+            if i is None:
+                i = by_real.get(os.path.realpath(path))
+            if i is None and not self.is_tracked(path):
+                continue
+            tracked = True
             try:
-                db += orgnode.makelist(path,
-                                       todo_default=todo_all)
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+
+            if i is None:
+                if stat is not None:
+                    found.append((path, stat))
+                continue
+            self.forget([found[i][0]])
+            if stat is None:
+                removed.add(i)
+            else:
+                found[i] = (found[i][0], stat)
+        self.found = [
+            entry for i, entry in enumerate(found)
+            if i not in removed
+        ]
+        return tracked
+
+    def parse(self, files, durations=None):
+        """
+        Parse given files (list of (path, stat)) and return aggregated nodes.
+        Unchanged files are reused from the cache.
+
+        If durations dictionary is given, parse time of each parsed file is
+        stored within it.
+        """
+        # Aggregated Orgnodes objects
+        db = []
+
+        first = True
+        old_files, self.files = self.files, {}
+        self.reused = 0
+        for path, stat in files:
+            key = self._file_key(stat)
+            cached = old_files.get(path)
+            if cached is not None and cached[0] == key:
+                self.files[path] = cached
+                db += cached[1]
+                self.reused += 1
+                continue
+
+            start = monotonic()
+            try:
+                nodes = orgnode.makelist(path, todo_default=self.todo_all)
             except Exception:
-                if cfg['resilient']:
+                if self.cfg['resilient']:
                     log.warning("Warning: Ignoring error while parsing %s", path)
                     if first:
                         tb.print_exc()
                     first = False
                     continue
                 raise
-    return db
+            if durations is not None:
+                durations[path] = monotonic() - start
+            self.files[path] = (key, nodes)
+            db += nodes
+
+        parsed = len(self.files) - self.reused
+        if self.cache_path is not None and (parsed or len(old_files) != self.reused):
+            self.save_cache()
+        return db
+
+    def load(self, durations=None):
+        "Walk the tree and parse all files"
+        return self.parse(self.walk(), durations)
+
+
+class OrgEditError(Exception):
+    "Org file can't be safely modified"
+
+
+def set_todo_state(node, state, keywords):
+    """
+    Change TODO keyword of a headline by patching its line in place.
+
+    Uses the headline location recorded by makelist. The file content hash
+    is verified first, so concurrent edits are not overwritten. Only the
+    part of the file after the headline is rewritten.
+    """
+    if node.filename is None or node.offset is None:
+        raise OrgEditError("Entry location is unknown")
+
+    with open(node.filename, 'r+b') as handle:
+        content = handle.read()
+        if hashlib.sha1(content).hexdigest() != node.file_hash:
+            raise OrgEditError("File %s was modified since it was read - "
+                               "refresh and try again" % node.filename)
+
+        end = node.offset + node.length
+        line = content[node.offset:end].decode('utf8')
+        match = re.match(r'^\*+[ \t]+', line)
+        if match is None or node.headline not in line:
+            raise OrgEditError("Headline not found at the recorded position")
+        stars = match.group()
+        rest = line[len(stars):]
+        words = rest.split(None, 1)
+        if words and words[0] in keywords:
+            rest = rest[len(words[0]):].lstrip(' \t')
+        patched = (stars + state + ' ' + rest).encode('utf8')
+
+        handle.seek(node.offset)
+        if len(patched) == node.length:
+            handle.write(patched)
+        else:
+            handle.write(patched + content[end:])
+            handle.truncate()
+
+
+def load_orgnode(cfg, durations=None):
+    "Load data from all org-files using orgnode"
+    return OrgTree(cfg).load(durations)
+
+class Rollup:
+    """
+    Counts of TODO entries within a subtree of a headline.
+    """
+    def __init__(self):
+        self.open = 0
+        self.closed = 0
+        self.overdue = 0
+        # Earliest future deadline of an open entry
+        self.next_deadline = None
+
+    def merge(self, other):
+        "Add counts of other subtree"
+        self.open += other.open
+        self.closed += other.closed
+        self.overdue += other.overdue
+        if other.next_deadline is not None:
+            if self.next_deadline is None or other.next_deadline < self.next_deadline:
+                self.next_deadline = other.next_deadline
+
+    def describe(self):
+        "Short description"
+        txt = "%d open, %d closed" % (self.open, self.closed)
+        if self.overdue:
+            txt += ", %d overdue" % self.overdue
+        if self.next_deadline is not None:
+            txt += ", next deadline %s" % self.next_deadline.strftime("%Y-%m-%d %H:%M")
+        return txt
+
+    def __repr__(self):
+        return '<Rollup %s>' % self.describe()
+
+
+def _sort_date(date, timezone):
+    "Convert orgnode date or naive datetime to an aware datetime"
+    if not isinstance(date, dt.datetime):
+        date = dt.datetime(date.year, date.month, date.day, 23, 59, 59)
+    return timezone.localize(date)
+
+
+def compute_rollups(nodes, cfg, relative_to):
+    """
+    Compute a Rollup of each node's subtree (excluding the node itself) in
+    a single post-order pass. Set as `rollup' attribute on all nodes.
+
+    Nodes are in file order, so descendants always follow their ancestors -
+    iterating backwards visits all children before their parents.
+    """
+    todos_open = set(cfg['todos_open'])
+    todos_closed = set(cfg['todos_closed'])
+    timezone = cfg['timezone']
+
+    for node in nodes:
+        node.rollup = Rollup()
+
+    for node in reversed(nodes):
+        if node.parent is None:
+            continue
+        parent_rollup = node.parent.rollup
+        parent_rollup.merge(node.rollup)
+
+        if node.todo in todos_open:
+            parent_rollup.open += 1
+            dates = [node.deadline, node.scheduled]
+            dates = [_sort_date(date, timezone) for date in dates if date]
+            if any(date < relative_to for date in dates):
+                parent_rollup.overdue += 1
+            if node.deadline:
+                deadline = _sort_date(node.deadline, timezone)
+                if deadline >= relative_to:
+                    if (parent_rollup.next_deadline is None or
+                            deadline < parent_rollup.next_deadline):
+                        parent_rollup.next_deadline = deadline
+        elif node.todo in todos_closed:
+            parent_rollup.closed += 1
+
 
 def orgnode_to_event(node, org_config, relative_to=None):
     "Convert orgnode entries to events"
     event = Event(node.headline)
     event.add_tags(node.tags)
-
-    event.body = unindent(node.body)
+    event.all_tags = node.all_tags
+    event.path = node.path
+    # Used to modify the entry in the file
+    event.meta['org_node'] = node
+
+    if event.all_tags.intersection(org_config.get('tags_private', ())):
+        # Hide the content, keep dates. Private entries have private
+        # descendants, so the path is hidden as well.
+        event.headline = PRIVATE_HEADLINE
+        event.path = ()
+    else:
+        # Unindent only when body gets displayed or searched.
+        event.set_lazy_body(functools.partial(unindent, node.body))
     if node.todo:
         state = EventState(node.todo,
                            is_open=node.todo in org_config['todos_open'])
@@ -115,11 +522,13 @@ def orgnode_to_event(node, org_config, relative_to=None):
         event.priority = node.priority
 
     if node.scheduled:
-        date = EventDate(node.scheduled, DateType.SCHEDULED, org_config['timezone'])
+        date = EventDate(node.scheduled, DateType.SCHEDULED, org_config['timezone'],
+                         repeater=node.scheduled_repeater)
         event.add_date(date, relative_to)
 
     if node.deadline:
-        date = EventDate(node.deadline, DateType.DEADLINE, org_config['timezone'])
+        date = EventDate(node.deadline, DateType.DEADLINE, org_config['timezone'],
+                         repeater=node.deadline_repeater)
         event.add_date(date, relative_to)
 
     for ranged in node.rangelist:
@@ -127,9 +536,10 @@ def orgnode_to_event(node, org_config, relative_to=None):
         date = EventDate((start, end), DateType.RANGE, org_config['timezone'])
         event.add_date(date, relative_to)
 
-    for node_date in node.datelist:
+    for node_date, repeater in zip(node.datelist, node.datelist_repeaters):
         # Appointment dates
-        date = EventDate(node_date, DateType.TIMESTAMP, org_config['timezone'])
+        date = EventDate(node_date, DateType.TIMESTAMP, org_config['timezone'],
+                         repeater=repeater)
         event.add_date(date, relative_to)
 
     return event
@@ -33,6 +33,7 @@ https://github.com/albins/orgnode.git
 import re
 import datetime
 import codecs
+import hashlib
 
 def get_datetime(year, month, day, hour=None, minute=None, second=None):
     if "" in (year, month, day):
@@ -49,6 +50,10 @@ def get_datetime(year, month, day, hour=None, minute=None, second=None):
         return datetime.datetime(*ymdhms)
     return datetime.date(*ymdhms)
 
+# Optional repeater cookie (+1w, .+1d, ++1m) and a warning period (-2d)
+# which can follow the time within an active timestamp.
+_REPEATER = r"(?:\s+([.+]?\+\d+[hdwmy]))?(?:\s+-{1,2}\d+[hdwmy])?\s*"
+
 def _re_compile_date():
     """
     >>> re_date = _re_compile_date()
@@ -57,79 +62,83 @@ def _re_compile_date():
     >>> m.group()
     '<2010-06-21 Mon>'
     >>> m.group(1)
-    >>> m.group(16)
+    >>> m.group(18)
     '<2010-06-21 Mon>'
     >>> m = re_date.match('<2010-06-21 Mon 12:00>--<2010-06-21 Mon 12:00>')
     >>> m.group()
     '<2010-06-21 Mon 12:00>--<2010-06-21 Mon 12:00>'
     >>> m.group(1)
     '<2010-06-21 Mon 12:00>--<2010-06-21 Mon 12:00>'
-    >>> m.group(16)
+    >>> m.group(18)
+    >>> m = re_date.match('<2010-06-21 Mon 12:00 .+1w>')
+    >>> m.group(26)
+    '.+1w'
     """
-    date_pattern = r"<(\d+)\-(\d+)\-(\d+)([^>\d]*)((\d+)\:(\d+))?>"
+    date_pattern = r"<(\d+)\-(\d+)\-(\d+)([^>\d]*)((\d+)\:(\d+))?" + _REPEATER + ">"
     re_date = re.compile('(%(dtp)s--%(dtp)s)|(%(dtp)s)'
                          % dict(dtp=date_pattern))
     return re_date
 
 _RE_DATE = _re_compile_date()
 def find_daterangelist(string):
+    """
+    Find active timestamps and ranges in a given string.
+
+    Return (datelist, rangelist, repeaters) where repeaters is a list of
+    repeater cookies (or None) matching datelist entries.
+    """
     datelist = []
     rangelist = []
+    repeaters = []
     for dm in _RE_DATE.findall(string):
         if dm[0]:
             d1 = get_datetime(dm[1], dm[2], dm[3], dm[6], dm[7])
-            d2 = get_datetime(dm[8], dm[9], dm[10], dm[13], dm[14])
+            d2 = get_datetime(dm[9], dm[10], dm[11], dm[14], dm[15])
             rangelist.append((d1, d2))
         else:
-            dt = get_datetime(dm[16], dm[17], dm[18], dm[21], dm[22])
+            dt = get_datetime(dm[18], dm[19], dm[20], dm[23], dm[24])
             datelist.append(dt)
-    return (datelist, rangelist)
+            repeaters.append(dm[25] or None)
+    return (datelist, rangelist, repeaters)
+
+def _find_date(regexp, line):
+    """
+    Search for a date using a SCHEDULED/DEADLINE regexp.
+    Return (date, repeater) tuple, (None, None) if not found.
+    """
+    found = regexp.search(line)
+    if not found:
+        return None, None
+    if found.group(4) is None:
+        date = datetime.date(int(found.group(1)),
+                             int(found.group(2)),
+                             int(found.group(3)))
+    else:
+        date = datetime.datetime(int(found.group(1)),
+                                 int(found.group(2)),
+                                 int(found.group(3)),
+                                 int(found.group(5)),
+                                 int(found.group(6)))
+    return date, found.group(7)
 
 _RE_SCHEDULED = re.compile(
-    r'SCHEDULED:\s+<(\d+)\-(\d+)\-(\d+)[^>\d]*((\d+)\:(\d+))?>')
+    r'SCHEDULED:\s+<(\d+)\-(\d+)\-(\d+)[^>\d]*((\d+)\:(\d+))?' + _REPEATER + '>')
 def find_scheduled(line):
     """
     Find SCHEDULED from given string.
     Return datetime object if found else None.
     """
-    sd_re = _RE_SCHEDULED.search(line)
-    if sd_re:
-        if sd_re.group(4) == None:
-            sched_date = datetime.date(int(sd_re.group(1)),
-                                       int(sd_re.group(2)),
-                                       int(sd_re.group(3)))
-        else:
-            sched_date = datetime.datetime(int(sd_re.group(1)),
-                                           int(sd_re.group(2)),
-                                           int(sd_re.group(3)),
-                                           int(sd_re.group(5)),
-                                           int(sd_re.group(6)))
-    else:
-        sched_date = None
-    return sched_date
+    return _find_date(_RE_SCHEDULED, line)[0]
 
-_RE_DEADLINE = re.compile(r'DEADLINE:\s+<(\d+)\-(\d+)\-(\d+)[^>\d]*((\d+)\:(\d+))?>')
+_RE_DEADLINE = re.compile(
+    r'DEADLINE:\s+<(\d+)\-(\d+)\-(\d+)[^>\d]*((\d+)\:(\d+))?' + _REPEATER + '>')
 
 def find_deadline(line):
     """
     Find DEADLINE from given string.
     Return datetime object if found else None.
     """
-    dd_re = _RE_DEADLINE.search(line)
-    if dd_re:
-        if dd_re.group(4) == None:
-            deadline_date = datetime.date(int(dd_re.group(1)),
-                                          int(dd_re.group(2)),
-                                          int(dd_re.group(3)))
-        else:
-            deadline_date = datetime.datetime(int(dd_re.group(1)),
-                                              int(dd_re.group(2)),
-                                              int(dd_re.group(3)),
-                                              int(dd_re.group(5)),
-                                              int(dd_re.group(6)))
-    else:
-        deadline_date = None
-    return deadline_date
+    return _find_date(_RE_DEADLINE, line)[0]
 
 _RE_TAGSRCH = re.compile(r'(.*?)\s*:(.*?):(.*?)$')
 def find_tags_and_heading(heading):
@@ -229,41 +238,61 @@ def makelist(filename, todo_default=['TODO', 'DONE']):
     Read an org-mode file and return a list of Orgnode objects
     created from this file.
     """
+    if isinstance(filename, str):
+        with codecs.open(filename, 'r', 'utf8') as f:
+            return _makelist(f, filename, todo_default)
+    return _makelist(filename, None, todo_default)
+
+def _makelist(f, path, todo_default):
+    "Create Orgnode objects out of lines of a file opened at a given path"
     ctr = 0
 
-    if isinstance(filename, str):
-        f = codecs.open(filename, 'r', 'utf8')
-    else:
-        f = filename
+    # Byte offsets of headlines and a hash of the content allow to patch the
+    # file in place later.
+    offset = 0
+    heading_offset = 0
+    heading_length = 0
+    content_hash = hashlib.sha1()
 
     todos = set(todo_default) # populated from #+SEQ_TODO line
     level = ''
     heading = ""
-    bodytext = ""
+    bodylines = []   # joined once per node - avoids quadratic concatenation
     tag1 = ""      # The first tag enclosed in ::
     alltags = set([]) # set of all tags in headline
     sched_date = ''
+    sched_repeater = None
     deadline_date = ''
+    deadline_repeater = None
     closed_date = ''
     clocklist = []
     datelist = []
+    date_repeaters = []
     rangelist = []
     nodelist = []
     propdict = dict()
 
     for line in f:
         ctr += 1
+        line_bytes = line.encode('utf8')
+        content_hash.update(line_bytes)
+        line_offset = offset
+        offset += len(line_bytes)
         hdng = _RE_HEADING.search(line)
 
         if hdng:
             if heading:  # we are processing a heading line
-                this_node = Orgnode(level, heading, bodytext, tag1, alltags)
+                this_node = Orgnode(level, heading, ''.join(bodylines),
+                                    tag1, alltags)
+                this_node.set_location(path, heading_offset, heading_length)
                 if sched_date:
-                    this_node.set_scheduled(sched_date)
+                    this_node.set_scheduled(sched_date, sched_repeater)
                     sched_date = ""
+                    sched_repeater = None
                 if deadline_date:
-                    this_node.set_deadline(deadline_date)
+                    this_node.set_deadline(deadline_date, deadline_repeater)
                     deadline_date = ''
+                    deadline_repeater = None
                 if closed_date:
                     this_node.set_closed(closed_date)
                     closed_date = ''
@@ -271,8 +300,9 @@ def makelist(filename, todo_default=['TODO', 'DONE']):
                     this_node.set_clock(clocklist)
                     clocklist = []
                 if datelist:
-                    this_node.set_datelist(datelist)
+                    this_node.set_datelist(datelist, date_repeaters)
                     datelist = []
+                    date_repeaters = []
                 if rangelist:
                     this_node.set_rangelist(rangelist)
                     rangelist = []
@@ -281,7 +311,9 @@ def makelist(filename, todo_default=['TODO', 'DONE']):
                 propdict = dict()
             level = hdng.group(1)
             heading = hdng.group(2)
-            bodytext = ""
+            heading_offset = line_offset
+            heading_length = len(line_bytes)
+            bodylines = []
             (tag1, alltags, heading) = find_tags_and_heading(heading)
         else:      # we are processing a non-heading line
             if line.startswith('#+SEQ_TODO'):
@@ -295,30 +327,34 @@ def makelist(filename, todo_default=['TODO', 'DONE']):
             if prop_key:
                 propdict[prop_key] = prop_val
                 continue
-            _sched_date = find_scheduled(line)
-            _deadline_date = find_deadline(line)
+            _sched_date, _sched_repeater = _find_date(_RE_SCHEDULED, line)
+            _deadline_date, _deadline_repeater = _find_date(_RE_DEADLINE, line)
             _closed_date = find_closed(line)
-            sched_date = _sched_date or sched_date
-            deadline_date = _deadline_date or deadline_date
+            if _sched_date:
+                sched_date, sched_repeater = _sched_date, _sched_repeater
+            if _deadline_date:
+                deadline_date, deadline_repeater = _deadline_date, _deadline_repeater
             closed_date = closed_date or _closed_date
             if not _sched_date and not _deadline_date:
-                (dl, rl) = find_daterangelist(line)
+                (dl, rl, rp) = find_daterangelist(line)
                 datelist += dl
                 rangelist += rl
+                date_repeaters += rp
             clock = find_clock(line)
             if clock:
                 clocklist.append(clock)
             if not (line.startswith('#') or _sched_date or _deadline_date
                     or clock or _closed_date):
-                bodytext = bodytext + line
+                bodylines.append(line)
 
     # write out last node
-    this_node = Orgnode(level, heading, bodytext, tag1, alltags)
+    this_node = Orgnode(level, heading, ''.join(bodylines), tag1, alltags)
+    this_node.set_location(path, heading_offset, heading_length)
     this_node.set_properties(propdict)
     if sched_date:
-        this_node.set_scheduled(sched_date)
+        this_node.set_scheduled(sched_date, sched_repeater)
     if deadline_date:
-        this_node.set_deadline(deadline_date)
+        this_node.set_deadline(deadline_date, deadline_repeater)
     if closed_date:
         this_node.set_closed(closed_date)
         closed_date = ''
@@ -326,7 +362,7 @@ def makelist(filename, todo_default=['TODO', 'DONE']):
         this_node.set_clock(clocklist)
         clocklist = []
     if datelist:
-        this_node.set_datelist(datelist)
+        this_node.set_datelist(datelist, date_repeaters)
         datelist = []
     if rangelist:
         this_node.set_rangelist(rangelist)
@@ -335,7 +371,9 @@ def makelist(filename, todo_default=['TODO', 'DONE']):
 
     # using the list of TODO keywords found in the file
     # process the headings searching for TODO keywords
+    file_hash = content_hash.hexdigest()
     for n in nodelist:
+        n.file_hash = file_hash
         h = n.headline
 
         todo_search = _RE_TODO_SRCH.search(h)
@@ -349,8 +387,9 @@ def makelist(filename, todo_default=['TODO', 'DONE']):
             n.set_priority(priority_search.group(1))
             n.set_heading(priority_search.group(2))
 
-    # set parent of nodes
+    # set parent of nodes, inherited tags and outline paths
     ancestors = [None]
+    interned_tags = {}
     n1 = nodelist[0]
     l1 = n1.level
     for n2 in nodelist:
@@ -364,6 +403,19 @@ def makelist(filename, todo_default=['TODO', 'DONE']):
                 ancestors.pop()
         if ancestors:
             n2.set_parent(ancestors[-1])
+
+        parent = n2.parent
+        if parent is None:
+            all_tags = frozenset(n2.tags)
+            n2.path = ()
+        else:
+            all_tags = parent.all_tags.union(n2.tags)
+            if parent.child_path is None:
+                parent.child_path = parent.path + (parent.headline,)
+            n2.path = parent.child_path
+        # Most nodes share few distinct tag sets - keep one copy of each.
+        n2.all_tags = interned_tags.setdefault(all_tags, all_tags)
+
         n1 = n2
         l1 = l2
 
@@ -391,13 +443,29 @@ class Orgnode:
         self.priority = ""            # empty of A, B or C
         self.scheduled = ""       # Scheduled date
         self.deadline = ""        # Deadline date
+        self.scheduled_repeater = None  # Repeater cookies (eg. +1w)
+        self.deadline_repeater = None
         self.clock = []
         self.closed = ""
         self.properties = dict()
         self.datelist = []
+        self.datelist_repeaters = []  # Repeater cookie (or None) per date
         self.rangelist = []
         self.parent = None
 
+        # Computed by makelist: tags including inherited ones and headlines
+        # of ancestors (shared between siblings).
+        self.all_tags = frozenset(alltags)
+        self.path = ()
+        self.child_path = None
+
+        # Set by makelist: file, byte offset and length of the headline line
+        # and hash of the file content when it was read.
+        self.filename = None
+        self.offset = None
+        self.length = None
+        self.file_hash = None
+
         # Look for priority in headline and transfer to priority field
 
     def set_heading(self, newhdng):
@@ -417,10 +485,11 @@ class Orgnode:
         """
         Returns a list of all tags
         For example, :HOME:COMPUTER: would return ['HOME', 'COMPUTER']
-        If `inher` is True, then all tags from ancestors is included.
+        If `inher` is True, then all tags from ancestors is included
+        (precomputed by makelist).
         """
-        if inher and self.parent:
-            return self.tags | set(self.parent.get_tags(True))
+        if inher:
+            return self.all_tags
         else:
             return self.tags
 
@@ -465,23 +534,32 @@ class Orgnode:
         """
         return self.properties.get(keyval, "")
 
-    def set_scheduled(self, dateval):
+    def set_scheduled(self, dateval, repeater=None):
         """
         Set the scheduled date using the supplied date object
+        and an optional repeater cookie
         """
         self.scheduled = dateval
+        self.scheduled_repeater = repeater
 
-    def set_deadline(self, dateval):
+    def set_deadline(self, dateval, repeater=None):
         """
         Set the deadline (due) date using the supplied date object
+        and an optional repeater cookie
         """
         self.deadline = dateval
+        self.deadline_repeater = repeater
 
-    def set_datelist(self, datelist):
+    def set_datelist(self, datelist, repeaters=None):
         """
         Set the list of date using list of the supplied date object
+        and an optional list of matching repeater cookies
         """
         self.datelist = datelist[:]
+        if repeaters is None:
+            repeaters = [None] * len(datelist)
+        assert len(repeaters) == len(datelist)
+        self.datelist_repeaters = repeaters[:]
 
     def get_datelist(self):
         """
@@ -522,6 +600,14 @@ class Orgnode:
         """
         self.clock = clock[:]
 
+    def set_location(self, filename, offset, length):
+        """
+        Set file name, byte offset and byte length of the headline line
+        """
+        self.filename = filename
+        self.offset = offset
+        self.length = length
+
     def set_parent(self, parent):
         """
         Set parent node
@@ -11,6 +11,7 @@ Works for me though.
 (C) 2018 by Tomasz bla Fortuna
 """
 import datetime as dt
+from collections import namedtuple
 import pytz
 
 from orgassist import log
@@ -19,6 +20,12 @@ from orgassist.config import ConfigError
 
 from . import helpers
 from orgassist.helpers import get_template, get_default_template
+from orgassist.helpers import PhaseTrace
+from orgassist.helpers import sources
+
+# Immutable result of loading org files, shared between assistants
+OrgSnapshot = namedtuple('OrgSnapshot',
+                         'events, nodes, projects, files, trace')
 
 
 @Assistant.plugin('org')
@@ -26,32 +33,148 @@ class OrgPlugin(AssistantPlugin):
     """
     Handle operations on an org-mode tree
     """
-    def refresh_db(self):
-        "Refresh/load DB with org entries"
+    def load_db(self, changed=None):
+        """
+        Load org entries and convert them to events.
+
+        Called by the shared source - only once for all assistants using the
+        same org configuration. Each phase of loading is traced.
+
+        If a list of changed files is given, the tree is not walked again
+        and only those files are parsed. None is returned if none of them
+        belongs to the tree.
+
+        Events of nodes reused from the parse cache are reused too, so the
+        calendar update is proportional to the change.
+        """
+        trace = PhaseTrace('org refresh')
+        cfg = self.parsed_config
+
+        if changed is None:
+            with trace.phase('walk') as phase:
+                files = self.tree.walk()
+                phase.items = len(files)
+        else:
+            if not self.tree.update(changed):
+                return None
+            files = self.tree.found
+
+        with trace.phase('parse') as phase:
+            db = self.tree.parse(files, trace.items)
+            phase.items = len(db)
+        log.debug('Parsed %d org files, %d unchanged reused',
+                  len(files) - self.tree.reused, self.tree.reused)
+
+        with trace.phase('convert') as phase:
+            # Count only converted nodes
+            phase.items = 0
+            converted = {}
+            for node in db:
+                cached = self.converted.get(id(node))
+                if cached is None:
+                    cached = (node, helpers.orgnode_to_event(node, cfg))
+                    phase.items += 1
+                converted[id(node)] = cached
+            self.converted = converted
+            events = tuple(converted[id(node)][1] for node in db)
+
+        with trace.phase('rollup') as phase:
+            helpers.compute_rollups(db, cfg, self.time.now())
+            projects = []
+            for node, event in zip(db, events):
+                if node.todo == cfg['project']:
+                    event.meta['rollup'] = node.rollup
+                    projects.append(event)
+            phase.items = len(projects)
+
         log.info('Refreshed/read org-mode data')
-        db = helpers.load_orgnode(self.parsed_config)
-        events = [
-            helpers.orgnode_to_event(node, self.parsed_config)
-            for node in db
-        ]
+        return OrgSnapshot(events=events, nodes=tuple(db),
+                           projects=tuple(projects),
+                           files=frozenset(path for path, _ in files),
+                           trace=trace)
+
+    def update_calendar(self, snapshot):
+        "Feed events of a new snapshot into the calendar"
+        trace = snapshot.trace.copy()
+        with trace.phase('calendar') as phase:
+            self.state['calendar'].update_events(snapshot.events, 'org')
+            phase.items = len(snapshot.events)
+
+        for line in trace.describe():
+            log.debug(line)
+        for phase in trace.phases:
+            self.assistant.stats.record('org.' + phase.name, phase.seconds)
+        self.assistant.stats.set('events.org', len(snapshot.events))
+
+        self.last_trace = trace
+        # Files reused from the parse cache keep their last parse time
+        durations = {
+            path: duration
+            for path, duration in self.parse_durations.items()
+            if path in snapshot.files
+        }
+        durations.update(trace.items)
+        self.parse_durations = durations
+        self.node_count = len(snapshot.nodes)
+
+    def refresh_db(self, max_age=0):
+        """
+        Refresh/load DB with org entries, unless other assistant sharing the
+        same source did it less than max_age seconds ago.
+        """
+        snapshot = self.source.refresh(max_age)
+        return snapshot.events
 
-        self.state['calendar'].update_events(events, 'org')
-        return events
+    def reparse(self, path):
+        """
+        Parse a single changed file (eg. saved in an editor) and update
+        calendars. Return False if the file is not a part of the org tree.
+        """
+        generation = self.source.generation
+        self.source.refresh(changed=[path])
+        return self.source.generation != generation
+
+    def get_metrics(self):
+        "Parse durations and node counts"
+        samples = [
+            ('orgassist_org_parse_seconds', {'file': path}, duration)
+            for path, duration in sorted(self.parse_durations.items())
+        ]
+        samples.append(('orgassist_org_nodes', {}, self.node_count))
+        return samples
 
     def register(self):
         commands = [
             (['note', 'no'], self.handle_note),
             (['refresh'], self.handle_refresh),
+            (['projects', 'pr'], self.handle_projects),
+            (['done'], self.handle_done),
         ]
         for aliases, callback in commands:
             self.assistant.command.register(aliases, callback)
 
     def initialize(self):
         "Initialize org plugin, read database and schedule updates"
-        self.refresh_db()
+        # Stats of the last refresh
+        self.last_trace = None
+        self.parse_durations = {}
+        self.node_count = 0
+
+        # Org files with change-detection cache
+        self.tree = helpers.OrgTree(self.parsed_config)
+        # id(node) -> (node, event) of the last load
+        self.converted = {}
+
+        # Assistants with the same org configuration share parsed data
+        key = sources.make_key('org', self.parsed_config)
+        self.source = sources.registry.get(key, self.load_db)
+        self.source.subscribe(self.update_calendar)
 
+        # Periodic refreshes are skipped if other assistant refreshed recently
         interval = self.config.get('scan_interval_s', assert_type=int)
-        self.scheduler.every(interval).seconds.do(self.refresh_db)
+        self.refresh_db(max_age=interval / 2)
+        self.scheduler.every(interval).seconds.do(self.refresh_db,
+                                                  max_age=interval / 2)
 
     def validate_config(self):
         "Read config and apply defaults"
@@ -66,6 +189,10 @@ class OrgPlugin(AssistantPlugin):
             'files_re': self.config.get('org_regexp', default=r'.*\.org$'),
             'base': self.config.get_path('directory'),
 
+            # Glob patterns of files and directories to skip (matched
+            # against names and paths relative to the base)
+            'exclude': self.config.get('exclude', default=['.git']),
+
             # Look 5 days ahead
             #'horizont_future': self.config.get('agenda.horizont_future', default=2),
             #'horizont_past': self.config.get('agenda.horizont_past', default=10),
@@ -80,6 +207,9 @@ class OrgPlugin(AssistantPlugin):
             # How grouping entry is marked - which groups TODOs and DONEs.
             'project': self.config.get('todos.project', default='PROJECT'),
 
+            # Parsed files are kept between runs
+            'cache_path': self.config.get_path('cache_path', required=False),
+
             # Ignore exceptions during file parsing (happens in orgnode when file is
             # badly broken or not ORG at all).
             # This should be fixed in orgnode.
@@ -96,7 +226,8 @@ class OrgPlugin(AssistantPlugin):
         if self.note_position != 'append':
             raise ConfigError('Unhandled new note position: ' + self.note_position)
         try:
-            open(self.note_inbox, 'a')
+            with open(self.note_inbox, 'a'):
+                pass
         except IOError:
             raise ConfigError("Unable to open note inbox file: " + self.note_inbox)
 
@@ -176,8 +307,67 @@ class OrgPlugin(AssistantPlugin):
         else:
             message.respond('Got it!')
 
+    def handle_projects(self, message):
+        "Report TODO counts of projects computed during the last refresh"
+        projects = self.source.result.projects
+        if not projects:
+            message.respond("No projects found.")
+            return
+        lines = [
+            "%s: %s" % (event.headline, event.meta['rollup'].describe())
+            for event in projects
+        ]
+        message.respond("\n".join(lines))
+
+    def handle_done(self, message):
+        """
+        Mark an entry from the last listed results (search, query, tag or
+        agenda) as done: done 2
+        """
+        listed = self.state.get('listed', [])
+        try:
+            number = int(message.text.strip())
+            if number < 1:
+                raise IndexError
+            event = listed[number - 1]
+        except (ValueError, IndexError):
+            message.respond("Usage: done <number of a listed entry>")
+            return
+
+        # Cyclic events are listed as occurrences
+        event = event.occurrence_of or event
+        node = event.meta.get('org_node')
+        if node is None or self.state['calendar'].source_of(event) != 'org':
+            message.respond("Only org entries can be marked as done.")
+            return
+        if event.repeating:
+            message.respond("Entry '%s' is repeating - mark it done in "
+                            "org-mode." % event.headline)
+            return
+        if event.state is not None and not event.state.is_open:
+            message.respond("Entry '%s' is already %s." %
+                            (event.headline, event.state.name))
+            return
+
+        cfg = self.parsed_config
+        state = cfg['todos_closed'][0]
+        try:
+            helpers.set_todo_state(node, state, self.tree.todo_all)
+        except (helpers.OrgEditError, OSError) as ex:
+            message.respond("Unable to change '%s': %s" % (event.headline, ex))
+            return
+
+        self.source.refresh(changed=[node.filename])
+        message.respond("Marked '%s' as %s." % (event.headline, state))
+
     def handle_refresh(self, message):
-        "Handle refresh request"
+        """
+        Handle refresh request
+
+        "refresh trace" additionally replies with a per-phase breakdown.
+        """
         events = self.refresh_db()
         message.respond("Loaded %d events" % len(events))
+        if message.text.strip() == 'trace':
+            message.respond("\n".join(self.last_trace.describe()))
 
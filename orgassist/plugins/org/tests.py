@@ -1,5 +1,7 @@
+import os
 import random
 import io
+import tempfile
 import datetime as dt
 import pytz
 
@@ -8,6 +10,10 @@ import unittest
 import jinja2
 
 from orgassist.calendar import DateType
+from orgassist.config import Config
+from orgassist.assistant import Assistant
+from orgassist.helpers import Scheduler
+import orgassist.plugins
 from . import orgnode
 from . import helpers
 
@@ -29,6 +35,10 @@ ORG_TMPL = """
    [{{ accurate }}]
 ** [#A] Ranged              :RANGE:
    <{{ yesterday }}>--<{{ today }}>
+** TODO Weekly review       :REPEAT:
+   SCHEDULED: <{{ yesterday }} +1w>
+** Standup                  :REPEAT_APP:
+   <{{ accurate }} .+1d>
 """
 DAYTIME = '%Y-%m-%d %a %H:%M'
 DAY = '%Y-%m-%d %a'
@@ -123,6 +133,240 @@ class TestOrg(unittest.TestCase):
                 self.assertEqual(event.priority, 'B')
                 self.assertTrue(relevant.appointment)
 
-        self.assertEqual(len(events), 8)
+            if 'REPEAT' in event.tags:
+                self.assertEqual(str(event.relevant_date.repeater), '+1w')
+                self.assertTrue(event.repeating)
+            if 'REPEAT_APP' in event.tags:
+                self.assertEqual(str(event.relevant_date.repeater), '.+1d')
+                self.assertTrue(event.relevant_date.appointment)
 
+        self.assertEqual(len(events), 10)
 
+
+
+    def test_tree(self):
+        "Test walking org tree with cache, exclusions and symlinks"
+        with tempfile.TemporaryDirectory() as base:
+            os.makedirs(os.path.join(base, 'sub'))
+            os.makedirs(os.path.join(base, 'data'))
+            for path in ['main.org', 'sub/other.org', 'data/attachment.org',
+                         'notes.txt']:
+                with open(os.path.join(base, path), 'w') as handle:
+                    handle.write(self.rendered_org)
+
+            # Loop and a duplicate path to the same file
+            os.symlink(base, os.path.join(base, 'sub', 'loop'))
+            os.symlink(os.path.join(base, 'main.org'),
+                       os.path.join(base, 'sub', 'link.org'))
+
+            cfg = dict(ORG_CONFIG, base=base, files_re=r'.*\.org$',
+                       exclude=['.git', 'data'])
+            tree = helpers.OrgTree(cfg)
+            files = tree.walk()
+            names = sorted(os.path.relpath(path, base) for path, _ in files)
+            self.assertEqual(names, ['main.org', 'sub/other.org'])
+
+            nodes = tree.parse(files)
+            self.assertEqual(len(nodes), 2 * len(self.db))
+            self.assertEqual(tree.reused, 0)
+
+            # Nothing changed - nothing is parsed.
+            durations = {}
+            tree.parse(tree.walk(), durations)
+            self.assertEqual(tree.reused, 2)
+            self.assertEqual(durations, {})
+
+            # New file and a modified one
+            with open(os.path.join(base, 'sub', 'new.org'), 'w') as handle:
+                handle.write("* TODO New\n")
+            with open(os.path.join(base, 'main.org'), 'a') as handle:
+                handle.write("\n* TODO Appended\n")
+            nodes = tree.parse(tree.walk())
+            self.assertEqual(tree.reused, 1)
+            self.assertEqual(len(nodes), 2 * len(self.db) + 2)
+
+            # Files reported by an editor are handled without walking
+            with open(os.path.join(base, 'sub', 'saved.org'), 'w') as handle:
+                handle.write("* TODO Saved\n")
+            os.unlink(os.path.join(base, 'sub', 'new.org'))
+            self.assertTrue(tree.update([
+                os.path.join(base, 'sub', 'saved.org'),
+                os.path.join(base, 'sub', 'new.org'),
+            ]))
+            nodes = tree.parse(tree.found)
+            self.assertEqual(tree.reused, 2)
+            self.assertEqual(len(nodes), 2 * len(self.db) + 2)
+
+            self.assertTrue(tree.update([os.path.join(base, 'sub', 'link.org')]))
+            tree.parse(tree.found)
+            self.assertEqual(tree.reused, 2)
+
+            self.assertFalse(tree.update([os.path.join(base, 'notes.txt')]))
+            self.assertFalse(tree.update([os.path.join(base, 'data', 'attachment.org')]))
+
+            # Files linked into the tree from elsewhere
+            with tempfile.TemporaryDirectory() as other:
+                for name in ['linked.org', 'later.org']:
+                    with open(os.path.join(other, name), 'w') as handle:
+                        handle.write("* TODO %s\n" % name)
+                os.symlink(os.path.join(other, 'linked.org'),
+                           os.path.join(base, 'linked.org'))
+                files = tree.walk()
+                self.assertIn(os.path.join(base, 'linked.org'),
+                              [path for path, _ in files])
+                tree.parse(files)
+                self.assertTrue(tree.update([os.path.join(base, 'linked.org')]))
+
+                os.symlink(os.path.join(other, 'later.org'),
+                           os.path.join(base, 'later.org'))
+                self.assertTrue(tree.update([os.path.join(base, 'later.org')]))
+                nodes = tree.parse(tree.found)
+                self.assertIn('later.org', [node.headline for node in nodes])
+                self.assertFalse(tree.update([os.path.join(other, 'other.org')]))
+
+    def test_persistent_cache(self):
+        "Parse results are reused across OrgTree instances"
+        with tempfile.TemporaryDirectory() as base:
+            with open(os.path.join(base, 'main.org'), 'w') as handle:
+                handle.write(self.rendered_org)
+            cfg = dict(ORG_CONFIG, base=base, files_re=r'.*\.org$',
+                       cache_path=os.path.join(base, 'cache', 'org.cache'))
+
+            tree = helpers.OrgTree(cfg)
+            nodes = tree.parse(tree.walk())
+            self.assertTrue(os.path.exists(cfg['cache_path']))
+
+            tree = helpers.OrgTree(cfg)
+            cached = tree.parse(tree.walk())
+            self.assertEqual(tree.reused, 1)
+            self.assertEqual([node.headline for node in cached],
+                             [node.headline for node in nodes])
+
+            # Cache of a different TODO configuration is not used
+            tree = helpers.OrgTree(dict(cfg, todos_open=['NEXT']))
+            tree.parse(tree.walk())
+            self.assertEqual(tree.reused, 0)
+
+            # Broken cache is ignored
+            with open(cfg['cache_path'], 'wb') as handle:
+                handle.write(b'garbage')
+            tree = helpers.OrgTree(cfg)
+            tree.parse(tree.walk())
+            self.assertEqual(tree.reused, 0)
+
+    def test_rollups(self):
+        "Test project rollups"
+        now = self.utc.localize(dt.datetime.now())
+        helpers.compute_rollups(self.db, ORG_CONFIG, now)
+
+        project = self.db[0]
+        self.assertEqual(project.headline, 'Aggregator')
+        self.assertEqual(project.rollup.open, 3)
+        self.assertEqual(project.rollup.closed, 1)
+        # Past task and the weekly review
+        self.assertEqual(project.rollup.overdue, 2)
+        self.assertIsNone(project.rollup.next_deadline)
+        self.assertEqual(self.db[1].rollup.open, 0)
+
+    def test_inherited_tags(self):
+        "Test inherited tags, outline paths and private entries"
+        org = io.StringIO("* Work  :WORK:\n"
+                          "** Team\n"
+                          "*** TODO Review  :CODE:\n"
+                          "*** Health  :PRIVATE:\n"
+                          "**** Dentist\n"
+                          "     body\n"
+                          "* Home\n")
+        db = orgnode.makelist(org)
+        self.assertEqual(db[2].all_tags, {'WORK', 'CODE'})
+        self.assertEqual(db[2].get_tags(inher=True), {'WORK', 'CODE'})
+        self.assertEqual(db[2].path, ('Work', 'Team'))
+        # Siblings share the path, equal tag sets are interned
+        self.assertIs(db[2].path, db[3].path)
+        self.assertIs(db[0].all_tags, db[1].all_tags)
+        self.assertEqual(db[5].all_tags, set())
+        self.assertEqual(db[5].path, ())
+
+        cfg = dict(ORG_CONFIG, tags_private=['PRIVATE'])
+        events = [helpers.orgnode_to_event(node, cfg) for node in db]
+        self.assertEqual(events[2].all_tags, {'WORK', 'CODE'})
+        self.assertEqual(events[2].tags, {'CODE'})
+        self.assertEqual(events[2].path, ('Work', 'Team'))
+        dentist = events[4]
+        self.assertEqual(dentist.headline, helpers.PRIVATE_HEADLINE)
+        self.assertEqual(dentist.body, '')
+        self.assertEqual(dentist.path, ())
+
+    def test_set_todo_state(self):
+        "Test patching TODO state in place"
+        content = ("#+TITLE: Zażółć\n"
+                   "* TODO Gęślą jaźń  :TAG:\n"
+                   "  SCHEDULED: <2024-01-01 Mon>\n"
+                   "* [#A] Plain headline\n"
+                   "* TODO Last\n")
+        keywords = {'TODO', 'DONE'}
+        with tempfile.TemporaryDirectory() as base:
+            path = os.path.join(base, 'edit.org')
+            with open(path, 'w', encoding='utf8') as handle:
+                handle.write(content)
+
+            db = orgnode.makelist(path)
+            node = db[0]
+            self.assertEqual(node.filename, path)
+            self.assertEqual(node.offset, len("#+TITLE: Zażółć\n".encode('utf8')))
+            helpers.set_todo_state(node, 'DONE', keywords)
+
+            # File changed - stale locations are refused
+            with self.assertRaises(helpers.OrgEditError):
+                helpers.set_todo_state(db[1], 'TODO', keywords)
+
+            db = orgnode.makelist(path)
+            helpers.set_todo_state(db[1], 'TODO', keywords)
+            db = orgnode.makelist(path)
+            helpers.set_todo_state(db[2], 'DONE', keywords)
+            with open(path, encoding='utf8') as handle:
+                self.assertEqual(handle.read(),
+                                 "#+TITLE: Zażółć\n"
+                                 "* DONE Gęślą jaźń  :TAG:\n"
+                                 "  SCHEDULED: <2024-01-01 Mon>\n"
+                                 "* TODO [#A] Plain headline\n"
+                                 "* DONE Last\n")
+
+
+class TestOrgPlugin(unittest.TestCase):
+    "Test org plugin refreshes"
+
+    def test_parse_durations(self):
+        "Files reused from the parse cache keep their parse time"
+        base = tempfile.mkdtemp()
+        paths = [os.path.join(base, name) for name in ['a.org', 'b.org']]
+        for path in paths:
+            with open(path, 'w') as handle:
+                handle.write("* TODO Task\n")
+        config = Config.from_dict({
+            'timezone': 'UTC',
+            'channels': [
+                {'jid': 'boss@example.com'},
+            ],
+            'plugins': {
+                'calendar': {},
+                'org': {
+                    'directory': base,
+                    'scan_interval_s': 3600,
+                    'note': {'inbox': os.path.join(base, 'inbox.txt')},
+                },
+            },
+        })
+        plugin = Assistant('test', config, Scheduler()).plugins['org']
+        self.assertEqual(sorted(plugin.parse_durations), paths)
+
+        with open(paths[0], 'a') as handle:
+            handle.write("* TODO Other\n")
+        self.assertTrue(plugin.reparse(paths[0]))
+        self.assertEqual(list(plugin.last_trace.items), [paths[0]])
+        self.assertEqual(sorted(plugin.parse_durations), paths)
+
+        # Removed files are forgotten
+        os.unlink(paths[1])
+        self.assertTrue(plugin.reparse(paths[1]))
+        self.assertEqual(sorted(plugin.parse_durations), paths[:1])
@@ -24,7 +24,6 @@ setuptools.setup(
     install_requires=[
         'PyYAML==5.3',
         'sleekxmpp==1.3.1',
-        'schedule>=0.6.0',
         'Jinja2>=2.11.1',
         'pytz>=2019.3',
     ],